@@ -0,0 +1,126 @@
+"""
+Load time, memory and query latency of the airport autocomplete index.
+
+    python benchmarks/airports.py [airports.csv] [--countries countries.csv]
+
+Uses the OurAirports CSV the service would load (AIRPORTS_CSV, data/ by
+default). Without one, a synthetic file of the same shape and size is
+generated - about 80,000 rows, 9,000 of them with IATA codes - so cold start
+and memory can still be measured offline. Query latency is reported over a
+mix of code, prefix, multi-word and misspelled queries, including every
+city in AIRPORT_TO_CITY.
+"""
+
+import argparse
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from flight_agent import AIRPORT_TO_CITY, AIRPORTS_CSV, COUNTRIES_CSV, AirportIndex  # noqa: E402
+
+COLUMNS = ["id", "ident", "type", "name", "latitude_deg", "longitude_deg", "elevation_ft", "continent",
+           "iso_country", "iso_region", "municipality", "scheduled_service", "gps_code", "iata_code",
+           "local_code", "home_link", "wikipedia_link", "keywords"]
+SYLLABLES = ["ba", "ce", "lo", "na", "ri", "to", "ma", "dor", "sen", "ka", "vil", "le", "mu", "ster", "ham",
+             "burg", "ton", "ro", "pa", "qui", "zu", "rich", "an", "ge", "les", "por", "ti", "go", "bo", "sa"]
+SUFFIXES = ["International Airport", "Airport", "Regional Airport", "Airfield", "Municipal Airport"]
+
+
+def synthetic_csv(path, rows=80000, iata=9000, seed=7):
+    """OurAirports-shaped airports.csv: a mix of airport types, a fraction with IATA codes"""
+    rng = random.Random(seed)
+    codes = set(AIRPORT_TO_CITY)
+    while len(codes) < iata:
+        codes.add("".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(3)))
+    codes = sorted(codes)
+    rng.shuffle(codes)
+    countries = [f"{a}{b}" for a in "ABCDEFGHIJ" for b in "ABCDEFGHIJ"]
+
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for i in range(rows):
+            city = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).title()
+            code = codes[i] if i < iata else ""
+            if code in AIRPORT_TO_CITY:
+                city = AIRPORT_TO_CITY[code].split(",")[0]
+            kind = rng.choices(["large_airport", "medium_airport", "small_airport", "heliport", "closed"],
+                               [1, 8, 60, 20, 11])[0] if not code else rng.choices(
+                               ["large_airport", "medium_airport", "small_airport"], [6, 50, 44])[0]
+            writer.writerow([i, f"X{i:05d}", kind, f"{city} {rng.choice(SUFFIXES)}", 0, 0, 0, "EU",
+                             rng.choice(countries), "", city, rng.choice(["yes", "no"]), "", code, "", "", "", ""])
+    return path
+
+
+def queries(index, seed=11):
+    rng = random.Random(seed)
+    cities = sorted({label.split(",")[0] for label in AIRPORT_TO_CITY.values()})
+    names = [entry[AirportIndex.NAME] or entry[AirportIndex.CITY] for entry in index.entries]
+    mix = list(AIRPORT_TO_CITY)                                        # exact codes
+    mix += [code[:n] for code in AIRPORT_TO_CITY for n in (1, 2)]      # code prefixes
+    mix += [city[:n] for city in cities for n in (3, 5)]               # as-you-type
+    mix += cities                                                      # full city names
+    mix += [" ".join(w[:4] for w in rng.choice(names).split()[:2]) for _ in range(500)]  # multi-word
+    for city in cities:                                                # one-letter typos
+        if len(city) > 4:
+            i = rng.randrange(1, len(city) - 1)
+            mix.append(city[:i] + city[i + 1:])
+    rng.shuffle(mix)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv", nargs="?", default=AIRPORTS_CSV)
+    parser.add_argument("--countries", default=COUNTRIES_CSV)
+    parser.add_argument("--repeat", type=int, default=5, help="load-time repetitions (best is reported)")
+    args = parser.parse_args()
+
+    path = args.csv
+    if not os.path.exists(path):
+        path = synthetic_csv(os.path.join(tempfile.mkdtemp(prefix="bench_airports_"), "airports.csv"))
+        print(f"{args.csv} not found - using synthetic data")
+    print(f"{path}: {os.path.getsize(path) / 1e6:.1f} MB")
+
+    load_seconds = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        AirportIndex.load(path, args.countries)
+        load_seconds = min(load_seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    index = AirportIndex.load(path, args.countries)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    index_bytes = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+    mix = queries(index)
+    latencies = []
+    empty = 0
+    for query in mix:
+        start = time.perf_counter()
+        results = index.search(query)
+        latencies.append(time.perf_counter() - start)
+        empty += not results
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1e6
+
+    print(f"index: {index.stats()}")
+    print(f"load  {load_seconds * 1000:6.0f} ms   memory {index_bytes / 1e6:5.1f} MB")
+    print(f"query p50 {pct(50):5.0f} us   p99 {pct(99):5.0f} us   max {latencies[-1] * 1e6:5.0f} us"
+          f"   ({len(mix)} queries, {empty} with no results)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Memory and build-time cost of FlightRecord vs the old per-flight dicts.
+
+    python benchmarks/flight_records.py [records]
+
+Builds records from synthetic google_flights payloads and reports the memory
+they hold (tracemalloc) and the time to extract them, next to the same
+flights in the dict shape the API returns - FlightRecord.to_dict(), which is
+what _extract_flight_details used to build for every flight - and the cost of
+that conversion, now only paid for the flights that reach a response.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flight_agent import agent  # noqa: E402
+from payloads import payload_corpus  # noqa: E402
+
+
+def extract_all(corpus):
+    flights = []
+    for payload, origin, destination, outbound, return_date in corpus:
+        flights.extend(agent._extract_date_results(payload, origin, destination, outbound, return_date))
+    return flights
+
+
+def retained(build):
+    """(result, bytes still allocated once build() returns)"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return result, sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+
+def timed(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    target = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    corpus = payload_corpus(max(1, target // 8))  # _extract_date_results keeps 8 per date
+
+    records, record_bytes = retained(lambda: extract_all(corpus))
+    dicts, dict_bytes = retained(lambda: [r.to_dict() for r in extract_all(corpus)])
+    n = len(records)
+
+    extract_time = timed(lambda: extract_all(corpus))
+    to_dict_time = timed(lambda: [r.to_dict() for r in records])
+
+    print(f"{n} flights from {len(corpus)} payloads")
+    print(f"FlightRecord  {record_bytes / n:6.0f} bytes/flight   extract {extract_time / n * 1e6:5.1f} us/flight")
+    print(f"dict          {dict_bytes / n:6.0f} bytes/flight   to_dict {to_dict_time / n * 1e6:5.1f} us/flight")
+    print(f"memory saved: {1 - record_bytes / dict_bytes:.0%}")
+
+
+if __name__ == "__main__":
+    main()
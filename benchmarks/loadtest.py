@@ -0,0 +1,283 @@
+"""
+Open-loop load test for POST /itinerary against the local stand-ins.
+
+    python benchmarks/loadtest.py --mode gunicorn --workers 2 --threads 8 --rate 4 --duration 60
+    python benchmarks/loadtest.py --mode uvicorn --rate 20 --duration 60
+    python benchmarks/loadtest.py --url http://host:8080 --pid 1234 --rate 4
+
+Starts the stand-ins, launches the service in the chosen serving mode with
+SerpApi and Anthropic pointed at them (or targets --url), then sends a mix of
+full-service and itinerary_only bodies at a fixed average arrival rate
+(Poisson arrivals, so load does not back off when the server slows down).
+Reports throughput, latency percentiles, error and timeout rates and the
+server's peak RSS - the baseline for choosing worker counts.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standins import REPO, StandIns, add_arguments  # noqa: E402
+
+DESTINATIONS = ["BCN", "CDG", "FCO", "AMS", "LIS", "PRG", "BER", "MAD", "DUB", "ATH", "VIE", "CPH"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def server_command(args, port):
+    if args.mode == "uvicorn":
+        return ["uvicorn", "flight_agent:asgi_app", "--host", "127.0.0.1", "--port", str(port),
+                "--workers", str(args.workers), "--log-level", "warning"]
+    return ["gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(args.workers),
+            "--threads", str(args.threads), "--timeout", "120", "--log-level", "warning", "flight_agent:app"]
+
+
+def start_server(args, standin_url):
+    port = free_port()
+    env = dict(
+        os.environ,
+        SERPAPI_URL=standin_url + "/search",
+        ANTHROPIC_BASE_URL=standin_url,
+        ANTHROPIC_API_KEY=os.environ.get("ANTHROPIC_API_KEY", "standin"),
+        SERPAPI_KEY=os.environ.get("SERPAPI_KEY", "standin"),
+        ITINERARY_CACHE_DIR=os.path.join("/tmp", f"loadtest_itineraries_{port}"),
+        PYTHONUNBUFFERED="1",
+    )
+    process = subprocess.Popen(server_command(args, port), cwd=REPO, env=env,
+                               stdout=subprocess.DEVNULL, stderr=None if args.server_logs else subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"server exited with status {process.returncode}")
+        try:
+            if httpx.get(url + "/cache/stats", timeout=1).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    sys.exit("server did not come up within 30s")
+
+
+def process_tree(pid):
+    """pid and all of its descendants (gunicorn/uvicorn workers)"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def rss_bytes(pid):
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class RssSampler(threading.Thread):
+    """Track the peak RSS of a process tree in the background"""
+
+    def __init__(self, pid, interval=0.25):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, rss_bytes(self.pid))
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def trip_bodies(count, itinerary_only_share, seed):
+    """``count`` distinct request bodies, mixing both service types"""
+    rng = random.Random(seed)
+    bodies = []
+    for _ in range(count):
+        destination = rng.choice(DESTINATIONS)
+        outbound = datetime.now() + timedelta(days=rng.randint(20, 120))
+        nights = rng.randint(2, 10)
+        if rng.random() < itinerary_only_share:
+            bodies.append(("itinerary_only", {
+                "service_type": "itinerary_only", "destination": destination,
+                "start_date": outbound.strftime("%Y-%m-%d"), "duration_days": nights,
+                "daily_budget": rng.choice([60, 120, 250]), "keywords": rng.sample(["food", "museums", "nightlife", "hiking", "shopping"], 2)
+            }))
+        else:
+            bodies.append(("full", {
+                "origin": "LHR", "destination": destination,
+                "outbound_date": outbound.strftime("%Y-%m-%d"),
+                "return_date": (outbound + timedelta(days=nights)).strftime("%Y-%m-%d"),
+                "budget": rng.choice([600, 1200, 2500]), "accommodation_type": rng.choice(["hotel", "airbnb", "mixed"]),
+                "keywords": rng.sample(["food", "museums", "nightlife", "hiking", "shopping"], 2)
+            }))
+    return bodies
+
+
+async def generate_load(url, bodies, rate, duration, timeout, seed):
+    rng = random.Random(seed)
+    results = []
+    tasks = []
+
+    async def one(client, kind, body):
+        start = time.perf_counter()
+        try:
+            response = await client.post(url + "/itinerary", json=body)
+            outcome = "ok" if response.status_code == 200 else f"http_{response.status_code}"
+        except httpx.TimeoutException:
+            outcome = "timeout"
+        except httpx.HTTPError as e:
+            outcome = type(e).__name__
+        results.append((kind, outcome, time.perf_counter() - start))
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        next_arrival = 0.0
+        while next_arrival < duration:
+            delay = started + next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind, body = rng.choice(bodies)
+            tasks.append(asyncio.create_task(one(client, kind, body)))
+            next_arrival += rng.expovariate(rate)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else None
+
+
+def summarize(results, elapsed):
+    def stats(subset):
+        ok = sorted(latency for _, outcome, latency in subset if outcome == "ok")
+        count = len(subset)
+        return {
+            "requests": count,
+            "ok": len(ok),
+            "throughput_rps": round(len(ok) / elapsed, 2),
+            "error_rate": round(sum(1 for _, o, _ in subset if o not in ("ok", "timeout")) / count, 4) if count else 0,
+            "timeout_rate": round(sum(1 for _, o, _ in subset if o == "timeout") / count, 4) if count else 0,
+            **{f"{name}_s": round(percentile(ok, q), 3) if ok else None
+               for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+            "max_s": round(ok[-1], 3) if ok else None,
+        }
+
+    outcomes = {}
+    for _, outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    summary = {"all": stats(results)}
+    for kind in ("full", "itinerary_only"):
+        summary[kind] = stats([r for r in results if r[0] == kind])
+    summary["outcomes"] = outcomes
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=["gunicorn", "uvicorn"], default="gunicorn", help="serving mode to launch")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=1, help="gunicorn threads per worker")
+    parser.add_argument("--url", help="load an already running server instead of launching one")
+    parser.add_argument("--pid", type=int, help="with --url: server pid to sample RSS from")
+    parser.add_argument("--rate", type=float, default=2.0, help="average arrivals per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to keep sending")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-request client timeout (s)")
+    parser.add_argument("--itinerary-only-share", type=float, default=0.5)
+    parser.add_argument("--distinct", type=int, default=200, help="distinct bodies to draw from (fewer = more cache hits)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--server-logs", action="store_true", help="show the server's stderr")
+    parser.add_argument("--json", help="also write the results to this file")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    standins = StandIns.from_args(args)
+    standin_url = standins.start()
+
+    process = None
+    if args.url:
+        url, pid = args.url.rstrip("/"), args.pid
+    else:
+        process, url = start_server(args, standin_url)
+        pid = process.pid
+
+    sampler = RssSampler(pid) if pid else None
+    if sampler:
+        sampler.start()
+    try:
+        bodies = trip_bodies(args.distinct, args.itinerary_only_share, args.seed)
+        results, elapsed = asyncio.run(generate_load(url, bodies, args.rate, args.duration, args.timeout, args.seed))
+    finally:
+        if sampler:
+            sampler.stop()
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+        standins.stop()
+
+    summary = summarize(results, elapsed)
+    summary["peak_rss_mb"] = round(sampler.peak / 2**20, 1) if sampler else None
+    summary["standins"] = standins.counts()
+    label = f"{args.mode} workers={args.workers}" + (f" threads={args.threads}" if args.mode == "gunicorn" else "")
+    summary["setup"] = {"target": args.url or label, "rate": args.rate, "duration": args.duration}
+
+    print(f"{summary['setup']['target']}  rate={args.rate}/s  duration={args.duration}s  elapsed={elapsed:.1f}s")
+    print(f"{'':16}{'requests':>9}{'ok/s':>8}{'errors':>8}{'timeouts':>9}{'p50':>8}{'p95':>8}{'p99':>8}  (s)")
+    for kind in ("all", "full", "itinerary_only"):
+        s = summary[kind]
+        fmt = lambda v: f"{v:>8.2f}" if v is not None else f"{'-':>8}"  # noqa: E731
+        print(f"{kind:16}{s['requests']:>9}{s['throughput_rps']:>8.2f}{s['error_rate']:>8.1%}{s['timeout_rate']:>9.1%}"
+              f"{fmt(s['p50_s'])}{fmt(s['p95_s'])}{fmt(s['p99_s'])}")
+    print(f"outcomes: {summary['outcomes']}")
+    if summary["peak_rss_mb"] is not None:
+        print(f"peak server RSS: {summary['peak_rss_mb']} MB")
+    print(f"stand-in requests: {summary['standins']['requests']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
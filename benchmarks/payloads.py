@@ -0,0 +1,110 @@
+"""
+Synthetic google_flights responses for the offline benchmarks.
+
+Shapes follow what SerpApi returns for round trips: best_flights/other_flights
+entries with a "flights" list of segments (outbound legs, then return legs),
+optional layovers, prices and carbon data.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+AIRLINES = ["British Airways", "easyJet", "Ryanair", "Air France", "KLM", "Lufthansa", "Vueling", "Iberia"]
+HUBS = ["AMS", "CDG", "FRA", "MAD", "MUC", "ZRH", "DUB", "BRU"]
+
+
+def _segment(rng, dep, arr, day, airline):
+    dep_time = datetime.strptime(day, "%Y-%m-%d") + timedelta(hours=rng.randint(5, 21), minutes=rng.choice([0, 15, 30, 45]))
+    duration = rng.randint(55, 240)
+    return {
+        "departure_airport": {"name": f"{dep} Airport", "id": dep, "time": dep_time.strftime("%Y-%m-%d %H:%M")},
+        "arrival_airport": {"name": f"{arr} Airport", "id": arr, "time": (dep_time + timedelta(minutes=duration)).strftime("%Y-%m-%d %H:%M")},
+        "duration": duration,
+        "airplane": rng.choice(["Airbus A320", "Boeing 737", "Airbus A321neo"]),
+        "airline": airline,
+        "airline_logo": f"https://www.gstatic.com/flights/airline_logos/70px/{airline[:2].upper()}.png",
+        "travel_class": "Economy",
+        "flight_number": f"{airline[:2].upper()} {rng.randint(100, 9999)}",
+        "overnight": rng.random() < 0.1,
+    }
+
+
+def _journey(rng, origin, destination, day, airline):
+    stops = rng.choices([0, 1, 2], weights=[5, 4, 1])[0]
+    path = [origin] + rng.sample(HUBS, stops) + [destination]
+    return [_segment(rng, path[i], path[i + 1], day, airline) for i in range(len(path) - 1)]
+
+
+def flight_option(rng, origin, destination, outbound_date, return_date):
+    airline = rng.choice(AIRLINES)
+    segments = _journey(rng, origin, destination, outbound_date, airline)
+    if return_date:
+        segments += _journey(rng, destination, origin, return_date, airline)
+    return {
+        "flights": segments,
+        "layovers": [{"id": seg["arrival_airport"]["id"], "duration": rng.randint(40, 300)} for seg in segments[:-1]],
+        "total_duration": sum(seg["duration"] for seg in segments),
+        "carbon_emissions": {"this_flight": rng.randint(60000, 400000)},
+        "price": rng.randint(40, 900),
+        "type": "Round trip" if return_date else "One way",
+    }
+
+
+def flight_payload(origin, destination, outbound_date, return_date=None, seed=0, best=5, other=12):
+    """A google_flights response with ``best`` best_flights and ``other`` other_flights"""
+    rng = random.Random(f"{origin}{destination}{outbound_date}{return_date}{seed}")
+    return {
+        "best_flights": [flight_option(rng, origin, destination, outbound_date, return_date) for _ in range(best)],
+        "other_flights": [flight_option(rng, origin, destination, outbound_date, return_date) for _ in range(other)],
+    }
+
+
+def payload_corpus(count=200, origin="LHR", destination="BCN", seed=0):
+    """``count`` varied payloads as (payload, origin, destination, outbound, return) tuples"""
+    rng = random.Random(seed)
+    start = datetime(2026, 6, 1)
+    corpus = []
+    for i in range(count):
+        outbound = (start + timedelta(days=rng.randint(0, 120))).strftime("%Y-%m-%d")
+        return_date = None
+        if rng.random() < 0.8:
+            return_date = (datetime.strptime(outbound, "%Y-%m-%d") + timedelta(days=rng.randint(2, 14))).strftime("%Y-%m-%d")
+        corpus.append((flight_payload(origin, destination, outbound, return_date, seed=i), origin, destination, outbound, return_date))
+    return corpus
+
+
+def hotel_payload(city, check_in, check_out, seed=0, count=20):
+    """A google_hotels response with ``count`` properties"""
+    rng = random.Random(f"{city}{check_in}{check_out}{seed}")
+    nights = max(1, (datetime.strptime(check_out, "%Y-%m-%d") - datetime.strptime(check_in, "%Y-%m-%d")).days) if check_in and check_out else 3
+    properties = []
+    for i in range(count):
+        rate = rng.randint(45, 400)
+        properties.append({
+            "type": "hotel",
+            "name": f"{city} {rng.choice(['Grand', 'Central', 'Harbour', 'Old Town', 'Garden', 'Royal'])} Hotel {i + 1}",
+            "description": f"Stylish rooms a short walk from the sights of {city}. " * 3,
+            "link": f"https://example.com/hotels/{i}",
+            "rate_per_night": {"lowest": f"£{rate}", "extracted_lowest": rate},
+            "total_rate": {"lowest": f"£{rate * nights}", "extracted_lowest": rate * nights},
+            "overall_rating": round(rng.uniform(3.2, 4.9), 1),
+            "reviews": rng.randint(20, 5000),
+            "images": [{"thumbnail": f"https://example.com/img/{i}-{n}.jpg"} for n in range(6)],
+            "amenities": rng.sample(["Free Wi-Fi", "Breakfast", "Pool", "Gym", "Spa", "Bar", "Parking", "Air conditioning"], 6),
+        })
+    return {"properties": properties}
+
+
+def search_payload(query, seed=0, count=10):
+    """A google web search response, as used for the Airbnb lookup"""
+    rng = random.Random(f"{query}{seed}")
+    results = []
+    for i in range(count):
+        host = "www.airbnb.co.uk" if rng.random() < 0.7 else "www.example.com"
+        results.append({
+            "position": i + 1,
+            "title": f"{query.title()} - listing {i + 1}",
+            "link": f"https://{host}/rooms/{rng.randint(10**6, 10**8)}",
+            "snippet": "Entire rental unit, 2 guests, 1 bedroom, wifi, kitchen.",
+        })
+    return {"organic_results": results}
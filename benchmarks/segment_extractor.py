@@ -0,0 +1,255 @@
+"""
+Single-pass flight extractor vs the multi-pass one it replaced.
+
+    python benchmarks/segment_extractor.py [payloads]
+
+First checks that TravelPlanningAgent._extract_flight_details gives exactly
+the same output as the old extractor (kept below, verbatim) over a corpus of
+google_flights payloads: the synthetic ones from payloads.py plus edge-case
+segment orders, plus any recorded responses saved as JSON files in the
+directory named by RECORDED_PAYLOADS_DIR. Then reports flights/second for both,
+producing the same dict output, and for the new one returning its FlightRecord.
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flight_agent import agent  # noqa: E402
+from payloads import flight_option, payload_corpus  # noqa: E402
+import random  # noqa: E402
+
+
+def legacy_extract_flight_details(flight, origin, destination, search_date, search_return):
+    """_extract_flight_details as it was before the single-pass rewrite (multi-pass, returns a dict)"""
+    flights_info = flight.get("flights", [])
+
+    if not flights_info:
+        return None
+
+    # For round trips, Google Flights API returns legs in the flights array
+    # Outbound segments go from origin to destination
+    # Return segments go from destination to origin
+
+    outbound_segments = []
+    return_segments = []
+
+    for segment in flights_info:
+        dep_airport = segment.get("departure_airport", {}).get("id", "")
+        arr_airport = segment.get("arrival_airport", {}).get("id", "")
+
+        # Determine if this segment is outbound or return based on airports
+        # Outbound: starts from origin or previous outbound arrival
+        # Return: starts from destination or goes back toward origin
+        if dep_airport == origin or (outbound_segments and not return_segments):
+            # Check if we've reached destination (end of outbound)
+            if arr_airport == destination:
+                outbound_segments.append(segment)
+            elif not return_segments:
+                outbound_segments.append(segment)
+            else:
+                return_segments.append(segment)
+        elif dep_airport == destination or return_segments:
+            return_segments.append(segment)
+        else:
+            # Default to outbound if unclear
+            if not outbound_segments or (outbound_segments and outbound_segments[-1].get("arrival_airport", {}).get("id") != destination):
+                outbound_segments.append(segment)
+            else:
+                return_segments.append(segment)
+
+    # Get first outbound segment for departure info
+    outbound_first = outbound_segments[0] if outbound_segments else {}
+    # Get last outbound segment for arrival info
+    outbound_last = outbound_segments[-1] if outbound_segments else {}
+
+    # Get first return segment for departure info
+    return_first = return_segments[0] if return_segments else {}
+    # Get last return segment for arrival info
+    return_last = return_segments[-1] if return_segments else {}
+
+    # Calculate total outbound duration
+    outbound_duration = sum(seg.get("duration", 0) for seg in outbound_segments)
+    return_duration = sum(seg.get("duration", 0) for seg in return_segments)
+
+    # Get layover information
+    outbound_layovers = []
+    for i, seg in enumerate(outbound_segments[:-1]) if len(outbound_segments) > 1 else []:
+        layover_airport = seg.get("arrival_airport", {}).get("id", "")
+        if layover_airport:
+            outbound_layovers.append(layover_airport)
+
+    return_layovers = []
+    for i, seg in enumerate(return_segments[:-1]) if len(return_segments) > 1 else []:
+        layover_airport = seg.get("arrival_airport", {}).get("id", "")
+        if layover_airport:
+            return_layovers.append(layover_airport)
+
+    # Determine airline (use most prominent or first)
+    airlines = [seg.get("airline", "") for seg in outbound_segments if seg.get("airline")]
+    primary_airline = airlines[0] if airlines else "Multiple Airlines"
+    airline_logo = outbound_first.get("airline_logo", "")
+
+    flight_details = {
+        "outbound_date": search_date,
+        "return_date": search_return,
+        "price": flight.get("price"),
+        "total_duration": flight.get("total_duration"),
+
+        # Outbound flight details
+        "airline": primary_airline,
+        "airline_logo": airline_logo,
+        "outbound_departure_time": outbound_first.get("departure_airport", {}).get("time", ""),
+        "outbound_arrival_time": outbound_last.get("arrival_airport", {}).get("time", ""),
+        "outbound_departure_airport": outbound_first.get("departure_airport", {}).get("id", origin),
+        "outbound_arrival_airport": outbound_last.get("arrival_airport", {}).get("id", destination),
+        "outbound_duration": outbound_duration if outbound_duration else outbound_first.get("duration"),
+        "outbound_stops": len(outbound_segments) - 1 if len(outbound_segments) > 1 else 0,
+        "outbound_layovers": outbound_layovers,
+
+        # Return/Inbound flight details
+        "return_departure_time": return_first.get("departure_airport", {}).get("time", ""),
+        "return_arrival_time": return_last.get("arrival_airport", {}).get("time", ""),
+        "return_departure_airport": return_first.get("departure_airport", {}).get("id", destination) if return_first else "",
+        "return_arrival_airport": return_last.get("arrival_airport", {}).get("id", origin) if return_last else "",
+        "return_duration": return_duration if return_duration else (return_first.get("duration") if return_first else ""),
+        "return_stops": len(return_segments) - 1 if len(return_segments) > 1 else 0,
+        "return_layovers": return_layovers,
+        "return_airline": return_first.get("airline", primary_airline) if return_first else "",
+
+        # Booking and metadata
+        "booking_link": f"https://www.google.com/travel/flights?q=Flights+from+{origin}+to+{destination}+on+{search_date}",
+        "layovers": outbound_layovers + return_layovers,
+        "flight_number": outbound_first.get("flight_number", ""),
+        "airplane": outbound_first.get("airplane", ""),
+        "carbon_emissions": flight.get("carbon_emissions", {}).get("this_flight"),
+        "is_overnight": outbound_first.get("overnight", False),
+        "is_round_trip": bool(search_return and return_segments)
+    }
+
+    return flight_details if flight_details.get("price") else None
+
+
+def _segment(dep, arr, duration=90, airline="KLM", **extra):
+    return dict({
+        "departure_airport": {"id": dep, "time": "2026-06-01 08:00"},
+        "arrival_airport": {"id": arr, "time": "2026-06-01 09:30"},
+        "duration": duration,
+        "airline": airline,
+    }, **extra)
+
+
+def edge_case_payloads():
+    """Segment orders that exercise every branch of the classification"""
+    orders = [
+        [("LHR", "BCN")],
+        [("LHR", "AMS"), ("AMS", "BCN"), ("BCN", "AMS"), ("AMS", "LHR")],
+        [("BCN", "LHR")],                                   # return leg first
+        [("BCN", "AMS"), ("AMS", "LHR"), ("LHR", "BCN")],   # return, then origin -> destination
+        [("BCN", "AMS"), ("LHR", "MAD"), ("MAD", "BCN")],   # return, then origin elsewhere
+        [("BCN", "AMS"), ("CDG", "LHR")],                   # return, then unknown airport
+        [("CDG", "AMS"), ("AMS", "BCN")],                   # starts at neither airport
+        [("LHR", ""), ("", "BCN")],                         # missing airport ids
+    ]
+    payloads = []
+    for order in orders:
+        segments = [_segment(dep, arr, airline="" if i == 0 and len(order) > 1 else "KLM") for i, (dep, arr) in enumerate(order)]
+        payloads.append(({"best_flights": [{"flights": segments, "price": 120, "total_duration": 300}]}, "LHR", "BCN", "2026-06-01", "2026-06-05"))
+    payloads.append(({"best_flights": [{"flights": [{}], "price": 99}]}, "LHR", "BCN", "2026-06-01", None))
+    payloads.append(({"best_flights": [{"flights": [_segment("LHR", "BCN")], "price": 0}]}, "LHR", "BCN", "2026-06-01", None))
+    payloads.append(({"best_flights": [{"flights": [], "price": 50}]}, "LHR", "BCN", "2026-06-01", None))
+    return payloads
+
+
+def shuffled_payloads(count=200, seed=1):
+    """Synthetic options with segment order scrambled, so returns come first"""
+    rng = random.Random(seed)
+    payloads = []
+    for i in range(count):
+        option = flight_option(rng, "LHR", "BCN", "2026-07-01", "2026-07-08")
+        rng.shuffle(option["flights"])
+        payloads.append(({"other_flights": [option]}, "LHR", "BCN", "2026-07-01", "2026-07-08"))
+    return payloads
+
+
+def recorded_payloads():
+    """Saved google_flights responses: {"engine", "origin", "destination", "outbound_date", "return_date", "response"}"""
+    directory = os.environ.get("RECORDED_PAYLOADS_DIR")
+    if not directory:
+        return []
+    payloads = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                recorded = json.load(f)
+            if recorded.get("engine", "google_flights") != "google_flights":
+                continue
+            payloads.append((recorded["response"], recorded["origin"], recorded["destination"],
+                             recorded["outbound_date"], recorded.get("return_date")))
+    return payloads
+
+
+def options(corpus):
+    """(flight option, origin, destination, outbound, return) for every option in the corpus"""
+    return [
+        (option, origin, destination, outbound, return_date)
+        for payload, origin, destination, outbound, return_date in corpus
+        for section in ("best_flights", "other_flights")
+        for option in payload.get(section, [])
+    ]
+
+
+def check_identical(corpus):
+    mismatches = 0
+    for option, *args in options(corpus):
+        old = legacy_extract_flight_details(option, *args)
+        new = agent._extract_flight_details(option, *args)
+        if old != (new.to_dict() if new else None):
+            mismatches += 1
+    return mismatches
+
+
+def extract_as_dict(option, *args):
+    """The single-pass extractor's output as the dict the old one returned"""
+    record = agent._extract_flight_details(option, *args)
+    return record.to_dict() if record else None
+
+
+def flights_per_second(extractors, items, rounds=15):
+    """Best-of-``rounds`` throughput for each extractor, run interleaved so
+    machine noise hits them alike"""
+    best = [float("inf")] * len(extractors)
+    for _ in range(rounds):
+        for i, extract in enumerate(extractors):
+            start = time.perf_counter()
+            for option, *args in items:
+                extract(option, *args)
+            best[i] = min(best[i], time.perf_counter() - start)
+    return [len(items) / elapsed for elapsed in best]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    corpus = payload_corpus(count) + shuffled_payloads() + edge_case_payloads() + recorded_payloads()
+    items = options(corpus)
+
+    mismatches = check_identical(corpus)
+    print(f"{len(items)} flight options, {mismatches} mismatches")
+    if mismatches:
+        sys.exit(1)
+
+    # The old extractor returned a dict and the new one a FlightRecord; time
+    # the new one with to_dict() so both produce the same thing
+    old, new, new_record = flights_per_second(
+        [legacy_extract_flight_details, extract_as_dict, agent._extract_flight_details], items
+    )
+    print(f"multi-pass (dict)           {old:10,.0f} flights/s")
+    print(f"single-pass (dict)          {new:10,.0f} flights/s   ({new / old:.2f}x)")
+    print(f"single-pass (FlightRecord)  {new_record:10,.0f} flights/s   ({new_record / old:.2f}x, not like for like)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Local stand-ins for SerpApi and the Anthropic Messages API.
+
+One HTTP server answers both, so benchmarks and load tests run offline:
+
+- GET  /search?engine=google_flights|google_hotels|google  - SerpApi
+- POST /v1/messages (stream=true)                         - Claude, as SSE
+
+Point the service at it with SERPAPI_URL=<url>/search and
+ANTHROPIC_BASE_URL=<url>. SerpApi answers come from recorded responses in
+``recorded_dir`` when there are any for the engine (JSON files shaped
+{"engine", "response", ...}), otherwise from the synthetic generators in
+payloads.py. Claude replies are canned itineraries shaped like the real ones.
+Every answer waits ``latency`` +/- ``jitter`` seconds; Claude replies then
+stream at ``claude_chars_per_second``.
+"""
+
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from payloads import flight_payload, hotel_payload, search_payload
+
+# The canned itineraries reuse the service's own fallback content
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+
+
+def load_recorded(directory):
+    """engine -> list of recorded responses"""
+    recorded = {}
+    if not directory:
+        return recorded
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                entry = json.load(f)
+            recorded.setdefault(entry.get("engine", "google_flights"), []).append(entry["response"])
+    return recorded
+
+
+def canned_itinerary(prompt):
+    """An itinerary reply in the shape the prompt asks for (full trip or one day group)"""
+    # Imported lazily: the service module reads SERPAPI_URL/ANTHROPIC_BASE_URL
+    # at import time, so it must not be imported before the stand-ins are up
+    from flight_agent import agent
+
+    days = re.search(r"(?:a|of a) (\d+)-day (?:travel itinerary for|trip to) (.+?)\.\n", prompt)
+    duration, city = (int(days.group(1)), days.group(2)) if days else (5, "the city")
+    itinerary = agent._get_fallback_itinerary(city, duration)
+
+    group = re.search(r"Plan days (\d+) to (\d+)", prompt)
+    if group:
+        first, last = int(group.group(1)), int(group.group(2))
+        return {"daily_itinerary": itinerary["daily_itinerary"][first - 1:last]}
+    if "daily_itinerary as an empty array" in prompt:
+        itinerary["daily_itinerary"] = []
+    return itinerary
+
+
+def add_arguments(parser):
+    """Command-line options for the stand-ins, shared by the benchmark scripts"""
+    group = parser.add_argument_group("stand-ins")
+    group.add_argument("--latency", type=float, default=0.05, help="SerpApi stand-in latency (s)")
+    group.add_argument("--jitter", type=float, default=0.02, help="+/- jitter on every stand-in reply (s)")
+    group.add_argument("--claude-latency", type=float, default=0.4, help="Claude stand-in time to first token (s)")
+    group.add_argument("--claude-cps", type=float, default=8000, help="Claude stand-in stream rate (chars/s)")
+    group.add_argument("--error-rate", type=float, default=0.0, help="share of stand-in replies that fail")
+    group.add_argument("--recorded", help="directory of recorded SerpApi responses to serve")
+
+
+class StandIns:
+    """Threaded SerpApi + Anthropic stand-in server"""
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            latency=args.latency, jitter=args.jitter, claude_latency=args.claude_latency,
+            claude_chars_per_second=args.claude_cps, error_rate=args.error_rate, recorded_dir=args.recorded
+        )
+
+    def __init__(self, latency=0.05, jitter=0.02, claude_latency=0.4, claude_chars_per_second=8000,
+                 error_rate=0.0, recorded_dir=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.claude_latency = claude_latency
+        self.claude_chars_per_second = claude_chars_per_second
+        self.error_rate = error_rate
+        self.recorded = load_recorded(recorded_dir)
+        self._recorded_turn = {engine: itertools.cycle(responses) for engine, responses in self.recorded.items()}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.errors = Counter()
+        self._server = None
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serve in a background thread and return the base URL"""
+        standins = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                standins._serpapi(self)
+
+            def do_POST(self):
+                standins._messages(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self._server.server_port}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def counts(self):
+        with self._lock:
+            return {"requests": dict(self.requests), "errors": dict(self.errors)}
+
+    def _delay(self, base):
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0
+            failed = self._random.random() < self.error_rate
+        time.sleep(max(0.0, base + jitter))
+        return failed
+
+    def _count(self, name, failed):
+        with self._lock:
+            self.requests[name] += 1
+            if failed:
+                self.errors[name] += 1
+
+    def _send_json(self, handler, body, status=200):
+        data = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _serpapi(self, handler):
+        url = urlparse(handler.path)
+        if url.path != "/search":
+            return self._send_json(handler, {"error": "not found"}, 404)
+        q = {k: v[0] for k, v in parse_qs(url.query).items()}
+        engine = q.get("engine", "")
+
+        failed = self._delay(self.latency)
+        self._count(engine, failed)
+        if failed:
+            return self._send_json(handler, {"error": "stand-in failure"}, 503)
+
+        if engine in self._recorded_turn:
+            with self._lock:
+                body = next(self._recorded_turn[engine])
+        elif engine == "google_flights":
+            body = flight_payload(q.get("departure_id", ""), q.get("arrival_id", ""), q.get("outbound_date", ""), q.get("return_date"))
+        elif engine == "google_hotels":
+            body = hotel_payload(q.get("q", ""), q.get("check_in_date"), q.get("check_out_date"))
+        elif engine == "google":
+            body = search_payload(q.get("q", ""))
+        else:
+            return self._send_json(handler, {"error": f"unknown engine {engine}"}, 400)
+        self._send_json(handler, body)
+
+    def _messages(self, handler):
+        if not urlparse(handler.path).path.startswith("/v1/messages"):
+            return self._send_json(handler, {"error": "not found"}, 404)
+        request = json.loads(handler.rfile.read(int(handler.headers.get("Content-Length", 0))) or b"{}")
+        prompt = "".join(
+            block.get("text", "") if isinstance(block, dict) else block
+            for message in request.get("messages", [])
+            for block in (message["content"] if isinstance(message["content"], list) else [message["content"]])
+        )
+
+        failed = self._delay(self.claude_latency)
+        self._count("messages", failed)
+        if failed:
+            return self._send_json(handler, {"type": "error", "error": {"type": "overloaded_error", "message": "stand-in failure"}}, 529)
+
+        reply = json.dumps(canned_itinerary(prompt))
+        if not request.get("stream"):
+            return self._send_json(handler, self._message(request, reply, len(prompt)))
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Cache-Control", "no-cache")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+
+        def event(name, data):
+            handler.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode())
+            handler.wfile.flush()
+
+        message = self._message(request, "", len(prompt))
+        event("message_start", {"type": "message_start", "message": message})
+        event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        chunk = 64
+        for i in range(0, len(reply), chunk):
+            event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": reply[i:i + chunk]}})
+            if self.claude_chars_per_second:
+                time.sleep(chunk / self.claude_chars_per_second)
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": {"output_tokens": len(reply) // 4}})
+        event("message_stop", {"type": "message_stop"})
+
+    def _message(self, request, text, prompt_chars):
+        return {
+            "id": "msg_standin",
+            "type": "message",
+            "role": "assistant",
+            "model": request.get("model", "standin"),
+            "content": [{"type": "text", "text": text}] if text else [],
+            "stop_reason": "end_turn" if text else None,
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": prompt_chars // 4,
+                "output_tokens": len(text) // 4 or 1,
+                "cache_creation_input_tokens": 0,
+                "cache_read_input_tokens": 2000,
+            },
+        }
@@ -0,0 +1,148 @@
+"""
+Offline latency benchmarks for the trip-planning pipeline.
+
+    python benchmarks/suite.py [--iterations 5] [--json results.json] [stand-in options]
+
+Starts the SerpApi/Anthropic stand-ins (standins.py), points the service at
+them and times each stage on its own - flexible-date search, flight ranking,
+hotel and Airbnb search, itinerary generation (short and chunked), response
+building - plus the /itinerary route end to end, cold and with warm caches.
+Caches are reset before every cold run so each iteration does the full work.
+No API keys or network access are needed.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from standins import StandIns, add_arguments  # noqa: E402
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        "n": n,
+        "mean_ms": round(sum(samples) / n * 1000, 1),
+        "p50_ms": round(samples[n // 2] * 1000, 1),
+        "p95_ms": round(samples[min(n - 1, int(n * 0.95))] * 1000, 1),
+        "max_ms": round(samples[-1] * 1000, 1),
+    }
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def trip_dates(days_out=45, nights=5):
+    outbound = datetime.now() + timedelta(days=days_out)
+    return outbound.strftime("%Y-%m-%d"), (outbound + timedelta(days=nights)).strftime("%Y-%m-%d")
+
+
+def run(args):
+    standins = StandIns.from_args(args)
+    base_url = standins.start()
+    os.environ["SERPAPI_URL"] = base_url + "/search"
+    os.environ["ANTHROPIC_BASE_URL"] = base_url
+    os.environ.setdefault("ANTHROPIC_API_KEY", "standin")
+    os.environ.setdefault("SERPAPI_KEY", "standin")
+    os.environ["ITINERARY_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench_itineraries_")
+    # Keep the service's progress logging out of the report
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    import flight_agent as fa  # after the environment points at the stand-ins
+
+    agent = fa.agent
+    client = fa.app.test_client()
+
+    def reset_caches():
+        agent.flight_cache = fa.SearchCache(max_entries=fa.FLIGHT_CACHE_SIZE)
+        agent.hotel_cache = fa.SearchCache(max_entries=fa.HOTEL_CACHE_SIZE)
+        agent.itinerary_cache = fa.ItineraryDiskCache(tempfile.mkdtemp(prefix="bench_itineraries_"))
+
+    outbound, return_date = trip_dates()
+    origin, destination, budget = "LHR", "BCN", 1200
+    full_body = {
+        "origin": origin, "destination": destination, "outbound_date": outbound, "return_date": return_date,
+        "budget": budget, "accommodation_type": "mixed", "keywords": ["food", "architecture"], "trip_type": "leisure"
+    }
+    itinerary_only_body = {
+        "service_type": "itinerary_only", "destination": destination, "start_date": outbound,
+        "duration_days": 5, "daily_budget": 120, "keywords": ["museums"]
+    }
+    days_info = fa.days_of_trip(datetime.strptime(outbound, "%Y-%m-%d"), 5)
+    long_days_info = fa.days_of_trip(datetime.strptime(outbound, "%Y-%m-%d"), 10)
+
+    samples = {}
+
+    def record(stage, seconds):
+        samples.setdefault(stage, []).append(seconds)
+
+    for _ in range(args.iterations):
+        reset_caches()
+        flights, seconds = timed(lambda: agent.analyze_flexible_dates(origin, destination, outbound, return_date, budget=budget))
+        record("analyze_flexible_dates", seconds)
+        best, seconds = timed(lambda: agent.find_best_value_flights(flights))
+        record("find_best_value_flights", seconds)
+        hotels, seconds = timed(lambda: agent.search_hotels(destination, outbound, return_date))
+        record("search_hotels", seconds)
+        airbnb, seconds = timed(lambda: agent.search_airbnb(destination, outbound, return_date))
+        record("search_airbnb", seconds)
+        itinerary, seconds = timed(lambda: agent.create_structured_itinerary(
+            destination, ["food"], budget, 5, hotels, days_info=days_info))
+        record("create_structured_itinerary (5 days)", seconds)
+        _, seconds = timed(lambda: agent.create_structured_itinerary(
+            destination, ["food"], budget, 10, hotels, days_info=long_days_info))
+        record("create_structured_itinerary (10 days, chunked)", seconds)
+
+        trip, _ = fa.prepare_trip(full_body)
+        _, seconds = timed(lambda: json.dumps(fa.full_service_payload(trip, best, hotels, airbnb, itinerary)))
+        record("build full-service response", seconds)
+
+        reset_caches()
+        response, seconds = timed(lambda: client.post("/itinerary", json=full_body))
+        assert response.status_code == 200, response.status_code
+        record("POST /itinerary full (cold)", seconds)
+        response, seconds = timed(lambda: client.post("/itinerary", json=full_body))
+        record("POST /itinerary full (warm caches)", seconds)
+
+        reset_caches()
+        response, seconds = timed(lambda: client.post("/itinerary", json=itinerary_only_body))
+        assert response.status_code == 200, response.status_code
+        record("POST /itinerary itinerary_only (cold)", seconds)
+
+    standins.stop()
+    return {stage: summarize(values) for stage, values in samples.items()}, standins.counts()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=5)
+    add_arguments(parser)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results, counts = run(args)
+
+    width = max(len(stage) for stage in results)
+    print(f"{'stage':<{width}}  {'n':>3}  {'mean':>8}  {'p50':>8}  {'p95':>8}  {'max':>8}  (ms)")
+    for stage, stats in results.items():
+        print(f"{stage:<{width}}  {stats['n']:>3}  {stats['mean_ms']:>8.1f}  {stats['p50_ms']:>8.1f}  {stats['p95_ms']:>8.1f}  {stats['max_ms']:>8.1f}")
+    print(f"stand-in requests: {counts['requests']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"stages": results, "standins": counts, "settings": vars(args)}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,227 @@
 AI Flight Search Agent - GUARANTEED Itinerary Generation
 """
 
+import asyncio
+import atexit
+import bisect
+import contextvars
+import csv
+import functools
+import hashlib
+import heapq
+import logging
+import math
 import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import uuid
 from datetime import datetime, timedelta
+from urllib.parse import parse_qs
 import json
-from anthropic import Anthropic
+from anthropic import Anthropic, APIConnectionError, APIStatusError, AsyncAnthropic
+import httpx
 import requests
-from flask import Flask, request, jsonify, send_from_directory
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, g, request, jsonify, send_from_directory
 
 app = Flask(__name__, static_folder='.')
 client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+async_client = AsyncAnthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+
+# Max number of flexible-date flight searches sent to SerpApi at the same time
+FLIGHT_SEARCH_CONCURRENCY = int(os.environ.get("FLIGHT_SEARCH_CONCURRENCY", 6))
+
+# Flexible-date search - how many days after the requested date may be tried
+# (3 days before are always considered), the most dates one request may search,
+# how many dates are searched per round, and when to stop early: once the
+# FLEX_TOP_K cheapest fares are all under FLEX_BUDGET_SHARE of the trip budget,
+# or when a round cuts the top-k total by less than FLEX_MIN_GAIN
+FLEX_DAYS_RANGE = int(os.environ.get("FLEX_DAYS_RANGE", 7))
+FLEX_MAX_CALLS = int(os.environ.get("FLEX_MAX_CALLS", 6))
+FLEX_ROUND_SIZE = int(os.environ.get("FLEX_ROUND_SIZE", 3))
+FLEX_TOP_K = int(os.environ.get("FLEX_TOP_K", 5))
+FLEX_BUDGET_SHARE = float(os.environ.get("FLEX_BUDGET_SHARE", 0.5))
+FLEX_MIN_GAIN = float(os.environ.get("FLEX_MIN_GAIN", 0.02))
+
+# Metro-area routes (LON, PAR, NYC...) search every airport pair, so they get
+# a larger shared call budget than FLEX_MAX_CALLS and METRO_ROUND_SIZE searches
+# per round instead of FLEX_ROUND_SIZE
+METRO_MAX_CALLS = int(os.environ.get("METRO_MAX_CALLS", 12))
+METRO_ROUND_SIZE = int(os.environ.get("METRO_ROUND_SIZE", 6))
+
+# /compare - destinations tried when the request lists none, the most one
+# request may list, flight searches per destination (airport pairs of a metro
+# area, main airports first) and how many searches run at once
+COMPARE_DESTINATIONS = tuple(os.environ.get(
+    "COMPARE_DESTINATIONS", "BCN,LIS,PAR,AMS,ROM,DUB,PRG,BUD,BER,CPH,MIL,EDI,VIE,ATH"
+).split(","))
+COMPARE_MAX_DESTINATIONS = int(os.environ.get("COMPARE_MAX_DESTINATIONS", 20))
+COMPARE_FLIGHT_CALLS = int(os.environ.get("COMPARE_FLIGHT_CALLS", 2))
+COMPARE_CONCURRENCY = int(os.environ.get("COMPARE_CONCURRENCY", 12))
+
+# Flight ranking - default mode ("price", "value" or "pareto"), how many options
+# to return, and what the "value" score charges per hour of travel and per stop (£)
+FLIGHT_RANKING = os.environ.get("FLIGHT_RANKING", "price")
+FLIGHT_RANKING_MODES = ("price", "value", "pareto")
+FLIGHT_RESULTS_LIMIT = int(os.environ.get("FLIGHT_RESULTS_LIMIT", 20))
+FLIGHT_VALUE_PER_HOUR = float(os.environ.get("FLIGHT_VALUE_PER_HOUR", 20))
+FLIGHT_STOP_PENALTY = float(os.environ.get("FLIGHT_STOP_PENALTY", 40))
+
+# Shared SerpApi HTTP client - connection pool size, retry policy and timeouts (seconds)
+SERPAPI_URL = os.environ.get("SERPAPI_URL", "https://serpapi.com/search")
+SERPAPI_POOL_SIZE = int(os.environ.get("SERPAPI_POOL_SIZE", 20))
+SERPAPI_MAX_RETRIES = int(os.environ.get("SERPAPI_MAX_RETRIES", 2))
+SERPAPI_BACKOFF = float(os.environ.get("SERPAPI_BACKOFF", 0.5))
+SERPAPI_CONNECT_TIMEOUT = float(os.environ.get("SERPAPI_CONNECT_TIMEOUT", 5))
+SERPAPI_READ_TIMEOUT = float(os.environ.get("SERPAPI_READ_TIMEOUT", 30))
+# The async client multiplexes many requests per process, so it gets a bigger pool
+SERPAPI_ASYNC_POOL_SIZE = int(os.environ.get("SERPAPI_ASYNC_POOL_SIZE", 100))
+SERPAPI_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Circuit breakers, one per upstream (each SerpApi engine, Anthropic) - after
+# CIRCUIT_FAILURE_THRESHOLD failures in a row (errors, timeouts, 429/5xx) calls
+# fail fast for CIRCUIT_RESET_TIMEOUT seconds, then one probe call is let
+# through: success closes the circuit, failure opens it again
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 3))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", 30))
+
+# Flight search result cache - max entries and TTL (seconds) for far-out departures
+FLIGHT_CACHE_SIZE = int(os.environ.get("FLIGHT_CACHE_SIZE", 1024))
+FLIGHT_CACHE_TTL = int(os.environ.get("FLIGHT_CACHE_TTL", 3 * 60 * 60))
+
+# Hotel search result cache - max entries (TTLs follow flight_cache_ttl)
+HOTEL_CACHE_SIZE = int(os.environ.get("HOTEL_CACHE_SIZE", 512))
+
+# On-disk itinerary cache - location, size bound (bytes) and max age (seconds)
+ITINERARY_CACHE_DIR = os.environ.get("ITINERARY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "itinerary_cache"))
+ITINERARY_CACHE_MAX_BYTES = int(os.environ.get("ITINERARY_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+ITINERARY_CACHE_TTL = int(os.environ.get("ITINERARY_CACHE_TTL", 30 * 24 * 60 * 60))
+
+# Trips longer than ITINERARY_CHUNK_THRESHOLD days are generated as concurrent
+# model calls: one for overview/restaurants/nightlife and one per group of days
+ITINERARY_CHUNK_THRESHOLD = int(os.environ.get("ITINERARY_CHUNK_THRESHOLD", 7))
+ITINERARY_CHUNK_DAYS = int(os.environ.get("ITINERARY_CHUNK_DAYS", 4))
+
+# Itinerary latency SLO - the longest a request waits for the model (seconds,
+# 0 = no limit; a request body's "itinerary_deadline" overrides it). On a miss
+# the response carries the fallback itinerary and an upgrade link, generation
+# carries on in the background,
+# and the finished itinerary can be fetched for ITINERARY_UPGRADE_TTL seconds.
+# Streams stay open up to ITINERARY_UPGRADE_WAIT seconds to push it, which
+# holds a server thread (a task under asgi_app) - run gunicorn with threads.
+# Deadline-bound generations run on ITINERARY_BACKGROUND_WORKERS threads, more
+# than the server's request threads plus JOB_WORKERS so none waits in a queue
+# (which would eat into its deadline). When all are busy a request generates
+# on its own thread without a deadline, counted in
+# flight_agent_itinerary_pool_saturated_total.
+ITINERARY_DEADLINE = float(os.environ.get("ITINERARY_DEADLINE", 0))
+ITINERARY_BACKGROUND_WORKERS = int(os.environ.get("ITINERARY_BACKGROUND_WORKERS", 64))
+ITINERARY_UPGRADE_TTL = int(os.environ.get("ITINERARY_UPGRADE_TTL", 15 * 60))
+ITINERARY_UPGRADE_WAIT = float(os.environ.get("ITINERARY_UPGRADE_WAIT", 90))
+
+# Fallback itineraries kept ready-built, per city and duration
+FALLBACK_TEMPLATE_CACHE_SIZE = int(os.environ.get("FALLBACK_TEMPLATE_CACHE_SIZE", 256))
+
+# Background job API - worker pool size, max queued jobs, how long finished
+# jobs are kept (seconds) and the longest a poll may block (seconds)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_MAX_PENDING = int(os.environ.get("JOB_MAX_PENDING", 100))
+JOB_TTL = int(os.environ.get("JOB_TTL", 15 * 60))
+JOB_MAX_WAIT = float(os.environ.get("JOB_MAX_WAIT", 30))
+
+# Airport dataset - OurAirports CSVs (https://ourairports.com/data/), fetched
+# into data/ by the Docker build. Without them only the built-in
+# AIRPORT_TO_CITY table is known. AIRPORT_SUGGEST_LIMIT is the default number
+# of /airports autocomplete results.
+AIRPORTS_CSV = os.environ.get("AIRPORTS_CSV", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "airports.csv"))
+COUNTRIES_CSV = os.environ.get("COUNTRIES_CSV", os.path.join(os.path.dirname(AIRPORTS_CSV), "countries.csv"))
+AIRPORT_SUGGEST_LIMIT = int(os.environ.get("AIRPORT_SUGGEST_LIMIT", 8))
+
+# Logging - minimum level (DEBUG adds per-call detail and itinerary summaries)
+# and output format: "json" (one object per line) or "text"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+
+# Correlation id of the request (or background job) being handled. Set per
+# request and carried into worker threads with in_context().
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+def in_context(fn):
+    """Wrap fn to run in a copy of the caller's context, so work handed to a
+    thread pool keeps the request id (pool threads don't inherit contextvars)"""
+    context = contextvars.copy_context()
+    # A Context can only be entered by one thread at a time, so each call gets its own copy
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+class RequestIdFilter(logging.Filter):
+    """Stamp each record with the current request id, on the logging thread's caller"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, request id, message and any ``extra`` fields"""
+
+    STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": record.request_id,
+            "msg": record.getMessage()
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in self.STANDARD)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue records as they are; formatting happens on the listener thread"""
+
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    """Logger whose records are formatted and written by a background thread.
+
+    Request threads only enqueue, so slow or contended stdout never blocks a
+    request. With gunicorn, don't use --preload: the writer thread has to be
+    started in each worker.
+    """
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s"))
+
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(RequestIdFilter())
+    listener = QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger("flight_agent")
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(handler)
+    logger.propagate = False
+    return logger
+
+log = setup_logging()
 
 # Map airport codes to city names for hotel searches
 AIRPORT_TO_CITY = {
@@ -234,357 +446,1732 @@ AIRPORT_TO_CITY = {
     "INV": "Inverness, UK",
     "JER": "Jersey, UK",
     "GCI": "Guernsey, UK",
-    "IOM": "Isle of Man, UK"
+    "IOM": "Isle of Man, UK",
+
+    # Metro areas (see METRO_AREAS)
+    "LON": "London, UK",
+    "MIL": "Milan, Italy",
+    "STO": "Stockholm, Sweden",
+    "WAS": "Washington DC, USA",
+    "CHI": "Chicago, USA",
+    "YTO": "Toronto, Canada",
+    "SAO": "Sao Paulo, Brazil",
+    "RIO": "Rio de Janeiro, Brazil",
+    "BUE": "Buenos Aires, Argentina",
+    "OSA": "Osaka, Japan",
+    "SEL": "Seoul, South Korea",
+    "BJS": "Beijing, China"
+}
+
+# Metro-area codes and their airports, main airport first. A metro code as
+# origin or destination searches each of its airports.
+METRO_AREAS = {
+    "LON": ("LHR", "LGW", "STN", "LTN", "LCY", "SEN"),
+    "PAR": ("CDG", "ORY", "BVA"),
+    "NYC": ("JFK", "EWR", "LGA"),
+    "MIL": ("MXP", "LIN", "BGY"),
+    "ROM": ("FCO", "CIA"),
+    "STO": ("ARN", "BMA", "NYO"),
+    "WAS": ("IAD", "DCA", "BWI"),
+    "CHI": ("ORD", "MDW"),
+    "YTO": ("YYZ", "YTZ"),
+    "SAO": ("GRU", "CGH", "VCP"),
+    "RIO": ("GIG", "SDU"),
+    "BUE": ("EZE", "AEP"),
+    "TYO": ("HND", "NRT"),
+    "OSA": ("KIX", "ITM"),
+    "SEL": ("ICN", "GMP"),
+    "BJS": ("PEK", "PKX")
 }
 
+def metro_airports(code):
+    """The airports a search for ``code`` covers: a metro area's members, or just the code"""
+    return METRO_AREAS.get(code, (code,))
+
+def airport_pairs(origin, destination):
+    """(rank, origin airport, destination airport) for a route, main airports (lowest rank) first"""
+    return sorted(
+        (
+            (i + j, search_origin, search_destination)
+            for i, search_origin in enumerate(metro_airports(origin))
+            for j, search_destination in enumerate(metro_airports(destination))
+            if search_origin != search_destination
+        ),
+        key=lambda pair: pair[0]
+    )
+
+# Country names as used in AIRPORT_TO_CITY labels, where they differ from the
+# OurAirports ones
+COUNTRY_SHORT_NAMES = {"GB": "UK", "US": "USA", "AE": "UAE"}
+
+# Words too common in airport names to help tell them apart
+AIRPORT_STOPWORDS = frozenset((
+    "airport", "international", "intl", "regional", "municipal", "county", "airfield",
+    "aerodrome", "air", "base", "field", "the", "of", "de", "del", "la"
+))
+
+NON_WORD = re.compile(r"[^a-z0-9]+")
+
+def normalize_text(text):
+    """Lowercase ASCII words only, accents dropped ("Zürich-Kloten" -> "zurich kloten")"""
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    return NON_WORD.sub(" ", text.lower()).strip()
+
+def trigrams(word):
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class AirportIndex:
+    """Airports by IATA code, with autocomplete over codes, names and cities.
+
+    Each airport is stored once, as a (code, name, city, country, label) tuple,
+    in rank order (large airports first), so lower ids are better matches.
+    Prefix search uses ``_words``, a sorted list of every indexed word with the
+    airport ids in the parallel ``_word_ids`` array. It is a flattened prefix
+    trie: the words starting with a prefix sit in one run found with two
+    bisects, at a fraction of a dict-of-dicts trie's memory. Queries that match
+    few airports by prefix (typos, "barcelna") fall back to ``_trigrams``,
+    which scores airports by the letter trigrams they share with the query.
+    """
+
+    # Prefix runs longer than this ("a", "int") are cheaper to answer by
+    # scanning airports in rank order than by collecting every id in the run
+    SCAN_RUN = 512
+
+    CODE, NAME, CITY, COUNTRY, LABEL = range(5)
+
+    def __init__(self, airports):
+        """airports: (code, name, city, country, label, rank) tuples; lowest rank first"""
+        self.entries = [entry[:5] for entry in sorted(airports, key=lambda a: (a[5], a[0]))]
+        self.by_code = {entry[self.CODE]: i for i, entry in enumerate(self.entries)}
+        # " code name words city words" per airport, for the rank-order scan
+        self._text = []
+
+        words = []
+        grams = {}
+        for i, (code, name, city, country, _) in enumerate(self.entries):
+            entry_words = set(normalize_text(f"{code} {name} {city}").split())
+            self._text.append(" " + " ".join(entry_words))
+            words.extend((sys.intern(word), i) for word in entry_words)
+            for word in entry_words - AIRPORT_STOPWORDS:
+                for gram in trigrams(word):
+                    grams.setdefault(gram, array("I")).append(i)
+
+        words.sort()
+        self._words = [word for word, _ in words]
+        self._word_ids = array("I", (i for _, i in words))
+        self._trigrams = grams
+
+    @classmethod
+    def load(cls, airports_csv=AIRPORTS_CSV, countries_csv=COUNTRIES_CSV, known=AIRPORT_TO_CITY):
+        """Index the OurAirports airports.csv, plus any ``known`` codes it lacks.
+
+        Airports with an IATA code are kept: large and medium ones, and small
+        ones with scheduled service. Codes in ``known`` rank first (metro
+        areas ahead of single airports) and keep their hand-written "City,
+        Country" label. If the CSV is missing, only ``known`` is indexed.
+        """
+        countries = {}
+        if countries_csv and os.path.exists(countries_csv):
+            with open(countries_csv, newline="", encoding="utf-8") as f:
+                rows = csv.reader(f)
+                header = next(rows)
+                code_col, name_col = header.index("code"), header.index("name")
+                countries = {row[code_col]: row[name_col] for row in rows}
+        countries.update(COUNTRY_SHORT_NAMES)
+
+        airports = {}
+        if airports_csv and os.path.exists(airports_csv):
+            types = {"large_airport": 0, "medium_airport": 2, "small_airport": 4}
+            with open(airports_csv, newline="", encoding="utf-8") as f:
+                rows = csv.reader(f)
+                header = next(rows)
+                iata_col, type_col, name_col, city_col, country_col, service_col = (
+                    header.index(column) for column in
+                    ("iata_code", "type", "name", "municipality", "iso_country", "scheduled_service")
+                )
+                for row in rows:
+                    code = row[iata_col]
+                    rank = types.get(row[type_col])
+                    if len(code) != 3 or rank is None:
+                        continue
+                    scheduled = row[service_col] == "yes"
+                    if rank == 4 and not scheduled:
+                        continue
+                    # Codes in the hand-written table are the usual destinations - suggest them first
+                    rank = -1 if code in known else rank + (not scheduled)
+                    if code in airports and airports[code][5] <= rank:
+                        continue
+                    city = row[city_col]
+                    country = sys.intern(countries.get(row[country_col], row[country_col]))
+                    label = known.get(code) or (f"{city}, {country}" if city else row[name_col])
+                    airports[code] = (code, row[name_col], city, country, label, rank)
+
+        for code, label in known.items():
+            if code not in airports:
+                city, _, country = label.rpartition(", ")
+                rank = -2 if code in METRO_AREAS else -1
+                airports[code] = (code, "", city or label, country if city else "", label, rank)
+
+        return cls(airports.values())
+
+    def label(self, code):
+        """The "City, Country" label for an airport code, or None if it isn't known"""
+        i = self.by_code.get(code)
+        return None if i is None else self.entries[i][self.LABEL]
+
+    def _prefix_run(self, prefix):
+        start = bisect.bisect_left(self._words, prefix)
+        return start, bisect.bisect_left(self._words, prefix + "\uffff", start)
+
+    def _prefix_ids(self, terms, limit):
+        """Lowest ``limit`` ids of the airports with a word starting with each term"""
+        runs = sorted((self._prefix_run(term) for term in terms), key=lambda run: run[1] - run[0])
+        start, end = runs[0]
+        if end - start > self.SCAN_RUN:
+            needles = [" " + term for term in terms]
+            matches = []
+            for i, text in enumerate(self._text):
+                if all(needle in text for needle in needles):
+                    matches.append(i)
+                    if len(matches) == limit:
+                        break
+            return matches
+
+        ids = set(self._word_ids[start:end])
+        for start, end in runs[1:]:
+            if not ids:
+                break
+            ids &= set(self._word_ids[start:end])
+        return heapq.nsmallest(limit, ids)
+
+    def _fuzzy_ids(self, terms, exclude, limit):
+        # Partial stopwords ("inte", "airp") and trigrams shared by a large
+        # share of airports say little about which airport is meant
+        terms = [t for t in terms if not any(word.startswith(t) for word in AIRPORT_STOPWORDS)]
+        common = len(self.entries) // 8
+        postings = [ids for ids in (self._trigrams.get(gram, ()) for gram in set().union(*map(trigrams, terms)))
+                    if len(ids) <= common]
+        scores = {}
+        for ids in postings:
+            for i in ids:
+                scores[i] = scores.get(i, 0) + 1
+        # At least half the query's trigrams must be shared
+        threshold = max(2, len(postings) // 2)
+        return heapq.nsmallest(
+            limit,
+            (i for i, score in scores.items() if score >= threshold and i not in exclude),
+            key=lambda i: (-scores[i], i)
+        )
+
+    def search(self, query, limit=AIRPORT_SUGGEST_LIMIT):
+        """Best ``limit`` airports for an autocomplete query.
+
+        Every word of the query must prefix a word of the airport's code, name
+        or city. An exact code match comes first, then airports by size.
+        Trigram matches fill any remaining slots.
+        """
+        terms = normalize_text(query).split()
+        if not terms or limit <= 0:
+            return []
+
+        matches = self._prefix_ids(terms, limit)
+        exact = self.by_code.get(query.strip().upper())
+        if exact is not None:
+            matches = [exact] + [i for i in matches if i != exact][:limit - 1]
+        if len(matches) < limit and len("".join(terms)) >= 3:
+            matches += self._fuzzy_ids(terms, set(matches), limit - len(matches))
+        return [self.as_dict(i) for i in matches]
+
+    def as_dict(self, i):
+        code, name, city, country, label = self.entries[i]
+        result = {"code": code, "name": name, "city": city, "country": country, "label": label}
+        if code in METRO_AREAS:
+            result["airports"] = list(METRO_AREAS[code])
+        return result
+
+    def stats(self):
+        return {"airports": len(self.entries), "words": len(self._words), "trigrams": len(self._trigrams)}
+
+# Lookups use the built-in table until the full dataset has loaded, which
+# happens off the import path so it doesn't add to cold start
+airports = AirportIndex.load(None, None)
+
+def load_airports():
+    global airports
+    if not os.path.exists(AIRPORTS_CSV):
+        log.info("No airport dataset at %s - using the built-in table of %d airports", AIRPORTS_CSV, len(airports.entries))
+        return
+    started = time.perf_counter()
+    try:
+        index = AirportIndex.load()
+    except (OSError, ValueError, csv.Error) as e:
+        log.warning("Airport dataset unavailable: %s", e)
+        return
+    airports = index
+    log.info("Loaded %d airports in %.0fms", len(index.entries), (time.perf_counter() - started) * 1000)
+
+threading.Thread(target=load_airports, daemon=True).start()
+
 def get_city_name(airport_code):
     """Convert airport code to city name"""
-    return AIRPORT_TO_CITY.get(airport_code, airport_code)
+    return airports.label(airport_code) or airport_code
 
-class TravelPlanningAgent:
-    def __init__(self):
-        self.serpapi_key = os.environ.get("SERPAPI_KEY")
-        
-    def search_flights(self, origin, destination, outbound_date, return_date=None):
-        """Search flights with detailed times and prices"""
-        params = {
-            "engine": "google_flights",
-            "departure_id": origin,
-            "arrival_id": destination,
-            "outbound_date": outbound_date,
-            "currency": "GBP",
-            "hl": "en",
-            "api_key": self.serpapi_key
-        }
-        
-        if return_date:
-            params["return_date"] = return_date
-            params["type"] = "1"
-        
+class SerpApiClient:
+    """Keep-alive, connection-pooled HTTP client shared by all SerpApi calls.
+
+    A single HTTPAdapter (one urllib3 pool) is shared by every thread, so TCP+TLS
+    connections to serpapi.com are reused across searches. Each thread gets its
+    own lightweight Session on top of that adapter because Session itself is not
+    documented as thread-safe.
+    """
+
+    def __init__(self, base_url=SERPAPI_URL, pool_size=SERPAPI_POOL_SIZE, max_retries=SERPAPI_MAX_RETRIES,
+                 backoff=SERPAPI_BACKOFF, connect_timeout=SERPAPI_CONNECT_TIMEOUT, read_timeout=SERPAPI_READ_TIMEOUT):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        # Retry connection errors and throttling/5xx responses with exponential backoff.
+        # Read timeouts are not retried - a slow search would just double the wait.
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            backoff_factor=backoff,
+            status_forcelist=SERPAPI_RETRY_STATUSES,
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False
+        )
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", self._adapter)
+            session.mount("http://", self._adapter)
+            self._local.session = session
+        return session
+
+    def get(self, params, timeout=None):
+        """GET a SerpApi search and return the decoded JSON body"""
+        engine = params.get("engine", "unknown")
+        response = upstream_call(
+            "serpapi", engine,
+            lambda: self._session().get(self.base_url, params=params, timeout=timeout or self.timeout),
+            failed=serpapi_unavailable
+        )
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.inc("serpapi", engine)
+        return response.json()
+
+class AsyncSerpApiClient:
+    """Non-blocking counterpart of SerpApiClient on a pooled httpx.AsyncClient.
+
+    Connection errors are retried by the transport; 429/5xx responses are
+    retried here with exponential backoff, matching the sync client's policy.
+    """
+
+    def __init__(self, base_url=SERPAPI_URL, pool_size=SERPAPI_ASYNC_POOL_SIZE, max_retries=SERPAPI_MAX_RETRIES,
+                 backoff=SERPAPI_BACKOFF, connect_timeout=SERPAPI_CONNECT_TIMEOUT, read_timeout=SERPAPI_READ_TIMEOUT):
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            transport=httpx.AsyncHTTPTransport(retries=max_retries, limits=limits)
+        )
+
+    async def get(self, params, timeout=None):
+        """GET a SerpApi search and return the decoded JSON body"""
+        engine = params.get("engine", "unknown")
+        response = await aupstream_call(
+            "serpapi", engine, lambda: self._get_with_retries(params, timeout), failed=serpapi_unavailable
+        )
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.inc("serpapi", engine)
+        return response.json()
+
+    async def _get_with_retries(self, params, timeout):
+        for attempt in range(self.max_retries + 1):
+            response = await self._client.get(
+                self.base_url, params=params, timeout=timeout or httpx.USE_CLIENT_DEFAULT
+            )
+            if response.status_code in SERPAPI_RETRY_STATUSES and attempt < self.max_retries:
+                await asyncio.sleep(self.backoff * (2 ** attempt))
+                continue
+            return response
+
+    async def aclose(self):
+        await self._client.aclose()
+
+class SearchCache:
+    """Thread-safe LRU cache with per-entry TTL and stale-while-revalidate.
+
+    Entries are fresh for their TTL, then stale for a further ``stale_fraction``
+    of the TTL. A stale entry is returned immediately and refreshed in a
+    background thread; anything older counts as a miss.
+    """
+
+    def __init__(self, max_entries=1024, stale_fraction=0.5):
+        self.max_entries = max_entries
+        self.stale_fraction = stale_fraction
+        self._entries = OrderedDict()  # key -> (value, fresh_until, stale_until)
+        self._refreshing = set()
+        self._background_tasks = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+    def _lookup(self, key):
+        """Return ``(found, value, needs_refresh)`` and update the counters"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                value, fresh_until, stale_until = entry
+                if now < fresh_until:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return True, value, False
+                if now < stale_until:
+                    self.stale_hits += 1
+                    self._entries.move_to_end(key)
+                    refresh = key not in self._refreshing
+                    if refresh:
+                        self._refreshing.add(key)
+                    return True, value, refresh
+                del self._entries[key]
+            self.misses += 1
+            return False, None, False
+
+    def get_or_fetch(self, key, fetch, ttl, should_cache=None):
+        """Return the cached value for key, calling fetch() on a miss"""
+        found, value, refresh = self._lookup(key)
+        if found:
+            if refresh:
+                threading.Thread(
+                    target=in_context(self._refresh), args=(key, fetch, ttl, should_cache), daemon=True
+                ).start()
+            return value
+
+        value = fetch()
+        if should_cache is None or should_cache(value):
+            self.put(key, value, ttl)
+        return value
+
+    async def aget_or_fetch(self, key, fetch, ttl, should_cache=None):
+        """Async variant of get_or_fetch - fetch is a coroutine function"""
+        found, value, refresh = self._lookup(key)
+        if found:
+            if refresh:
+                task = asyncio.ensure_future(self._arefresh(key, fetch, ttl, should_cache))
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
+            return value
+
+        value = await fetch()
+        if should_cache is None or should_cache(value):
+            self.put(key, value, ttl)
+        return value
+
+    def put(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (value, now + ttl, now + ttl * (1 + self.stale_fraction))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _refresh(self, key, fetch, ttl, should_cache):
         try:
-            response = requests.get("https://serpapi.com/search", params=params, timeout=30)
-            return response.json()
+            value = fetch()
+            if should_cache is None or should_cache(value):
+                self.put(key, value, ttl)
+                with self._lock:
+                    self.refreshes += 1
         except Exception as e:
-            print(f"Flight search error: {e}")
-            return {"error": str(e)}
-    
-    def search_hotels(self, destination_code, check_in, check_out):
-        """Search hotels with images and detailed info"""
-        city_name = get_city_name(destination_code)
-        print(f"Searching hotels for: {city_name}")
-        
-        params = {
-            "engine": "google_hotels",
-            "q": city_name,
-            "check_in_date": check_in,
-            "check_out_date": check_out,
-            "currency": "GBP",
-            "gl": "uk",
-            "hl": "en",
-            "api_key": self.serpapi_key
-        }
-        
+            log.warning("Cache refresh error for %s: %s", key, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    async def _arefresh(self, key, fetch, ttl, should_cache):
         try:
-            response = requests.get("https://serpapi.com/search", params=params, timeout=30)
-            result = response.json()
-            print(f"Hotel API returned {len(result.get('properties', []))} properties")
-            return result
+            value = await fetch()
+            if should_cache is None or should_cache(value):
+                self.put(key, value, ttl)
+                with self._lock:
+                    self.refreshes += 1
         except Exception as e:
-            print(f"Hotel search error: {e}")
-            return {"error": str(e)}
-    
-    def search_airbnb(self, destination_code, check_in, check_out):
-        """Search Airbnb listings"""
-        city_name = get_city_name(destination_code)
-        check_in_date = datetime.strptime(check_in, "%Y-%m-%d")
-        check_out_date = datetime.strptime(check_out, "%Y-%m-%d")
-        nights = (check_out_date - check_in_date).days
-        
-        params = {
-            "engine": "google",
-            "q": f"airbnb {city_name}",
-            "api_key": self.serpapi_key,
-            "num": 10
-        }
-        
+            log.warning("Cache refresh error for %s: %s", key, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "refreshes": self.refreshes,
+                "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0
+            }
+
+def flight_cache_ttl(outbound_date):
+    """Fares move faster close to departure, so cache them for less time"""
+    try:
+        days_out = (datetime.strptime(outbound_date, "%Y-%m-%d") - datetime.now()).days
+    except (TypeError, ValueError):
+        return FLIGHT_CACHE_TTL // 12
+    if days_out <= 3:
+        return FLIGHT_CACHE_TTL // 36   # 5 minutes with the default TTL
+    if days_out <= 14:
+        return FLIGHT_CACHE_TTL // 12   # 15 minutes
+    if days_out <= 60:
+        return FLIGHT_CACHE_TTL // 3    # 1 hour
+    return FLIGHT_CACHE_TTL
+
+class FlexibleDateSearch:
+    """Decide which flexible-date searches are worth making for one request.
+
+    Searches - (origin, destination, outbound, return) - are tried in the
+    order given, best bets first, a round at a time. After each round the
+    search stops if the cheapest FLEX_TOP_K fares are already well under
+    budget, if the round barely improved them, or if the call cap is spent.
+    The first round is judged against its first search - the requested dates -
+    alone, so a first round of flexible dates that beats nothing stops early.
+    """
+
+    def __init__(self, search_dates, budget=None, max_calls=None, round_size=None,
+                 top_k=FLEX_TOP_K, budget_share=FLEX_BUDGET_SHARE, min_gain=FLEX_MIN_GAIN):
+        self.pending = list(search_dates)
+        self.requested = self.pending[0] if self.pending else None
         try:
-            response = requests.get("https://serpapi.com/search", params=params, timeout=30)
-            results = response.json()
-            
-            airbnb_listings = []
-            if "organic_results" in results:
-                for result in results["organic_results"][:8]:
-                    if "airbnb" in result.get("link", "").lower():
-                        airbnb_listings.append({
-                            "name": result.get("title", "Airbnb Listing"),
-                            "description": result.get("snippet", ""),
-                            "link": result.get("link", "#"),
-                            "price_per_night": "50-150",
-                            "total_price": f"{nights * 75}",
-                            "type": "Entire home/Private room"
-                        })
-            
-            return airbnb_listings
-        except Exception as e:
-            print(f"Airbnb search error: {e}")
+            self.budget = float(budget) if budget else None
+        except (TypeError, ValueError):
+            self.budget = None
+        self.max_calls = FLEX_MAX_CALLS if max_calls is None else max_calls
+        self.round_size = max(1, round_size or FLEX_ROUND_SIZE)
+        self.top_k = top_k
+        self.budget_share = budget_share
+        self.min_gain = min_gain
+        self.calls = 0
+        self.prices = []
+        self.stop_reason = None
+
+    def next_round(self):
+        """The next searches to make, or [] when the search should stop"""
+        if self.stop_reason:
             return []
-    
-    def analyze_flexible_dates(self, origin, destination, start_date, return_date, days_range=10):
-        """Search flights across flexible dates - expanded range for more options"""
-        results = []
-        base_date = datetime.strptime(start_date, "%Y-%m-%d")
+        size = min(self.round_size, len(self.pending), self.max_calls - self.calls)
+        if size <= 0:
+            self.stop_reason = "call cap" if self.pending else "exhausted"
+            return []
+        batch, self.pending = self.pending[:size], self.pending[size:]
+        self.calls += size
+        return batch
 
-        if return_date:
-            return_date_obj = datetime.strptime(return_date, "%Y-%m-%d")
+    def add_round(self, results):
+        """Record one round's flights, ``{search: flights}``, and decide whether another round is worth it"""
+        if not self.prices and len(results) > 1:
+            before = self._top_k_total(self._prices(results.get(self.requested, [])))
+        else:
+            before = self._top_k_total(self.prices)
+        self.prices = sorted(self.prices + self._prices(flight for flights in results.values() for flight in flights))
+        after = self._top_k_total(self.prices)
 
-        # Search before and after the selected date for more flexibility
-        search_offsets = list(range(-3, days_range + 1))  # -3 to +10 days from selected date
+        top = self.prices[:self.top_k]
+        if self.budget and len(top) == self.top_k and top[-1] <= self.budget * self.budget_share:
+            self.stop_reason = "under budget"
+        elif before is not None and after is not None and after > before * (1 - self.min_gain):
+            self.stop_reason = "no improvement"
 
-        for i in search_offsets:
-            search_date = (base_date + timedelta(days=i)).strftime("%Y-%m-%d")
-            # Skip past dates
-            if datetime.strptime(search_date, "%Y-%m-%d") < datetime.now():
-                continue
+    @staticmethod
+    def _prices(flights):
+        return sorted(f.price for f in flights if isinstance(f.price, (int, float)))
 
-            search_return = (return_date_obj + timedelta(days=i)).strftime("%Y-%m-%d") if return_date else None
+    def _top_k_total(self, prices):
+        if len(prices) < self.top_k:
+            return None
+        return sum(prices[:self.top_k])
 
-            flight_data = self.search_flights(origin, destination, search_date, search_return)
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
 
-            # Process best_flights
-            if "best_flights" in flight_data:
-                for flight in flight_data.get("best_flights", [])[:5]:  # Get top 5 from each day
-                    flight_details = self._extract_flight_details(flight, origin, destination, search_date, search_return)
-                    if flight_details:
-                        results.append(flight_details)
+class FlightRecord:
+    """One flight option, kept compact while dates are searched and ranked.
 
-            # Also check other_flights for budget options
-            if "other_flights" in flight_data:
-                for flight in flight_data.get("other_flights", [])[:3]:  # Get top 3 budget options
-                    flight_details = self._extract_flight_details(flight, origin, destination, search_date, search_return)
-                    if flight_details:
-                        results.append(flight_details)
+    A request holds hundreds of these, so fields live in ``__slots__`` instead
+    of a 30-key dict, strings parsed afresh for every flight but shared
+    across them (airlines, airports, logos, aircraft) are interned, and the
+    booking link and combined layovers are derived on demand. ``to_dict()`` gives the JSON shape the API returns.
+    """
 
-        return results
+    __slots__ = (
+        "search_origin", "search_destination",
+        "outbound_date", "return_date", "price", "total_duration",
+        "airline", "airline_logo",
+        "outbound_departure_time", "outbound_arrival_time",
+        "outbound_departure_airport", "outbound_arrival_airport",
+        "outbound_duration", "outbound_stops", "outbound_layovers",
+        "return_departure_time", "return_arrival_time",
+        "return_departure_airport", "return_arrival_airport",
+        "return_duration", "return_stops", "return_layovers", "return_airline",
+        "flight_number", "airplane", "carbon_emissions", "is_overnight", "is_round_trip"
+    )
 
-    def _extract_flight_details(self, flight, origin, destination, search_date, search_return):
-        """Extract flight details from API response - handles both outbound and return flights"""
-        flights_info = flight.get("flights", [])
+    # Response keys in the order the API has always returned them
+    FIELDS = (
+        "outbound_date", "return_date", "price", "total_duration",
+        "airline", "airline_logo",
+        "outbound_departure_time", "outbound_arrival_time",
+        "outbound_departure_airport", "outbound_arrival_airport",
+        "outbound_duration", "outbound_stops", "outbound_layovers",
+        "return_departure_time", "return_arrival_time",
+        "return_departure_airport", "return_arrival_airport",
+        "return_duration", "return_stops", "return_layovers", "return_airline",
+        "booking_link", "layovers", "flight_number", "airplane",
+        "carbon_emissions", "is_overnight", "is_round_trip"
+    )
 
-        if not flights_info:
-            return None
+    def __init__(self, search_origin, search_destination, outbound_date, return_date, price, total_duration,
+                 airline, airline_logo,
+                 outbound_departure_time, outbound_arrival_time,
+                 outbound_departure_airport, outbound_arrival_airport,
+                 outbound_duration, outbound_stops, outbound_layovers,
+                 return_departure_time, return_arrival_time,
+                 return_departure_airport, return_arrival_airport,
+                 return_duration, return_stops, return_layovers, return_airline,
+                 flight_number, airplane, carbon_emissions, is_overnight, is_round_trip):
+        self.search_origin = search_origin
+        self.search_destination = search_destination
+        self.outbound_date = outbound_date
+        self.return_date = return_date
+        self.price = price
+        self.total_duration = total_duration
+        self.airline = _intern(airline)
+        self.airline_logo = _intern(airline_logo)
+        self.outbound_departure_time = outbound_departure_time
+        self.outbound_arrival_time = outbound_arrival_time
+        self.outbound_departure_airport = _intern(outbound_departure_airport)
+        self.outbound_arrival_airport = _intern(outbound_arrival_airport)
+        self.outbound_duration = outbound_duration
+        self.outbound_stops = outbound_stops
+        self.outbound_layovers = tuple(map(sys.intern, outbound_layovers)) if outbound_layovers else ()
+        self.return_departure_time = return_departure_time
+        self.return_arrival_time = return_arrival_time
+        self.return_departure_airport = _intern(return_departure_airport)
+        self.return_arrival_airport = _intern(return_arrival_airport)
+        self.return_duration = return_duration
+        self.return_stops = return_stops
+        self.return_layovers = tuple(map(sys.intern, return_layovers)) if return_layovers else ()
+        self.return_airline = _intern(return_airline)
+        self.flight_number = flight_number
+        self.airplane = _intern(airplane)
+        self.carbon_emissions = carbon_emissions
+        self.is_overnight = is_overnight
+        self.is_round_trip = is_round_trip
 
-        # For round trips, Google Flights API returns legs in the flights array
-        # Outbound segments go from origin to destination
-        # Return segments go from destination to origin
+    @property
+    def booking_link(self):
+        return f"https://www.google.com/travel/flights?q=Flights+from+{self.search_origin}+to+{self.search_destination}+on+{self.outbound_date}"
 
-        outbound_segments = []
-        return_segments = []
+    @property
+    def layovers(self):
+        return list(self.outbound_layovers + self.return_layovers)
 
-        for segment in flights_info:
-            dep_airport = segment.get("departure_airport", {}).get("id", "")
-            arr_airport = segment.get("arrival_airport", {}).get("id", "")
-
-            # Determine if this segment is outbound or return based on airports
-            # Outbound: starts from origin or previous outbound arrival
-            # Return: starts from destination or goes back toward origin
-            if dep_airport == origin or (outbound_segments and not return_segments):
-                # Check if we've reached destination (end of outbound)
-                if arr_airport == destination:
-                    outbound_segments.append(segment)
-                elif not return_segments:
-                    outbound_segments.append(segment)
-                else:
-                    return_segments.append(segment)
-            elif dep_airport == destination or return_segments:
-                return_segments.append(segment)
-            else:
-                # Default to outbound if unclear
-                if not outbound_segments or (outbound_segments and outbound_segments[-1].get("arrival_airport", {}).get("id") != destination):
-                    outbound_segments.append(segment)
+    def to_dict(self):
+        flight = {key: getattr(self, key) for key in self.FIELDS}
+        flight["outbound_layovers"] = list(self.outbound_layovers)
+        flight["return_layovers"] = list(self.return_layovers)
+        return flight
+
+def flight_dicts(flights):
+    """JSON-ready dicts for a list of FlightRecords"""
+    return [flight.to_dict() for flight in flights]
+
+def top_k(items, k, key):
+    """The k items with the smallest key, in key order (ties keep input order).
+
+    Streams through ``items`` with a bounded heap, so it costs O(n log k)
+    rather than sorting everything.
+    """
+    if k <= 0:
+        return []
+    heap = []
+    for seq, item in enumerate(items):
+        entry = (-key(item), -seq, item)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    return [item for _, _, item in sorted(heap, reverse=True)]
+
+def flight_stops(flight):
+    return (flight.outbound_stops or 0) + (flight.return_stops or 0)
+
+def flight_duration(flight):
+    """Total minutes in the air and on layovers, or None if the API didn't say"""
+    total = flight.total_duration
+    if isinstance(total, (int, float)):
+        return total
+    legs = [leg for leg in (flight.outbound_duration, flight.return_duration) if isinstance(leg, (int, float))]
+    return sum(legs) if legs else None
+
+def flight_value_score(flight):
+    """Price plus the cost of time and stops, in £ - lower is better"""
+    duration = flight_duration(flight)
+    if duration is None:
+        duration = 24 * 60  # unknown durations shouldn't win by default
+    return (flight.price or float('inf')) + duration / 60 * FLIGHT_VALUE_PER_HOUR + flight_stops(flight) * FLIGHT_STOP_PENALTY
+
+def pareto_frontier(flights):
+    """Flights no other flight beats on price, duration and stops all at once"""
+    # After sorting on (price, duration, stops) anything that dominates a flight
+    # comes before it, so one pass tracking the shortest duration seen per stop
+    # count is enough
+    def objectives(flight):
+        duration = flight_duration(flight)
+        return (
+            flight.price or float('inf'),
+            float('inf') if duration is None else duration,
+            flight_stops(flight)
+        )
+
+    keyed = sorted(
+        (objectives(f) + (seq, f) for seq, f in enumerate(flights)),
+        key=lambda entry: entry[:4]
+    )
+    shortest = {}  # stops -> shortest duration seen so far
+    frontier = []
+    for price, duration, stops, _, flight in keyed:
+        if any(d <= duration for s, d in shortest.items() if s <= stops):
+            continue
+        shortest[stops] = min(duration, shortest.get(stops, float('inf')))
+        frontier.append(flight)
+    return frontier
+
+class IncrementalJSONParser:
+    """Parse a JSON document as it streams in and report finished containers early.
+
+    Text before the first ``{`` (e.g. a markdown fence) is ignored. Each time an
+    object or array closes, ``watch(path)`` decides whether to decode it and pass
+    it to ``on_value(path, value)``. Paths are lists of keys and array indexes,
+    e.g. ``["daily_itinerary", 0]`` or ``["restaurants", "dinner"]``.
+    """
+
+    def __init__(self, on_value, watch):
+        self.on_value = on_value
+        self.watch = watch
+        self._text = ""
+        self._pos = 0
+        self._stack = []  # frames: {"kind", "path", "start", "key"/"index", "expect_key"}
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self.done = False
+
+    def _child_path(self):
+        if not self._stack:
+            return []
+        parent = self._stack[-1]
+        return parent["path"] + [parent["key"] if parent["kind"] == "object" else parent["index"]]
+
+    def feed(self, chunk):
+        self._text += chunk
+        text = self._text
+        stack = self._stack
+
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self.done:
+                break
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    frame = stack[-1]
+                    if frame["kind"] == "object" and frame["expect_key"]:
+                        frame["key"] = json.loads(text[self._string_start:i + 1])
+                        frame["expect_key"] = False
+            elif not stack:
+                if ch == "{":
+                    stack.append({"kind": "object", "path": [], "start": i, "key": None, "expect_key": True})
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == "{":
+                stack.append({"kind": "object", "path": self._child_path(), "start": i, "key": None, "expect_key": True})
+            elif ch == "[":
+                stack.append({"kind": "array", "path": self._child_path(), "start": i, "index": 0})
+            elif ch in "}]":
+                frame = stack.pop()
+                if self.watch(frame["path"]):
+                    try:
+                        self.on_value(frame["path"], json.loads(text[frame["start"]:i + 1]))
+                    except ValueError:
+                        pass
+                if not stack:
+                    self.done = True
+            elif ch == ",":
+                frame = stack[-1]
+                if frame["kind"] == "array":
+                    frame["index"] += 1
                 else:
-                    return_segments.append(segment)
+                    frame["expect_key"] = True
 
-        # Get first outbound segment for departure info
-        outbound_first = outbound_segments[0] if outbound_segments else {}
-        # Get last outbound segment for arrival info
-        outbound_last = outbound_segments[-1] if outbound_segments else {}
+        self._pos = len(text)
 
-        # Get first return segment for departure info
-        return_first = return_segments[0] if return_segments else {}
-        # Get last return segment for arrival info
-        return_last = return_segments[-1] if return_segments else {}
+# Itinerary keys that are streamed item by item rather than as one block
+ITINERARY_LIST_SECTIONS = ("daily_itinerary", "nightlife", "restaurants")
 
-        # Calculate total outbound duration
-        outbound_duration = sum(seg.get("duration", 0) for seg in outbound_segments)
-        return_duration = sum(seg.get("duration", 0) for seg in return_segments)
+def is_itinerary_section(path):
+    """The granularity itinerary sections are streamed at: one day, one restaurant list, one venue"""
+    if len(path) == 1:
+        return path[0] not in ITINERARY_LIST_SECTIONS
+    return len(path) == 2 and path[0] in ITINERARY_LIST_SECTIONS
 
-        # Get layover information
-        outbound_layovers = []
-        for i, seg in enumerate(outbound_segments[:-1]) if len(outbound_segments) > 1 else []:
-            layover_airport = seg.get("arrival_airport", {}).get("id", "")
-            if layover_airport:
-                outbound_layovers.append(layover_airport)
+class Counter:
+    """Monotonic counter with optional labels, for the /metrics endpoint"""
 
-        return_layovers = []
-        for i, seg in enumerate(return_segments[:-1]) if len(return_segments) > 1 else []:
-            layover_airport = seg.get("arrival_airport", {}).get("id", "")
-            if layover_airport:
-                return_layovers.append(layover_airport)
+    kind = "counter"
 
-        # Determine airline (use most prominent or first)
-        airlines = [seg.get("airline", "") for seg in outbound_segments if seg.get("airline")]
-        primary_airline = airlines[0] if airlines else "Multiple Airlines"
-        airline_logo = outbound_first.get("airline_logo", "")
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
 
-        flight_details = {
-            "outbound_date": search_date,
-            "return_date": search_return,
-            "price": flight.get("price"),
-            "total_duration": flight.get("total_duration"),
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
 
-            # Outbound flight details
-            "airline": primary_airline,
-            "airline_logo": airline_logo,
-            "outbound_departure_time": outbound_first.get("departure_airport", {}).get("time", ""),
-            "outbound_arrival_time": outbound_last.get("arrival_airport", {}).get("time", ""),
-            "outbound_departure_airport": outbound_first.get("departure_airport", {}).get("id", origin),
-            "outbound_arrival_airport": outbound_last.get("arrival_airport", {}).get("id", destination),
-            "outbound_duration": outbound_duration if outbound_duration else outbound_first.get("duration"),
-            "outbound_stops": len(outbound_segments) - 1 if len(outbound_segments) > 1 else 0,
-            "outbound_layovers": outbound_layovers,
+    def samples(self):
+        with self._lock:
+            return [(self.name, dict(zip(self.labels, key)), value) for key, value in self._values.items()]
 
-            # Return/Inbound flight details
-            "return_departure_time": return_first.get("departure_airport", {}).get("time", ""),
-            "return_arrival_time": return_last.get("arrival_airport", {}).get("time", ""),
-            "return_departure_airport": return_first.get("departure_airport", {}).get("id", destination) if return_first else "",
-            "return_arrival_airport": return_last.get("arrival_airport", {}).get("id", origin) if return_last else "",
-            "return_duration": return_duration if return_duration else (return_first.get("duration") if return_first else ""),
-            "return_stops": len(return_segments) - 1 if len(return_segments) > 1 else 0,
-            "return_layovers": return_layovers,
-            "return_airline": return_first.get("airline", primary_airline) if return_first else "",
-
-            # Booking and metadata
-            "booking_link": f"https://www.google.com/travel/flights?q=Flights+from+{origin}+to+{destination}+on+{search_date}",
-            "layovers": outbound_layovers + return_layovers,
-            "flight_number": outbound_first.get("flight_number", ""),
-            "airplane": outbound_first.get("airplane", ""),
-            "carbon_emissions": flight.get("carbon_emissions", {}).get("this_flight"),
-            "is_overnight": outbound_first.get("overnight", False),
-            "is_round_trip": bool(search_return and return_segments)
-        }
+class Histogram:
+    """Latency histogram (seconds) with optional labels, for the /metrics endpoint"""
 
-        return flight_details if flight_details.get("price") else None
-    
-    def create_structured_itinerary(self, destination_code, keywords, budget, duration_days, hotels, days_info=None, trip_type='leisure'):
-        """GUARANTEED itinerary generation - ALWAYS returns complete data with day-of-week awareness"""
-        city_name = get_city_name(destination_code)
+    kind = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
-        print(f"\n=== CREATING ITINERARY ===")
-        print(f"City: {city_name}")
-        print(f"Duration: {duration_days} days")
-        print(f"Budget: £{budget}")
-        print(f"Keywords: {keywords}")
-        print(f"Trip type: {trip_type}")
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
 
-        # Build hotel context
-        hotel_info = ""
-        if hotels and "properties" in hotels:
-            top_hotels = hotels["properties"][:3]
-            hotel_info = "\n\nTop Hotels:\n"
-            for hotel in top_hotels:
-                hotel_info += f"- {hotel.get('name', 'N/A')}: £{hotel.get('rate_per_night', {}).get('lowest', 'N/A')}/night\n"
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
 
-        # Build day-of-week context
-        days_context = ""
-        if days_info:
-            days_context = "\n\nSPECIFIC DAYS (plan activities appropriate for each day):\n"
-            for d in days_info:
-                weekend_note = "WEEKEND - more nightlife, brunches, leisure activities" if d['is_weekend'] else "WEEKDAY - some venues may be closed, but fewer crowds"
-                days_context += f"- Day {d['day']}: {d['weekday']} ({d['date']}) - {weekend_note}\n"
+    def time(self, *label_values):
+        """Context manager that observes the time spent inside it"""
+        return _Timer(self, label_values)
 
-        # Trip type specific guidance
-        trip_guidance = {
-            'leisure': 'balanced mix of sightseeing, relaxation, and local experiences',
-            'business': 'efficient itinerary with good restaurants for meetings, quieter evenings',
-            'adventure': 'active experiences, outdoor activities, unique thrills',
-            'romantic': 'intimate venues, scenic spots, special dining experiences',
-            'family': 'kid-friendly activities, parks, interactive museums, early dinners',
-            'nightlife': 'late starts, focus on evening/night activities, clubs and bars',
-            'cultural': 'museums, galleries, historic sites, local traditions',
-            'foodie': 'food tours, cooking classes, market visits, best restaurants'
-        }.get(trip_type, 'balanced mix of activities')
-
-        # Enhanced prompt with day-of-week awareness and nightlife
-        prompt = f"""You are creating a comprehensive {duration_days}-day travel itinerary for {city_name}.
+    def samples(self):
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        samples = []
+        for key, counts, total, count in series:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((self.name + "_bucket", dict(labels, le="+Inf" if bound == float("inf") else repr(bound)), cumulative))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, count))
+        return samples
 
-CRITICAL REQUIREMENTS:
-1. Respond ONLY with valid JSON
-2. NO markdown, NO code blocks, NO extra text
-3. Include EXACTLY {duration_days} days in daily_itinerary array
-4. Include 6-8 restaurants for breakfast, lunch, AND dinner
-5. Include alternative activities and hidden gems
-6. Include 8-12 nightlife venues with SPECIFIC music types
-7. IMPORTANT: Plan activities APPROPRIATE FOR EACH DAY OF WEEK:
-   - Weekends: More nightlife options, brunch spots, later wake-up activities
-   - Weekdays: Some venues closed, but museums/attractions less crowded
-   - Fridays/Saturdays: Best nights for clubs and bars
-   - Sundays: Many shops closed, good for markets and relaxed activities
-   - Mondays: Many museums closed - plan alternatives
-{days_context}
+class _Timer:
+    __slots__ = ("histogram", "label_values", "started")
 
-Trip type: {trip_type.upper()} - Focus on {trip_guidance}
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
 
-JSON Structure (copy this exactly):
-{{
-  "overview": {{
-    "destination": "{city_name}",
-    "best_time_to_visit": "Best months to visit with weather info",
-    "getting_around": "Detailed transport options including metro, bus, taxi costs",
-    "money_saving_tips": ["tip1", "tip2", "tip3", "tip4", "tip5"],
-    "local_customs": "Cultural notes and etiquette",
-    "emergency_info": "Emergency numbers and useful phrases",
-    "best_neighborhoods": ["neighborhood1", "neighborhood2", "neighborhood3"]
-  }},
-  "daily_itinerary": [
-    {{
-      "day": 1,
-      "weekday": "Saturday",
-      "theme": "Theme appropriate for this day of week",
-      "weather_tip": "What to expect/wear this time of year",
-      "day_note": "Why these activities suit this day (e.g., 'Weekend markets are open')",
-      "early_morning": {{
-        "time": "7:00 AM",
-        "activity": "Optional early activity (sunrise spots, markets)",
-        "description": "For early risers",
-        "cost": 0,
-        "duration": "1-2 hours",
-        "location": "Neighborhood",
-        "is_optional": true
-      }},
-      "morning": {{
-        "time": "9:00 AM",
-        "activity": "Main morning activity",
-        "description": "What to do and why",
-        "cost": 15,
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        return False
+
+class MetricsRegistry:
+    """Counters and histograms updated on the hot path, plus collectors that
+    read existing stats (caches, token usage) only when /metrics is scraped,
+    rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collect(self, name, kind, help, fn):
+        """Register ``fn() -> [(labels dict, value)]``, called at scrape time"""
+        self._collectors.append((name, kind, help, fn))
+
+    def render(self):
+        lines = []
+        families = [(m.name, m.kind, m.help, m.samples) for m in self._metrics]
+        families += [(name, kind, help, lambda name=name, fn=fn: [(name, labels, value) for labels, value in fn()])
+                     for name, kind, help, fn in self._collectors]
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples():
+                if labels:
+                    label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                    lines.append(f"{sample_name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+REQUEST_SECONDS = metrics.histogram("flight_agent_request_seconds", "HTTP request latency by route (streams until the last event)", ("route",))
+STAGE_SECONDS = metrics.histogram("flight_agent_stage_seconds", "Trip pipeline stage latency", ("stage",))
+UPSTREAM_SECONDS = metrics.histogram("flight_agent_upstream_seconds", "Upstream call latency", ("upstream", "operation"))
+UPSTREAM_CALLS = metrics.counter("flight_agent_upstream_calls_total", "Upstream calls made", ("upstream", "operation"))
+UPSTREAM_ERRORS = metrics.counter("flight_agent_upstream_errors_total", "Upstream calls that failed or returned an error status", ("upstream", "operation"))
+CLAUDE_FIRST_TOKEN_SECONDS = metrics.histogram("flight_agent_claude_first_token_seconds", "Time to the first streamed itinerary token")
+ITINERARY_PARSE_SECONDS = metrics.histogram("flight_agent_itinerary_parse_seconds", "Time to parse a Claude reply into JSON", buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+SERIALIZE_SECONDS = metrics.histogram("flight_agent_response_serialize_seconds", "Time to serialize a response body", ("format",), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+ITINERARY_FALLBACKS = metrics.counter("flight_agent_itinerary_fallbacks_total", "Itinerary parts replaced with fallback content", ("part",))
+ITINERARY_POOL_SATURATED = metrics.counter("flight_agent_itinerary_pool_saturated_total", "Deadline-bound itineraries generated without their deadline because every background worker was busy")
+GAP_FILLED_DAYS = metrics.counter("flight_agent_itinerary_gap_filled_days_total", "Itinerary days filled with placeholders")
+CIRCUIT_REJECTED = metrics.counter("flight_agent_circuit_rejected_total", "Upstream calls failed fast by an open circuit breaker", ("upstream", "operation"))
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for one upstream.
+
+    Closed, calls go through. After ``failure_threshold`` failures in a row it
+    opens and calls are refused until ``reset_timeout`` has passed; then it is
+    half-open and lets a single probe through. The probe's outcome closes the
+    circuit or opens it for another ``reset_timeout``.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+    STATES = (CLOSED, OPEN, HALF_OPEN)
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opens = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go ahead now (claims the probe when half-open)"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok):
+        """Record a call's outcome - True, False, or None when it never finished (cancelled)"""
+        with self._lock:
+            if ok is None:
+                self._probing = False
+            elif ok:
+                if self.state != self.CLOSED:
+                    log.info("Circuit %s closed - upstream recovered", self.name)
+                self.state = self.CLOSED
+                self.failures = 0
+                self._probing = False
+            else:
+                self.failures += 1
+                if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                    log.warning("Circuit %s open after %d failures - failing fast for %.0fs",
+                                self.name, self.failures, self.reset_timeout)
+                    self.state = self.OPEN
+                    self.opens += 1
+                    self._opened_at = time.monotonic()
+                    self._probing = False
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "opens": self.opens}
+
+class CircuitBreakers:
+    """One CircuitBreaker per (upstream, operation), created on first use"""
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, upstream, operation):
+        key = (upstream, operation)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(key, CircuitBreaker(f"{upstream}/{operation}"))
+        return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = list(self._breakers.items())
+        return [(upstream, operation, breaker.stats()) for (upstream, operation), breaker in breakers]
+
+circuit_breakers = CircuitBreakers()
+
+def _admit(upstream, operation):
+    """The upstream's breaker, or CircuitOpenError if it is refusing calls"""
+    breaker = circuit_breakers.get(upstream, operation)
+    if not breaker.allow():
+        CIRCUIT_REJECTED.inc(upstream, operation)
+        raise CircuitOpenError(f"{breaker.name} circuit open - upstream unavailable")
+    return breaker
+
+def upstream_call(upstream, operation, call, failed=None, failed_error=None):
+    """Run ``call()`` through the upstream's circuit breaker, record its
+    latency, and count it (and any failure). ``failed(result)`` marks results
+    that count as failures for the breaker without raising;
+    ``failed_error(exception)`` picks the exceptions that count (default: all) -
+    others leave the breaker as it is."""
+    breaker = _admit(upstream, operation)
+    UPSTREAM_CALLS.inc(upstream, operation)
+    started = time.perf_counter()
+    ok = None
+    try:
+        result = call()
+        ok = not (failed and failed(result))
+        return result
+    except Exception as e:
+        ok = False if failed_error is None or failed_error(e) else None
+        UPSTREAM_ERRORS.inc(upstream, operation)
+        raise
+    finally:
+        breaker.record(ok)
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream, operation)
+
+async def aupstream_call(upstream, operation, call, failed=None, failed_error=None):
+    """Async variant of upstream_call - ``call`` is a coroutine function"""
+    breaker = _admit(upstream, operation)
+    UPSTREAM_CALLS.inc(upstream, operation)
+    started = time.perf_counter()
+    ok = None
+    try:
+        result = await call()
+        ok = not (failed and failed(result))
+        return result
+    except Exception as e:
+        ok = False if failed_error is None or failed_error(e) else None
+        UPSTREAM_ERRORS.inc(upstream, operation)
+        raise
+    finally:
+        breaker.record(ok)
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream, operation)
+
+def serpapi_unavailable(response):
+    """Throttled or server-error responses count against SerpApi's breaker"""
+    return response.status_code in SERPAPI_RETRY_STATUSES
+
+def anthropic_unavailable(error):
+    """Connection errors, timeouts, 429 and 5xx count against Anthropic's
+    breaker; a rejected request (400, 401...) says nothing about an outage"""
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+class LatencyTracker:
+    """Rolling window of latency samples (seconds) with simple summary stats"""
+
+    def __init__(self, window=500):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self.count
+        if not samples:
+            return {"count": count}
+        return {
+            "count": count,
+            "avg": round(sum(samples) / len(samples), 4),
+            "p50": round(samples[len(samples) // 2], 4),
+            "p95": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+            "max": round(samples[-1], 4)
+        }
+
+class TokenUsage:
+    """Running totals of Anthropic token usage, including prompt cache reads/writes"""
+
+    FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.totals = dict.fromkeys(self.FIELDS, 0)
+
+    def record(self, usage):
+        with self._lock:
+            self.calls += 1
+            for field in self.FIELDS:
+                self.totals[field] += getattr(usage, field, None) or 0
+
+    def stats(self):
+        with self._lock:
+            return dict(self.totals, calls=self.calls)
+
+# Per-day budget buckets (GBP) used in itinerary cache keys
+BUDGET_BUCKETS = (0, 50, 100, 150, 250, 400, 600, 1000)
+
+def itinerary_cache_key(city_name, duration_days, trip_type, keywords, days_info, budget):
+    """Canonical cache key for an itinerary request.
+
+    Airports serving the same city share entries, keywords are order and case
+    insensitive, only the weekday pattern of the dates matters and the budget is
+    bucketed per day.
+    """
+    try:
+        daily_budget = float(budget) / max(int(duration_days), 1)
+    except (TypeError, ValueError):
+        daily_budget = 0
+    if not math.isfinite(daily_budget):
+        daily_budget = 0
+    budget_bucket = max((b for b in BUDGET_BUCKETS if b <= max(daily_budget, 0)), default=0)
+
+    canonical = {
+        "city": (city_name or "").strip().lower(),
+        "days": duration_days,
+        "trip_type": (trip_type or "leisure").strip().lower(),
+        "keywords": sorted({str(k).strip().lower() for k in keywords or [] if str(k).strip()}),
+        "weekdays": [d["weekday"] for d in days_info] if days_info else None,
+        "budget_bucket": budget_bucket
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+class ItineraryDiskCache:
+    """Size-bounded on-disk cache of generated itineraries, one JSON file per key.
+
+    The least recently used files (by mtime, which a hit refreshes) are
+    evicted once the directory grows past ``max_bytes``; entries older than
+    ``ttl`` seconds are treated as misses. The bound is checked against the
+    directory itself rather than a running total, so it holds when several
+    worker processes share the directory.
+    """
+
+    def __init__(self, directory=ITINERARY_CACHE_DIR, max_bytes=ITINERARY_CACHE_MAX_BYTES, ttl=ITINERARY_CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            log.warning("Itinerary cache unavailable: %s", e)
+            self.errors += 1
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _entries(self):
+        """(filename, size) of the cached files, least recently used first"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # evicted by another worker meanwhile
+                continue
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        return [(name, size) for _, name, size in entries]
+
+    def get(self, key):
+        path = self._path(f"{key}.json")
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                raise FileNotFoundError(path)
+            with open(path, encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(f"{key}.json")
+        try:
+            data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+            # Write to a temp file and rename so readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            entries = self._entries()
+        except (OSError, TypeError, ValueError) as e:
+            log.warning("Itinerary cache write error: %s", e)
+            with self._lock:
+                self.errors += 1
+            return
+
+        # The newest file (normally the one just written) is never evicted
+        total_bytes = sum(size for _, size in entries)
+        for old_name, old_size in entries[:-1]:
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= old_size
+            try:
+                os.remove(self._path(old_name))
+            except OSError:  # already gone - another worker evicted it
+                continue
+            with self._lock:
+                self.evictions += 1
+
+    def stats(self):
+        try:
+            entries = self._entries()
+        except OSError:
+            entries = []
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(entries),
+                "bytes": sum(size for _, size in entries),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "errors": self.errors,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# Shared by the sync and async agents, which cache the same itineraries
+itinerary_cache = ItineraryDiskCache()
+
+class SingleFlight:
+    """Coalesce identical concurrent calls so only one reaches the upstream.
+
+    While a call for a key is in flight, later callers with the same key wait
+    for its result (or exception) instead of starting their own. ``do`` is for
+    threads, ``ado`` for coroutines on a single event loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}    # key -> [done event, result, exception]
+        self._futures = {}  # key -> asyncio.Future
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None]
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = fn()
+            return call[1]
+        except BaseException as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+
+    async def ado(self, key, fn):
+        """Async variant of do - fn is a coroutine function"""
+        with self._lock:
+            future = self._futures.get(key)
+            leader = future is None
+            if leader:
+                future = self._futures[key] = asyncio.get_running_loop().create_future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return await asyncio.shield(future)
+
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved in case nobody else was waiting
+            raise
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._calls) + len(self._futures)}
+
+def request_key(data):
+    """Stable key for a JSON request body, used to spot duplicate submissions"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+class AsyncWaiters:
+    """Coroutines waiting on a threading.Condition without holding a thread.
+
+    A long-poll under asgi_app that blocked in ``asyncio.to_thread`` would tie
+    up the default executor, which the itinerary cache reads and writes also
+    run on. Instead ``add()`` hands out a loop future that ``notify()`` - called
+    wherever the condition is notified - resolves from the notifying thread.
+    Both must be called with the condition's lock held.
+    """
+
+    def __init__(self):
+        self._waiters = set()
+
+    def add(self):
+        loop = asyncio.get_running_loop()
+        entry = (loop, loop.create_future())
+        self._waiters.add(entry)
+        return entry
+
+    def discard(self, entry):
+        self._waiters.discard(entry)
+
+    def notify(self):
+        for loop, future in self._waiters:
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:  # the waiter's loop has closed
+                pass
+        self._waiters.clear()
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    async def wait(self, condition, entry, timeout):
+        """Wait up to ``timeout`` seconds for the next ``notify()`` after ``add()`` returned ``entry``"""
+        try:
+            await asyncio.wait_for(entry[1], timeout)
+        except asyncio.TimeoutError:
+            with condition:
+                self.discard(entry)
+
+class TripJob:
+    """One background /itinerary run: its status, partial events and final result"""
+
+    def __init__(self, data):
+        self.id = uuid.uuid4().hex
+        self.data = data
+        self.status = "queued"
+        self.events = []
+        self.result = None
+        self.status_code = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def snapshot(self, since=0):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "events": [{"event": event, "data": event_data} for event, event_data in self.events[since:]],
+            "next": len(self.events),
+            "status_code": self.status_code,
+            "result": self.result,
+            "error": self.error
+        }
+
+class JobStore:
+    """Runs trip searches on a bounded worker pool and keeps their results for polling.
+
+    Finished jobs are dropped ``ttl`` seconds after they complete; the sweep
+    happens lazily on submit and lookup.
+    """
+
+    def __init__(self, run, workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, ttl=JOB_TTL):
+        self.run = run
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="trip-job")
+        self._jobs = {}
+        self._by_key = {}  # request_key -> id of the latest job for that body
+        self._changed = threading.Condition()
+        self._async_waiters = AsyncWaiters()
+
+    def submit(self, data):
+        """Queue a job, or return None if too many are already waiting.
+
+        Submitting a body identical to a job that is still running returns that
+        job instead of starting a duplicate.
+        """
+        key = request_key(data)
+        with self._changed:
+            self._purge_expired()
+            running = self._jobs.get(self._by_key.get(key))
+            if running and not running.finished:
+                return running
+            if sum(1 for job in self._jobs.values() if not job.finished) >= self.max_pending:
+                return None
+            job = TripJob(data)
+            self._jobs[job.id] = job
+            self._by_key[key] = job.id
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        # Log lines from a job carry its id, which is what the client polls with
+        request_id_var.set(job.id)
+        self._update(job, status="running")
+        try:
+            payload, status = self.run(job.data, lambda event, event_data: self._add_event(job, event, event_data))
+            self._update(job, status="done" if status == 200 else "failed", result=payload, status_code=status)
+        except Exception as e:
+            log.exception("Job %s error: %s", job.id, e)
+            self._update(job, status="failed", error=str(e), status_code=500)
+
+    def _add_event(self, job, event, event_data):
+        with self._changed:
+            job.events.append((event, event_data))
+            self._changed.notify_all()
+            self._async_waiters.notify()
+
+    def _update(self, job, **fields):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(job, name, value)
+            if job.finished:
+                job.finished_at = time.time()
+            self._changed.notify_all()
+            self._async_waiters.notify()
+
+    def get(self, job_id, since=0, wait=0):
+        """Snapshot of a job; with ``wait`` block until it has news past ``since`` or finishes"""
+        deadline = time.time() + min(max(wait, 0), JOB_MAX_WAIT)
+        since = max(since, 0)
+        with self._changed:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            while not job.finished and len(job.events) <= since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return job.snapshot(since)
+
+    async def aget(self, job_id, since=0, wait=0):
+        """``get()`` for the event loop: waits without holding a thread"""
+        deadline = time.time() + min(max(wait, 0), JOB_MAX_WAIT)
+        since = max(since, 0)
+        while True:
+            with self._changed:
+                self._purge_expired()
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return None
+                remaining = deadline - time.time()
+                if job.finished or len(job.events) > since or remaining <= 0:
+                    return job.snapshot(since)
+                waiter = self._async_waiters.add()
+            await self._async_waiters.wait(self._changed, waiter, remaining)
+
+    def _purge_expired(self):
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and now - j.finished_at > self.ttl]:
+            del self._jobs[job_id]
+        for key in [k for k, job_id in self._by_key.items() if job_id not in self._jobs]:
+            del self._by_key[key]
+
+class SectionRelay:
+    """Forwards streamed itinerary sections to one request until closed.
+
+    Once a request has answered with the fallback, the generation it started
+    carries on for the upgrade, but its sections no longer belong to that
+    response. Closing waits for a section being forwarded, so none can
+    arrive after the request's final event.
+    """
+
+    def __init__(self, on_section):
+        self.on_section = on_section
+        self._open = True
+        self._lock = threading.Lock()
+
+    def __call__(self, path, value):
+        with self._lock:
+            if self._open:
+                self.on_section(path, value)
+
+    def close(self):
+        with self._lock:
+            self._open = False
+
+class ItineraryUpgrades:
+    """Itineraries still being generated after their request was answered with the fallback.
+
+    ``add()`` hands out a token, ``resolve()`` stores the finished itinerary
+    (None if generation failed) and ``get()`` polls or long-polls for it.
+    Entries are dropped ``ttl`` seconds after they were added.
+    """
+
+    def __init__(self, ttl=ITINERARY_UPGRADE_TTL):
+        self.ttl = ttl
+        self._entries = {}  # token -> [status, itinerary, expires_at]
+        self._changed = threading.Condition()
+        self._async_waiters = AsyncWaiters()
+
+    def add(self):
+        token = uuid.uuid4().hex
+        with self._changed:
+            self._purge_expired()
+            self._entries[token] = ["pending", None, time.time() + self.ttl]
+        return token
+
+    def resolve(self, token, itinerary):
+        with self._changed:
+            entry = self._entries.get(token)
+            if entry:
+                entry[0], entry[1] = ("ready", itinerary) if itinerary is not None else ("failed", None)
+                self._changed.notify_all()
+                self._async_waiters.notify()
+
+    def get(self, token, wait=0):
+        """``{"status": ..., "itinerary": ...}``, waiting up to ``wait`` seconds while pending; None if unknown"""
+        deadline = time.time() + max(wait, 0)
+        with self._changed:
+            self._purge_expired()
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            while entry[0] == "pending":
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return {"status": entry[0], "itinerary": entry[1]}
+
+    async def aget(self, token, wait=0):
+        """``get()`` for the event loop: waits without holding a thread"""
+        deadline = time.time() + max(wait, 0)
+        while True:
+            with self._changed:
+                self._purge_expired()
+                entry = self._entries.get(token)
+                if entry is None:
+                    return None
+                remaining = deadline - time.time()
+                if entry[0] != "pending" or remaining <= 0:
+                    return {"status": entry[0], "itinerary": entry[1]}
+                waiter = self._async_waiters.add()
+            await self._async_waiters.wait(self._changed, waiter, remaining)
+
+    def _purge_expired(self):
+        now = time.time()
+        for token in [t for t, entry in self._entries.items() if entry[2] < now]:
+            del self._entries[token]
+
+itinerary_upgrades = ItineraryUpgrades()
+
+def upgrade_link(token):
+    return {"status": "pending", "token": token, "poll_url": f"/itinerary/upgrades/{token}"}
+
+def pending_upgrade(payload):
+    """Upgrade token of a response whose itinerary is the deadline fallback, else None"""
+    upgrade = (payload.get("itinerary") or {}).get("upgrade")
+    return upgrade["token"] if upgrade else None
+
+def resolve_upgrade(token, done):
+    """Resolve an upgrade token from the finished generation (Future or Task):
+    ready with its itinerary, or failed if it raised - the client already has the fallback"""
+    if done.cancelled() or done.exception() is not None:
+        log.warning("Itinerary upgrade %s failed: %s", token, "cancelled" if done.cancelled() else done.exception())
+        itinerary_upgrades.resolve(token, None)
+    else:
+        itinerary_upgrades.resolve(token, done.result())
+
+def upgrade_event(snapshot):
+    """``itinerary_upgrade`` stream event for a finished upgrade, or None"""
+    if snapshot and snapshot["status"] == "ready":
+        return ("itinerary_upgrade", snapshot["itinerary"])
+    return None
+
+def timed_stage(name, fn, *args):
+    with STAGE_SECONDS.time(name):
+        return fn(*args)
+
+def run_stage_graph(stages):
+    """Run a dependency graph of stages on a thread pool.
+
+    ``stages`` maps a stage name to ``(fn, deps)``. Each stage starts as soon as
+    every stage named in ``deps`` has finished, and ``fn`` is called with a dict
+    of the results produced so far. Returns ``{name: result}`` for all stages.
+    """
+    results = {}
+    pending = dict(stages)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        while pending or running:
+            for name in [n for n, (_, deps) in pending.items() if all(d in results for d in deps)]:
+                fn, _ = pending.pop(name)
+                running[executor.submit(in_context(timed_stage), name, fn, dict(results))] = name
+
+            if not running:
+                raise ValueError(f"Unsatisfiable stage dependencies: {sorted(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results
+
+# Static part of the itinerary prompt. It is identical on every request, so it is
+# sent as a cached system prompt and only the short per-trip suffix changes.
+ITINERARY_PROMPT_PREFIX = """You are creating comprehensive travel itineraries.
+
+CRITICAL REQUIREMENTS:
+1. Respond ONLY with valid JSON
+2. NO markdown, NO code blocks, NO extra text
+3. Include EXACTLY the days the request asks for in daily_itinerary array
+4. Include 6-8 restaurants for breakfast, lunch, AND dinner
+5. Include alternative activities and hidden gems
+6. Include 8-12 nightlife venues with SPECIFIC music types
+7. IMPORTANT: Plan activities APPROPRIATE FOR EACH DAY OF WEEK:
+   - Weekends: More nightlife options, brunch spots, later wake-up activities
+   - Weekdays: Some venues closed, but museums/attractions less crowded
+   - Fridays/Saturdays: Best nights for clubs and bars
+   - Sundays: Many shops closed, good for markets and relaxed activities
+   - Mondays: Many museums closed - plan alternatives
+
+JSON Structure (copy this exactly):
+{
+  "overview": {
+    "destination": "City name",
+    "best_time_to_visit": "Best months to visit with weather info",
+    "getting_around": "Detailed transport options including metro, bus, taxi costs",
+    "money_saving_tips": ["tip1", "tip2", "tip3", "tip4", "tip5"],
+    "local_customs": "Cultural notes and etiquette",
+    "emergency_info": "Emergency numbers and useful phrases",
+    "best_neighborhoods": ["neighborhood1", "neighborhood2", "neighborhood3"]
+  },
+  "daily_itinerary": [
+    {
+      "day": 1,
+      "weekday": "Saturday",
+      "theme": "Theme appropriate for this day of week",
+      "weather_tip": "What to expect/wear this time of year",
+      "day_note": "Why these activities suit this day (e.g., 'Weekend markets are open')",
+      "early_morning": {
+        "time": "7:00 AM",
+        "activity": "Optional early activity (sunrise spots, markets)",
+        "description": "For early risers",
+        "cost": 0,
+        "duration": "1-2 hours",
+        "location": "Neighborhood",
+        "is_optional": true
+      },
+      "morning": {
+        "time": "9:00 AM",
+        "activity": "Main morning activity",
+        "description": "What to do and why",
+        "cost": 15,
         "duration": "2-3 hours",
         "location": "Neighborhood",
         "insider_tip": "Beat the crowds tip"
-      }},
-      "morning_alternative": {{
+      },
+      "morning_alternative": {
         "time": "9:00 AM",
         "activity": "Alternative if main is crowded/closed",
         "description": "Great backup option",
         "cost": 10,
         "duration": "2 hours",
         "location": "Nearby area"
-      }},
-      "lunch_break": {{
+      },
+      "lunch_break": {
         "time": "12:30 PM",
         "suggested_area": "Neighborhood for lunch",
         "budget_option": "Affordable local spot",
         "splurge_option": "Nice restaurant nearby"
-      }},
-      "afternoon": {{
+      },
+      "afternoon": {
         "time": "2:00 PM",
         "activity": "Main afternoon activity",
         "description": "What to do",
@@ -592,24 +2179,24 @@ JSON Structure (copy this exactly):
         "duration": "3 hours",
         "location": "Neighborhood",
         "insider_tip": "Pro tip for this activity"
-      }},
-      "afternoon_alternative": {{
+      },
+      "afternoon_alternative": {
         "time": "2:00 PM",
         "activity": "Rainy day/alternative option",
         "description": "Indoor or different experience",
         "cost": 15,
         "duration": "2-3 hours",
         "location": "Area"
-      }},
-      "evening": {{
+      },
+      "evening": {
         "time": "6:00 PM",
         "activity": "Evening activity",
         "description": "What to do",
         "cost": 25,
         "duration": "2 hours",
         "location": "Neighborhood"
-      }},
-      "night": {{
+      },
+      "night": {
         "time": "9:00 PM",
         "activity": "Nightlife/late evening option",
         "description": "For those with energy left",
@@ -617,50 +2204,50 @@ JSON Structure (copy this exactly):
         "duration": "2-3 hours",
         "location": "Nightlife area",
         "is_optional": true
-      }},
-      "hidden_gem": {{
+      },
+      "hidden_gem": {
         "activity": "Local secret most tourists miss",
         "description": "Why it's special",
         "location": "Off the beaten path location",
         "best_time": "When to visit"
-      }},
+      },
       "daily_total": 60
-    }}
+    }
   ],
-  "restaurants": {{
+  "restaurants": {
     "breakfast": [
-      {{"name": "Café Name", "cuisine": "Type", "price_per_person": 12, "rating": 4.5, "description": "Why visit", "neighborhood": "Area", "signature_dish": "Dish", "best_for": "Quick bite/Leisurely brunch", "reservation_needed": false}}
+      {"name": "Café Name", "cuisine": "Type", "price_per_person": 12, "rating": 4.5, "description": "Why visit", "neighborhood": "Area", "signature_dish": "Dish", "best_for": "Quick bite/Leisurely brunch", "reservation_needed": false}
     ],
     "lunch": [
-      {{"name": "Restaurant", "cuisine": "Type", "price_per_person": 18, "rating": 4.6, "description": "Why visit", "neighborhood": "Area", "signature_dish": "Dish", "best_for": "Business/Casual/Date", "reservation_needed": false}}
+      {"name": "Restaurant", "cuisine": "Type", "price_per_person": 18, "rating": 4.6, "description": "Why visit", "neighborhood": "Area", "signature_dish": "Dish", "best_for": "Business/Casual/Date", "reservation_needed": false}
     ],
     "dinner": [
-      {{"name": "Restaurant", "cuisine": "Type", "price_per_person": 35, "rating": 4.7, "description": "Why visit", "neighborhood": "Area", "signature_dish": "Dish", "best_for": "Romantic/Family/Group", "reservation_needed": true}}
+      {"name": "Restaurant", "cuisine": "Type", "price_per_person": 35, "rating": 4.7, "description": "Why visit", "neighborhood": "Area", "signature_dish": "Dish", "best_for": "Romantic/Family/Group", "reservation_needed": true}
     ],
     "street_food": [
-      {{"name": "Food stall/market", "specialty": "What they're known for", "price_range": "5-10", "location": "Where to find", "hours": "Operating hours"}}
+      {"name": "Food stall/market", "specialty": "What they're known for", "price_range": "5-10", "location": "Where to find", "hours": "Operating hours"}
     ],
     "cafes_bars": [
-      {{"name": "Café/Bar name", "type": "Coffee shop/Wine bar/Cocktail bar", "vibe": "Atmosphere description", "must_try": "Signature drink", "neighborhood": "Area"}}
+      {"name": "Café/Bar name", "type": "Coffee shop/Wine bar/Cocktail bar", "vibe": "Atmosphere description", "must_try": "Signature drink", "neighborhood": "Area"}
     ]
-  }},
+  },
   "nightlife": [
-    {{"name": "Club/Bar Name", "venue_type": "Nightclub/Rooftop Bar/Live Music Venue/Lounge", "music_types": ["House", "Techno"], "description": "What makes it special", "best_nights": "Friday, Saturday", "dress_code": "Smart casual", "entry_fee": 15, "drink_prices": "8-15", "opening_hours": "11pm-6am", "age_restriction": "21+", "neighborhood": "Nightlife District", "rating": 4.5}},
-    {{"name": "Jazz Club", "venue_type": "Jazz Club", "music_types": ["Jazz", "Blues"], "description": "Intimate live music", "best_nights": "Thursday-Saturday", "dress_code": "Smart casual", "entry_fee": 10, "drink_prices": "10-18", "opening_hours": "8pm-2am", "age_restriction": "18+", "neighborhood": "Arts District", "rating": 4.7}},
-    {{"name": "Latin Night Spot", "venue_type": "Dance Club", "music_types": ["Latin", "Reggaeton", "Salsa"], "description": "Hot Latin beats", "best_nights": "Friday, Saturday", "dress_code": "Casual", "entry_fee": 12, "drink_prices": "6-12", "opening_hours": "10pm-4am", "age_restriction": "18+", "neighborhood": "Downtown", "rating": 4.4}},
-    {{"name": "Rooftop Lounge", "venue_type": "Rooftop Bar", "music_types": ["Lounge", "Deep House", "Chill"], "description": "Stunning views and cocktails", "best_nights": "Any night", "dress_code": "Smart", "entry_fee": 0, "drink_prices": "12-20", "opening_hours": "6pm-2am", "age_restriction": "21+", "neighborhood": "City Center", "rating": 4.6}},
-    {{"name": "Underground Techno", "venue_type": "Underground Club", "music_types": ["Techno", "Industrial", "Minimal"], "description": "For serious techno lovers", "best_nights": "Friday, Saturday", "dress_code": "All black encouraged", "entry_fee": 20, "drink_prices": "8-12", "opening_hours": "midnight-8am", "age_restriction": "21+", "neighborhood": "Industrial Area", "rating": 4.8}},
-    {{"name": "Hip Hop Club", "venue_type": "Nightclub", "music_types": ["Hip-Hop", "R&B", "Rap"], "description": "Urban beats and vibes", "best_nights": "Friday, Saturday", "dress_code": "Streetwear/Smart", "entry_fee": 15, "drink_prices": "8-15", "opening_hours": "11pm-5am", "age_restriction": "18+", "neighborhood": "Trendy Area", "rating": 4.3}},
-    {{"name": "Rock Venue", "venue_type": "Live Music Venue", "music_types": ["Rock", "Indie", "Alternative"], "description": "Live bands nightly", "best_nights": "Wednesday-Saturday", "dress_code": "Casual", "entry_fee": 10, "drink_prices": "5-10", "opening_hours": "8pm-3am", "age_restriction": "18+", "neighborhood": "Music Quarter", "rating": 4.5}},
-    {{"name": "Commercial Club", "venue_type": "Mainstream Club", "music_types": ["Mixed", "Commercial", "Top 40", "EDM"], "description": "Popular hits all night", "best_nights": "Thursday-Saturday", "dress_code": "Smart casual", "entry_fee": 12, "drink_prices": "7-14", "opening_hours": "10pm-4am", "age_restriction": "18+", "neighborhood": "Main Strip", "rating": 4.2}}
+    {"name": "Club/Bar Name", "venue_type": "Nightclub/Rooftop Bar/Live Music Venue/Lounge", "music_types": ["House", "Techno"], "description": "What makes it special", "best_nights": "Friday, Saturday", "dress_code": "Smart casual", "entry_fee": 15, "drink_prices": "8-15", "opening_hours": "11pm-6am", "age_restriction": "21+", "neighborhood": "Nightlife District", "rating": 4.5},
+    {"name": "Jazz Club", "venue_type": "Jazz Club", "music_types": ["Jazz", "Blues"], "description": "Intimate live music", "best_nights": "Thursday-Saturday", "dress_code": "Smart casual", "entry_fee": 10, "drink_prices": "10-18", "opening_hours": "8pm-2am", "age_restriction": "18+", "neighborhood": "Arts District", "rating": 4.7},
+    {"name": "Latin Night Spot", "venue_type": "Dance Club", "music_types": ["Latin", "Reggaeton", "Salsa"], "description": "Hot Latin beats", "best_nights": "Friday, Saturday", "dress_code": "Casual", "entry_fee": 12, "drink_prices": "6-12", "opening_hours": "10pm-4am", "age_restriction": "18+", "neighborhood": "Downtown", "rating": 4.4},
+    {"name": "Rooftop Lounge", "venue_type": "Rooftop Bar", "music_types": ["Lounge", "Deep House", "Chill"], "description": "Stunning views and cocktails", "best_nights": "Any night", "dress_code": "Smart", "entry_fee": 0, "drink_prices": "12-20", "opening_hours": "6pm-2am", "age_restriction": "21+", "neighborhood": "City Center", "rating": 4.6},
+    {"name": "Underground Techno", "venue_type": "Underground Club", "music_types": ["Techno", "Industrial", "Minimal"], "description": "For serious techno lovers", "best_nights": "Friday, Saturday", "dress_code": "All black encouraged", "entry_fee": 20, "drink_prices": "8-12", "opening_hours": "midnight-8am", "age_restriction": "21+", "neighborhood": "Industrial Area", "rating": 4.8},
+    {"name": "Hip Hop Club", "venue_type": "Nightclub", "music_types": ["Hip-Hop", "R&B", "Rap"], "description": "Urban beats and vibes", "best_nights": "Friday, Saturday", "dress_code": "Streetwear/Smart", "entry_fee": 15, "drink_prices": "8-15", "opening_hours": "11pm-5am", "age_restriction": "18+", "neighborhood": "Trendy Area", "rating": 4.3},
+    {"name": "Rock Venue", "venue_type": "Live Music Venue", "music_types": ["Rock", "Indie", "Alternative"], "description": "Live bands nightly", "best_nights": "Wednesday-Saturday", "dress_code": "Casual", "entry_fee": 10, "drink_prices": "5-10", "opening_hours": "8pm-3am", "age_restriction": "18+", "neighborhood": "Music Quarter", "rating": 4.5},
+    {"name": "Commercial Club", "venue_type": "Mainstream Club", "music_types": ["Mixed", "Commercial", "Top 40", "EDM"], "description": "Popular hits all night", "best_nights": "Thursday-Saturday", "dress_code": "Smart casual", "entry_fee": 12, "drink_prices": "7-14", "opening_hours": "10pm-4am", "age_restriction": "18+", "neighborhood": "Main Strip", "rating": 4.2}
   ],
   "must_see_attractions": [
-    {{"name": "Top attraction", "why": "Why it's unmissable", "time_needed": "2-3 hours", "best_time": "Early morning", "cost": 20, "skip_if": "When to skip it"}}
+    {"name": "Top attraction", "why": "Why it's unmissable", "time_needed": "2-3 hours", "best_time": "Early morning", "cost": 20, "skip_if": "When to skip it"}
   ],
   "day_trips": [
-    {{"destination": "Nearby place", "distance": "1 hour by train", "highlights": "What to see", "cost": 50, "best_for": "Day trip on day X"}}
+    {"destination": "Nearby place", "distance": "1 hour by train", "highlights": "What to see", "cost": 50, "best_for": "Day trip on day X"}
   ],
-  "budget_summary": {{
+  "budget_summary": {
     "activities": 200,
     "food": 300,
     "transport": 75,
@@ -669,79 +2256,754 @@ JSON Structure (copy this exactly):
     "budget_version": 600,
     "comfort_version": 1000,
     "luxury_version": 1800
-  }}
-}}
+  }
+}
+
+MUST include every day the request asks for, with all time slots.
+MUST include 8-12 nightlife venues with VARIED music types (electronic, techno, hip-hop, latin, rock, jazz, mixed/commercial, rooftop/lounge).
+Plan activities appropriate for each specific day of week."""
+
+# Trip type specific guidance
+TRIP_TYPE_GUIDANCE = {
+    'leisure': 'balanced mix of sightseeing, relaxation, and local experiences',
+    'business': 'efficient itinerary with good restaurants for meetings, quieter evenings',
+    'adventure': 'active experiences, outdoor activities, unique thrills',
+    'romantic': 'intimate venues, scenic spots, special dining experiences',
+    'family': 'kid-friendly activities, parks, interactive museums, early dinners',
+    'nightlife': 'late starts, focus on evening/night activities, clubs and bars',
+    'cultural': 'museums, galleries, historic sites, local traditions',
+    'foodie': 'food tours, cooking classes, market visits, best restaurants'
+}
+
+class TravelPlanningAgent:
+    def __init__(self):
+        self.serpapi_key = os.environ.get("SERPAPI_KEY")
+        self.serpapi = SerpApiClient()
+        self.flight_cache = SearchCache(max_entries=FLIGHT_CACHE_SIZE)
+        self.hotel_cache = SearchCache(max_entries=HOTEL_CACHE_SIZE)
+        self.itinerary_first_token = LatencyTracker()
+        self.itinerary_usage = TokenUsage()
+        self.itinerary_cache = itinerary_cache
+        self.inflight = SingleFlight()
+        # Itinerary generations that may outlive their request (see ITINERARY_DEADLINE)
+        self.itinerary_pool = ThreadPoolExecutor(max_workers=ITINERARY_BACKGROUND_WORKERS, thread_name_prefix="itinerary")
+        # One slot per pool thread: work is only submitted when a thread is free
+        self.itinerary_slots = threading.BoundedSemaphore(ITINERARY_BACKGROUND_WORKERS)
+        
+    def search_flights(self, origin, destination, outbound_date, return_date=None, currency="GBP"):
+        """Search flights with detailed times and prices (cached per route and dates)"""
+        key = (origin, destination, outbound_date, return_date, currency)
+        return self.flight_cache.get_or_fetch(
+            key,
+            lambda: self.inflight.do(
+                ("flights",) + key,
+                lambda: self._fetch_flights(origin, destination, outbound_date, return_date, currency)
+            ),
+            flight_cache_ttl(outbound_date),
+            should_cache=lambda result: "error" not in result
+        )
+
+    def _fetch_flights(self, origin, destination, outbound_date, return_date=None, currency="GBP"):
+        """Query SerpApi google_flights directly, bypassing the cache"""
+        try:
+            return self.serpapi.get(self._flight_params(origin, destination, outbound_date, return_date, currency))
+        except Exception as e:
+            log.warning("Flight search error: %s", e)
+            return {"error": str(e)}
+
+    def _flight_params(self, origin, destination, outbound_date, return_date=None, currency="GBP"):
+        params = {
+            "engine": "google_flights",
+            "departure_id": origin,
+            "arrival_id": destination,
+            "outbound_date": outbound_date,
+            "currency": currency,
+            "hl": "en",
+            "api_key": self.serpapi_key
+        }
+        
+        if return_date:
+            params["return_date"] = return_date
+            params["type"] = "1"
+
+        return params
+    
+    def search_hotels(self, destination_code, check_in, check_out):
+        """Search hotels with images and detailed info (cached per city and dates)"""
+        key = (destination_code, check_in, check_out)
+        return self.hotel_cache.get_or_fetch(
+            key,
+            lambda: self.inflight.do(
+                ("hotels",) + key,
+                lambda: self._fetch_hotels(destination_code, check_in, check_out)
+            ),
+            flight_cache_ttl(check_in),
+            should_cache=lambda result: "error" not in result
+        )
+
+    def _fetch_hotels(self, destination_code, check_in, check_out):
+        city_name = get_city_name(destination_code)
+        log.debug("Searching hotels for %s", city_name)
+        
+        try:
+            result = self.serpapi.get(self._hotel_params(city_name, check_in, check_out))
+            log.debug("Hotel API returned %d properties", len(result.get('properties', [])))
+            return result
+        except Exception as e:
+            log.warning("Hotel search error: %s", e)
+            return {"error": str(e)}
+
+    def _hotel_params(self, city_name, check_in, check_out):
+        return {
+            "engine": "google_hotels",
+            "q": city_name,
+            "check_in_date": check_in,
+            "check_out_date": check_out,
+            "currency": "GBP",
+            "gl": "uk",
+            "hl": "en",
+            "api_key": self.serpapi_key
+        }
+    
+    def search_airbnb(self, destination_code, check_in, check_out):
+        """Search Airbnb listings (identical in-flight searches are shared)"""
+        return self.inflight.do(
+            ("airbnb", destination_code, check_in, check_out),
+            lambda: self._fetch_airbnb(destination_code, check_in, check_out)
+        )
+
+    def _fetch_airbnb(self, destination_code, check_in, check_out):
+        city_name = get_city_name(destination_code)
+        check_in_date = datetime.strptime(check_in, "%Y-%m-%d")
+        check_out_date = datetime.strptime(check_out, "%Y-%m-%d")
+        nights = (check_out_date - check_in_date).days
+        
+        try:
+            results = self.serpapi.get(self._airbnb_params(city_name))
+            return self._parse_airbnb_results(results, nights)
+        except Exception as e:
+            log.warning("Airbnb search error: %s", e)
+            return []
+
+    def _airbnb_params(self, city_name):
+        return {
+            "engine": "google",
+            "q": f"airbnb {city_name}",
+            "api_key": self.serpapi_key,
+            "num": 10
+        }
+
+    def _parse_airbnb_results(self, results, nights):
+        """Pick Airbnb links out of a google search response"""
+        airbnb_listings = []
+        if "organic_results" in results:
+            for result in results["organic_results"][:8]:
+                if "airbnb" in result.get("link", "").lower():
+                    airbnb_listings.append({
+                        "name": result.get("title", "Airbnb Listing"),
+                        "description": result.get("snippet", ""),
+                        "link": result.get("link", "#"),
+                        "price_per_night": "50-150",
+                        "total_price": f"{nights * 75}",
+                        "type": "Entire home/Private room"
+                    })
+        
+        return airbnb_listings
+    
+    def analyze_flexible_dates(self, origin, destination, start_date, return_date, days_range=None, max_concurrency=None, on_date=None, budget=None, max_calls=None):
+        """Search flights across flexible dates around the requested ones.
+
+        Metro-area codes (LON, PAR...) are searched at each of their airports.
+        Searches run best bets first in concurrent rounds (see
+        FlexibleDateSearch) and stop as soon as more are unlikely to turn up
+        better fares, so most requests only spend a few SerpApi calls.
+        Results are merged back in date order. If given,
+        ``on_date(search_date, search_return, flights)`` is called as each
+        search's results arrive, in completion order.
+        """
+        search = self._flexible_search(origin, destination, start_date, return_date, days_range, budget, max_calls)
+        by_search = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency or FLIGHT_SEARCH_CONCURRENCY, search.round_size))) as executor:
+            for batch in iter(search.next_round, []):
+                futures = {executor.submit(in_context(self.search_flights), *route): route for route in batch}
+                round_results = {}
+                for future in as_completed(futures):
+                    route = futures[future]
+                    date_results = self._extract_date_results(future.result(), *route)
+                    by_search[route] = round_results[route] = date_results
+                    if on_date:
+                        on_date(route[2], route[3], date_results)
+                search.add_round(round_results)
+
+        return self._merge_flexible_results(search, by_search)
+
+    def estimate_flight_cost(self, origin, destination, outbound_date, return_date):
+        """Cheapest fare on the requested dates at the main airports.
+
+        This is the first search analyze_flexible_dates makes, so it shares
+        that call (in flight or cached) rather than adding one.
+        """
+        route = self._requested_route(origin, destination, outbound_date, return_date)
+        return self._cheapest_fare(self._extract_date_results(self.search_flights(*route), *route))
+
+    @staticmethod
+    def _requested_route(origin, destination, outbound_date, return_date):
+        _, search_origin, search_destination = airport_pairs(origin, destination)[0]
+        return search_origin, search_destination, outbound_date, return_date
+
+    @staticmethod
+    def _cheapest_fare(flights):
+        return min((f.price for f in flights if isinstance(f.price, (int, float))), default=0)
+
+    def _flexible_search(self, origin, destination, start_date, return_date, days_range=None, budget=None, max_calls=None):
+        """FlexibleDateSearch over every airport pair and date pair for a route.
+
+        Searches are ordered by how far the dates are from the requested ones
+        plus how far down their metro area's list the airports are, so the
+        main airports on the requested dates go first and minor airports on
+        far-off dates last. Routes with several airport pairs share
+        METRO_MAX_CALLS calls in rounds of METRO_ROUND_SIZE.
+        """
+        pairs = airport_pairs(origin, destination)
+        ranked = sorted(
+            (
+                (date_rank + pair_rank, (search_origin, search_destination, search_date, search_return))
+                for date_rank, (search_date, search_return) in enumerate(self._flexible_search_dates(start_date, return_date, days_range))
+                for pair_rank, search_origin, search_destination in pairs
+            ),
+            key=lambda ranked_search: ranked_search[0]
+        )
+        multi_airport = len(pairs) > 1
+        if max_calls is None and multi_airport:
+            max_calls = METRO_MAX_CALLS
+        return FlexibleDateSearch(
+            [route for _, route in ranked], budget=budget, max_calls=max_calls,
+            round_size=METRO_ROUND_SIZE if multi_airport else FLEX_ROUND_SIZE
+        )
+
+    def _merge_flexible_results(self, search, by_search):
+        log.info("Flexible dates: %d searches (%s)", search.calls, search.stop_reason,
+                 extra={"searches": search.calls, "stop_reason": search.stop_reason})
+
+        # Merge back in date order regardless of search order
+        routes = sorted(by_search, key=lambda route: (route[2], route[0], route[1]))
+        return [flight for route in routes for flight in by_search[route]]
+
+    def _flexible_search_dates(self, start_date, return_date, days_range=None):
+        """(outbound, return) date pairs to search around the requested dates, nearest first"""
+        if days_range is None:
+            days_range = FLEX_DAYS_RANGE
+        base_date = datetime.strptime(start_date, "%Y-%m-%d")
+
+        if return_date:
+            return_date_obj = datetime.strptime(return_date, "%Y-%m-%d")
+
+        # Search before and after the selected date for more flexibility,
+        # closest to what was asked for first: 0, +1, -1, +2, -2, ...
+        search_offsets = sorted(range(-3, days_range + 1), key=lambda i: (abs(i), i < 0))
+
+        search_dates = []
+        for i in search_offsets:
+            search_date = (base_date + timedelta(days=i)).strftime("%Y-%m-%d")
+            # Skip past dates
+            if datetime.strptime(search_date, "%Y-%m-%d") < datetime.now():
+                continue
+
+            search_return = (return_date_obj + timedelta(days=i)).strftime("%Y-%m-%d") if return_date else None
+            search_dates.append((search_date, search_return))
+
+        return search_dates
+
+    def _extract_date_results(self, flight_data, origin, destination, search_date, search_return):
+        """Pick the flights worth keeping out of one date's google_flights response"""
+        results = []
+
+        # Process best_flights
+        if "best_flights" in flight_data:
+            for flight in flight_data.get("best_flights", [])[:5]:  # Get top 5 from each day
+                flight_details = self._extract_flight_details(flight, origin, destination, search_date, search_return)
+                if flight_details:
+                    results.append(flight_details)
+
+        # Also check other_flights for budget options
+        if "other_flights" in flight_data:
+            for flight in flight_data.get("other_flights", [])[:3]:  # Get top 3 budget options
+                flight_details = self._extract_flight_details(flight, origin, destination, search_date, search_return)
+                if flight_details:
+                    results.append(flight_details)
+
+        return results
+
+    def _extract_flight_details(self, flight, origin, destination, search_date, search_return):
+        """Extract a FlightRecord from an API response - handles both outbound and return flights"""
+        flights_info = flight.get("flights", [])
+
+        if not flights_info or not flight.get("price"):
+            return None
+
+        # For round trips, Google Flights API returns legs in the flights array
+        # Outbound segments go from origin to destination
+        # Return segments go from destination to origin
+        #
+        # Everything is worked out in one walk over the segments. Once the
+        # outbound leg has started, segments stay outbound; a return leg is only
+        # recognised when the first segment leaves from the destination, and
+        # after that only an origin -> destination segment counts as outbound.
+
+        outbound_first = return_first = {}
+        outbound_departure = outbound_arrival_info = return_departure = return_arrival_info = {}
+        outbound_count = return_count = 0
+        outbound_duration = return_duration = 0
+        outbound_layovers = []
+        return_layovers = []
+        outbound_last_airport = return_last_airport = ""
+        primary_airline = None
+
+        for segment in flights_info:
+            departure = segment.get("departure_airport", {})
+            arrival = segment.get("arrival_airport", {})
+            dep_airport = departure.get("id", "")
+            arr_airport = arrival.get("id", "")
+
+            if return_count:
+                is_outbound = dep_airport == origin and arr_airport == destination
+            else:
+                is_outbound = outbound_count or dep_airport == origin or dep_airport != destination
+
+            if is_outbound:
+                if outbound_count:
+                    # The previous segment's arrival is a layover
+                    if outbound_last_airport:
+                        outbound_layovers.append(outbound_last_airport)
+                else:
+                    outbound_first = segment
+                    outbound_departure = departure
+                outbound_arrival_info = arrival
+                outbound_last_airport = arr_airport
+                outbound_count += 1
+                outbound_duration += segment.get("duration", 0)
+                if primary_airline is None and segment.get("airline"):
+                    primary_airline = segment["airline"]
+            else:
+                if return_count:
+                    if return_last_airport:
+                        return_layovers.append(return_last_airport)
+                else:
+                    return_first = segment
+                    return_departure = departure
+                return_arrival_info = arrival
+                return_last_airport = arr_airport
+                return_count += 1
+                return_duration += segment.get("duration", 0)
+
+        # Determine airline (use most prominent or first)
+        primary_airline = primary_airline or "Multiple Airlines"
+        airline_logo = outbound_first.get("airline_logo", "")
+
+        return FlightRecord(
+            search_origin=origin,
+            search_destination=destination,
+            outbound_date=search_date,
+            return_date=search_return,
+            price=flight.get("price"),
+            total_duration=flight.get("total_duration"),
+
+            # Outbound flight details
+            airline=primary_airline,
+            airline_logo=airline_logo,
+            outbound_departure_time=outbound_departure.get("time", ""),
+            outbound_arrival_time=outbound_arrival_info.get("time", ""),
+            outbound_departure_airport=outbound_departure.get("id", origin),
+            outbound_arrival_airport=outbound_arrival_info.get("id", destination),
+            outbound_duration=outbound_duration if outbound_duration else outbound_first.get("duration"),
+            outbound_stops=max(outbound_count - 1, 0),
+            outbound_layovers=outbound_layovers,
+
+            # Return/Inbound flight details
+            return_departure_time=return_departure.get("time", ""),
+            return_arrival_time=return_arrival_info.get("time", ""),
+            return_departure_airport=return_departure.get("id", destination) if return_first else "",
+            return_arrival_airport=return_arrival_info.get("id", origin) if return_first else "",
+            return_duration=return_duration if return_duration else (return_first.get("duration") if return_first else ""),
+            return_stops=max(return_count - 1, 0),
+            return_layovers=return_layovers,
+            return_airline=return_first.get("airline", primary_airline) if return_first else "",
+
+            # Booking and metadata (the booking link and combined layovers are derived)
+            flight_number=outbound_first.get("flight_number", ""),
+            airplane=outbound_first.get("airplane", ""),
+            carbon_emissions=flight.get("carbon_emissions", {}).get("this_flight"),
+            is_overnight=outbound_first.get("overnight", False),
+            is_round_trip=bool(search_return and return_count)
+        )
+    
+    def create_structured_itinerary(self, destination_code, keywords, budget, duration_days, hotels, days_info=None, trip_type='leisure', on_section=None, deadline=None):
+        """GUARANTEED itinerary generation - ALWAYS returns complete data with day-of-week awareness.
+
+        Complete model replies are cached on disk by normalized trip parameters.
+        The reply is streamed; if ``on_section(path, value)`` is given it is called
+        with each day, restaurant list and nightlife venue as soon as it is complete.
+        With a ``deadline`` (seconds) a slow model call is not waited for: the
+        fallback itinerary is returned with an ``upgrade`` link instead (see
+        _missed_deadline).
+        """
+        city_name, cache_key = self._start_itinerary(destination_code, keywords, budget, duration_days, days_info, trip_type)
+
+        cached = self.itinerary_cache.get(cache_key)
+        if cached is not None:
+            log.info("Itinerary cache hit")
+            self._complete_itinerary(cached, city_name, duration_days)
+            return cached
+
+        relay = SectionRelay(on_section) if deadline and on_section else None
+
+        # Identical trips already being generated share that call's result
+        def generate():
+            return self.inflight.do(
+                ("itinerary", cache_key),
+                lambda: self._generate_complete_itinerary(
+                    city_name, cache_key, keywords, budget, duration_days, hotels, days_info, trip_type, relay or on_section
+                )
+            )
+
+        try:
+            if not deadline:
+                return generate()
+
+            if not self.itinerary_slots.acquire(blocking=False):
+                log.warning("Itinerary pool saturated - generating without the %.1fs deadline", deadline)
+                ITINERARY_POOL_SATURATED.inc()
+                return generate()
+
+            future = self.itinerary_pool.submit(in_context(generate))
+            future.add_done_callback(lambda done: self.itinerary_slots.release())
+            try:
+                return future.result(timeout=deadline)
+            except FutureTimeout:
+                if relay:
+                    relay.close()
+                token = self._missed_deadline(deadline)
+                future.add_done_callback(lambda done: resolve_upgrade(token, done))
+                return self._upgradable_fallback(city_name, duration_days, token)
+        except Exception as e:
+            return self._failed_itinerary(city_name, duration_days, e)
+
+    def _failed_itinerary(self, city_name, duration_days, error):
+        log.error("Error creating itinerary, using complete fallback: %s", error)
+        ITINERARY_FALLBACKS.inc("itinerary")
+        return self._get_fallback_itinerary(city_name, duration_days)
+
+    def _missed_deadline(self, deadline):
+        """Record a generation that overran its deadline and return its upgrade token"""
+        log.warning("Itinerary not ready within %.1fs - answering with the fallback", deadline)
+        ITINERARY_FALLBACKS.inc("deadline")
+        return itinerary_upgrades.add()
+
+    def _upgradable_fallback(self, city_name, duration_days, token):
+        """The fallback itinerary, pointing at where the real one will appear"""
+        itinerary_data = self._get_fallback_itinerary(city_name, duration_days)
+        itinerary_data["upgrade"] = upgrade_link(token)
+        return itinerary_data
+
+    def _generate_complete_itinerary(self, city_name, cache_key, keywords, budget, duration_days, hotels, days_info, trip_type, on_section=None):
+        """Generate, check and cache an itinerary; raises if the model call fails
+        (callers answer with the fallback, or fail the upgrade past a deadline)"""
+        if duration_days > ITINERARY_CHUNK_THRESHOLD:
+            itinerary_data, complete = self._generate_itinerary_chunked(
+                city_name, keywords, budget, duration_days, hotels, days_info, trip_type, on_section
+            )
+        else:
+            prompt = self._build_itinerary_prompt(city_name, keywords, budget, duration_days, hotels, days_info, trip_type)
+            itinerary_data, complete = self._generate_itinerary(prompt, on_section), True
+
+        return self._finish_itinerary(itinerary_data, complete, city_name, duration_days, cache_key)
+
+    def _start_itinerary(self, destination_code, keywords, budget, duration_days, days_info, trip_type):
+        """Log the request and return ``(city_name, cache_key)``"""
+        city_name = get_city_name(destination_code)
+
+        log.info("Creating %d-day %s itinerary for %s", duration_days, trip_type, city_name,
+                 extra={"budget": budget, "keywords": keywords})
+
+        return city_name, itinerary_cache_key(city_name, duration_days, trip_type, keywords, days_info, budget)
+
+    def _finish_itinerary(self, itinerary_data, complete, city_name, duration_days, cache_key):
+        """Validate a generated itinerary and cache it if nothing had to be filled in"""
+        if self._complete_itinerary(itinerary_data, city_name, duration_days) and complete:
+            self.itinerary_cache.put(cache_key, itinerary_data)
+
+        self._print_itinerary_summary(itinerary_data)
+
+        return itinerary_data
+
+    def _build_itinerary_prompt(self, city_name, keywords, budget, duration_days, hotels, days_info, trip_type):
+        """Build the per-request part of the itinerary prompt"""
+        return f"""Create a {duration_days}-day travel itinerary for {city_name}.
+Use "{city_name}" as overview.destination and include EXACTLY {duration_days} days in daily_itinerary.
+{self._itinerary_context(keywords, budget, hotels, days_info, trip_type)}"""
+
+    def _build_sections_prompt(self, city_name, keywords, budget, duration_days, hotels, trip_type):
+        """Prompt for every section of a chunked itinerary except the days"""
+        return f"""Create the trip-wide sections of a {duration_days}-day travel itinerary for {city_name}.
+Use "{city_name}" as overview.destination. The days are planned in separate requests, so return
+daily_itinerary as an empty array and every other section in full.
+{self._itinerary_context(keywords, budget, hotels, None, trip_type)}"""
+
+    def _build_days_prompt(self, city_name, keywords, budget, duration_days, hotels, days_info, trip_type, first, last):
+        """Prompt for days ``first``..``last`` of a chunked itinerary"""
+        return f"""Plan days {first} to {last} of a {duration_days}-day trip to {city_name}.
+Return ONLY {{"daily_itinerary": [...]}} with EXACTLY {last - first + 1} days, numbered {first} to {last}
+("day": {first} first), and no other keys.
+{self._itinerary_context(keywords, budget, hotels, days_info, trip_type)}"""
+
+    def _itinerary_context(self, keywords, budget, hotels, days_info, trip_type):
+        """Trip details shared by every itinerary prompt: days, trip type, interests, budget, hotels"""
+        # Build hotel context
+        hotel_info = ""
+        if hotels and "properties" in hotels:
+            top_hotels = hotels["properties"][:3]
+            hotel_info = "\n\nTop Hotels:\n"
+            for hotel in top_hotels:
+                hotel_info += f"- {hotel.get('name', 'N/A')}: £{hotel.get('rate_per_night', {}).get('lowest', 'N/A')}/night\n"
+
+        # Build day-of-week context
+        days_context = ""
+        if days_info:
+            days_context = "\n\nSPECIFIC DAYS (plan activities appropriate for each day):\n"
+            for d in days_info:
+                weekend_note = "WEEKEND - more nightlife, brunches, leisure activities" if d['is_weekend'] else "WEEKDAY - some venues may be closed, but fewer crowds"
+                days_context += f"- Day {d['day']}: {d['weekday']} ({d['date']}) - {weekend_note}\n"
+
+        trip_guidance = TRIP_TYPE_GUIDANCE.get(trip_type, 'balanced mix of activities')
+
+        # Per-request part of the prompt - everything else is in the cached prefix
+        return f"""{days_context}
+Trip type: {trip_type.upper()} - Focus on {trip_guidance}
+
+User interests: {', '.join(keywords)}
+Budget: £{budget}
+Trip type: {trip_type}
+{hotel_info}
+Respond with ONLY the JSON object."""
+
+    def _generate_itinerary_chunked(self, city_name, keywords, budget, duration_days, hotels, days_info, trip_type, on_section=None):
+        """Generate a long itinerary as concurrent model calls and merge them.
+
+        One call produces everything except the days, and one call per group of
+        ITINERARY_CHUNK_DAYS days produces those days, so wall-clock time stays
+        roughly flat as trips get longer. Returns ``(itinerary, complete)`` where
+        ``complete`` is False if any day group had to be filled with placeholders.
+        """
+        jobs = self._itinerary_chunk_jobs(city_name, keywords, budget, duration_days, hotels, days_info, trip_type, on_section)
+
+        def run(prompt, callback):
+            try:
+                return self._generate_itinerary(prompt, callback)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            replies = list(executor.map(in_context(lambda job: run(job[1], job[2])), jobs))
+
+        return self._merge_itinerary_chunks(city_name, jobs, replies)
+
+    def _itinerary_chunk_jobs(self, city_name, keywords, budget, duration_days, hotels, days_info, trip_type, on_section=None):
+        """Split a long trip into ``(day_range, prompt, on_section)`` model calls.
+
+        The first job (``day_range`` None) covers every section except the days;
+        the rest each cover one group of ITINERARY_CHUNK_DAYS days.
+        """
+        groups = [
+            (first, min(first + ITINERARY_CHUNK_DAYS - 1, duration_days))
+            for first in range(1, duration_days + 1, ITINERARY_CHUNK_DAYS)
+        ]
+        log.debug("Long trip - generating in %d parallel parts", len(groups) + 1)
+
+        callback = None
+        if on_section:
+            callback = lambda path, value: on_section(path, value) if path[0] != "daily_itinerary" else None
+        jobs = [(None, self._build_sections_prompt(city_name, keywords, budget, duration_days, hotels, trip_type), callback)]
+
+        for first, last in groups:
+            group_days = [d for d in days_info if first <= d['day'] <= last] if days_info else None
+            callback = None
+            if on_section:
+                callback = lambda path, value, offset=first - 1: (
+                    on_section(["daily_itinerary", offset + path[1]], value)
+                    if path[0] == "daily_itinerary" and len(path) == 2 else None
+                )
+            jobs.append(((first, last), self._build_days_prompt(
+                city_name, keywords, budget, duration_days, hotels, group_days, trip_type, first, last
+            ), callback))
+
+        return jobs
 
-MUST include {duration_days} complete days with all time slots.
-MUST include 8-12 nightlife venues with VARIED music types (electronic, techno, hip-hop, latin, rock, jazz, mixed/commercial, rooftop/lounge).
-Plan activities appropriate for each specific day of week.
+    def _merge_itinerary_chunks(self, city_name, jobs, replies):
+        """Merge chunked replies (parsed dicts, or the exception a call raised) into one itinerary"""
+        complete = True
+        itinerary_data = None
+        daily_itinerary = []
 
-User interests: {', '.join(keywords)}
-Budget: £{budget}
-Trip type: {trip_type}
-{hotel_info}
+        for (day_range, _, _), reply in zip(jobs, replies):
+            if day_range is None:
+                if isinstance(reply, Exception):
+                    log.warning("Error generating overview sections: %s", reply)
+                    ITINERARY_FALLBACKS.inc("sections")
+                    complete = False
+                    itinerary_data = self._get_fallback_itinerary(city_name, 0)
+                else:
+                    itinerary_data = reply
+                continue
+
+            first, last = day_range
+            if isinstance(reply, Exception):
+                log.warning("Error generating days %d-%d: %s", first, last, reply)
+                days = {}
+            else:
+                days = self._group_days(reply.get("daily_itinerary"), first, last)
 
-Respond with ONLY the JSON object above."""
+            missing = last - first + 1 - len(days)
+            if missing:
+                log.warning("Only %d of days %d-%d generated - filling gaps", len(days), first, last)
+                GAP_FILLED_DAYS.inc(amount=missing)
+                complete = False
+                defaults = self._get_default_itinerary(city_name, last)
+                days = {number: days.get(number) or defaults[number - 1] for number in range(first, last + 1)}
+            daily_itinerary.extend(days[number] for number in range(first, last + 1))
+
+        itinerary_data["daily_itinerary"] = daily_itinerary
+        return itinerary_data, complete
+
+    @staticmethod
+    def _group_days(reply_days, first, last):
+        """A day group's reply as ``{day number: day}``, keeping only days first..last.
+
+        Days are placed by their own "day" number, so a reply that starts from
+        day 1 again is not relabelled as the group's days; unnumbered days are
+        placed by position.
+        """
+        days = {}
+        for position, day in enumerate(reply_days if isinstance(reply_days, list) else []):
+            if not isinstance(day, dict):
+                continue
+            try:
+                number = int(day.get("day"))
+            except (TypeError, ValueError):
+                number = first + position
+            if first <= number <= last and number not in days:
+                day["day"] = number
+                days[number] = day
+        return days
+
+    def _generate_itinerary(self, prompt, on_section=None):
+        """Stream one itinerary reply from Claude and parse it into a dict"""
+        parser = IncrementalJSONParser(on_section, is_itinerary_section) if on_section else None
+        chunks = []
+        started = time.perf_counter()
+
+        def call():
+            with client.beta.prompt_caching.messages.stream(**self._itinerary_request(prompt)) as stream:
+                for text in stream.text_stream:
+                    if not chunks:
+                        self._record_first_token(time.perf_counter() - started)
+                    chunks.append(text)
+                    if parser:
+                        parser.feed(text)
+                return stream.get_final_message().usage
+
+        usage = upstream_call("anthropic", "messages", call, failed_error=anthropic_unavailable)
+        self._record_itinerary_usage(usage)
+        return self._parse_itinerary_text("".join(chunks))
+
+    def _itinerary_request(self, prompt):
+        """Anthropic request arguments: cached static prefix as system, per-trip prompt as user message"""
+        return {
+            "model": "claude-sonnet-4-20250514",
+            "max_tokens": 4000,
+            "system": [{"type": "text", "text": ITINERARY_PROMPT_PREFIX, "cache_control": {"type": "ephemeral"}}],
+            "messages": [{"role": "user", "content": prompt}]
+        }
+
+    def _record_first_token(self, first_token):
+        self.itinerary_first_token.record(first_token)
+        CLAUDE_FIRST_TOKEN_SECONDS.observe(first_token)
+        log.debug("First token after %.2fs", first_token)
+
+    def _record_itinerary_usage(self, usage):
+        self.itinerary_usage.record(usage)
+        log.debug("Tokens: input=%s output=%s cache_write=%s cache_read=%s", usage.input_tokens, usage.output_tokens,
+                  usage.cache_creation_input_tokens or 0, usage.cache_read_input_tokens or 0)
+
+    def _parse_itinerary_text(self, response_text):
+        with ITINERARY_PARSE_SECONDS.time():
+            response_text = response_text.strip()
 
-        try:
-            message = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=4000,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            response_text = message.content[0].text.strip()
-            
             # Clean response
             if "```json" in response_text:
                 response_text = response_text.split("```json")[1].split("```")[0].strip()
             elif "```" in response_text:
                 response_text = response_text.split("```")[1].split("```")[0].strip()
-            
+
             # Parse JSON
-            itinerary_data = json.loads(response_text)
-            
-            # CRITICAL VALIDATION
-            if "daily_itinerary" not in itinerary_data or not itinerary_data["daily_itinerary"]:
-                print("❌ NO daily_itinerary - using fallback")
-                itinerary_data["daily_itinerary"] = self._get_default_itinerary(city_name, duration_days)
-            else:
-                # Check we have enough days
-                if len(itinerary_data["daily_itinerary"]) < duration_days:
-                    print(f"⚠️ Only {len(itinerary_data['daily_itinerary'])} days, need {duration_days} - filling gaps")
-                    current_days = len(itinerary_data["daily_itinerary"])
-                    for extra_day in range(current_days + 1, duration_days + 1):
-                        itinerary_data["daily_itinerary"].append({
-                            "day": extra_day,
-                            "theme": f"Day {extra_day} Exploration",
-                            "morning": {"time": "9:00 AM", "activity": "Morning exploration", "description": f"Explore {city_name}", "cost": 15, "duration": "2-3 hours", "location": "City Center"},
-                            "afternoon": {"time": "2:00 PM", "activity": "Afternoon activity", "description": "Continue exploring", "cost": 20, "duration": "3 hours", "location": "Main area"},
-                            "evening": {"time": "7:00 PM", "activity": "Evening entertainment", "description": "Dinner and relaxation", "cost": 30, "duration": "2 hours", "location": "Evening district"},
-                            "daily_total": 65
-                        })
-            
-            if "restaurants" not in itinerary_data or not itinerary_data["restaurants"]:
-                print("❌ NO restaurants - using fallback")
-                itinerary_data["restaurants"] = self._get_default_restaurants(city_name)
-
-            if "nightlife" not in itinerary_data or not itinerary_data["nightlife"]:
-                print("❌ NO nightlife - using fallback")
-                itinerary_data["nightlife"] = self._get_default_nightlife(city_name)
-
-            print(f"✅ Itinerary created successfully:")
-            print(f"   - Days: {len(itinerary_data['daily_itinerary'])}")
-            print(f"   - Breakfast: {len(itinerary_data['restaurants'].get('breakfast', []))}")
-            print(f"   - Lunch: {len(itinerary_data['restaurants'].get('lunch', []))}")
-            print(f"   - Dinner: {len(itinerary_data['restaurants'].get('dinner', []))}")
-            print(f"   - Nightlife: {len(itinerary_data.get('nightlife', []))}")
-
-            return itinerary_data
-            
-        except Exception as e:
-            print(f"❌ Error creating itinerary: {e}")
-            print("Using complete fallback...")
-            return self._get_fallback_itinerary(city_name, duration_days)
-    
+            return json.loads(response_text)
+
+    def _print_itinerary_summary(self, itinerary_data):
+        if not log.isEnabledFor(logging.DEBUG):
+            return
+        log.debug(
+            "Itinerary created: %d days, %d breakfast, %d lunch, %d dinner, %d nightlife",
+            len(itinerary_data['daily_itinerary']),
+            len(itinerary_data['restaurants'].get('breakfast', [])),
+            len(itinerary_data['restaurants'].get('lunch', [])),
+            len(itinerary_data['restaurants'].get('dinner', [])),
+            len(itinerary_data.get('nightlife', []))
+        )
+
+    def _complete_itinerary(self, itinerary_data, city_name, duration_days):
+        """Fill any missing days, restaurants or nightlife in place.
+
+        Returns True if nothing had to be filled in.
+        """
+        complete = True
+
+        # CRITICAL VALIDATION
+        if "daily_itinerary" not in itinerary_data or not itinerary_data["daily_itinerary"]:
+            log.warning("No daily_itinerary - using fallback")
+            GAP_FILLED_DAYS.inc(amount=duration_days)
+            complete = False
+            itinerary_data["daily_itinerary"] = self._get_default_itinerary(city_name, duration_days)
+        else:
+            # Check we have enough days
+            if len(itinerary_data["daily_itinerary"]) < duration_days:
+                log.warning("Only %d days, need %d - filling gaps", len(itinerary_data['daily_itinerary']), duration_days)
+                current_days = len(itinerary_data["daily_itinerary"])
+                GAP_FILLED_DAYS.inc(amount=duration_days - current_days)
+                complete = False
+                for extra_day in range(current_days + 1, duration_days + 1):
+                    itinerary_data["daily_itinerary"].append({
+                        "day": extra_day,
+                        "theme": f"Day {extra_day} Exploration",
+                        "morning": {"time": "9:00 AM", "activity": "Morning exploration", "description": f"Explore {city_name}", "cost": 15, "duration": "2-3 hours", "location": "City Center"},
+                        "afternoon": {"time": "2:00 PM", "activity": "Afternoon activity", "description": "Continue exploring", "cost": 20, "duration": "3 hours", "location": "Main area"},
+                        "evening": {"time": "7:00 PM", "activity": "Evening entertainment", "description": "Dinner and relaxation", "cost": 30, "duration": "2 hours", "location": "Evening district"},
+                        "daily_total": 65
+                    })
+        
+        if "restaurants" not in itinerary_data or not itinerary_data["restaurants"]:
+            log.warning("No restaurants - using fallback")
+            ITINERARY_FALLBACKS.inc("restaurants")
+            complete = False
+            itinerary_data["restaurants"] = self._get_default_restaurants(city_name)
+
+        if "nightlife" not in itinerary_data or not itinerary_data["nightlife"]:
+            log.warning("No nightlife - using fallback")
+            ITINERARY_FALLBACKS.inc("nightlife")
+            complete = False
+            itinerary_data["nightlife"] = self._get_default_nightlife(city_name)
+
+        return complete
+
     def _get_default_restaurants(self, city_name):
         """Fallback restaurant data"""
         return {
@@ -890,7 +3152,17 @@ Respond with ONLY the JSON object above."""
         return itinerary
     
     def _get_fallback_itinerary(self, city_name, duration_days):
-        """Complete fallback structure with enhanced options"""
+        """Complete fallback structure with enhanced options.
+
+        Built once per city and duration and shared between requests, so only
+        the top level is copied: callers may set keys on the result but must
+        not change the lists and dicts it holds. (A deep copy costs more than
+        building the template afresh.)
+        """
+        return dict(self._fallback_template(city_name, duration_days))
+
+    @functools.lru_cache(maxsize=FALLBACK_TEMPLATE_CACHE_SIZE)
+    def _fallback_template(self, city_name, duration_days):
         return {
             "overview": {
                 "destination": city_name,
@@ -931,27 +3203,263 @@ Respond with ONLY the JSON object above."""
             }
         }
     
-    def find_best_value_flights(self, flight_results):
-        """Sort and filter flights by value - returns more options"""
+    def find_best_value_flights(self, flight_results, ranking=None, limit=FLIGHT_RESULTS_LIMIT):
+        """Rank FlightRecords and return the best ``limit`` options.
+
+        ``ranking`` is one of FLIGHT_RANKING_MODES:
+        - "price": cheapest first
+        - "value": lowest flight_value_score first, so a slightly dearer direct
+          flight can beat a cheap one with two stops
+        - "pareto": only flights not beaten on price, duration and stops at
+          once, best value first
+        """
         if not flight_results:
             return []
 
-        # Remove duplicates based on price and times
+        ranking = ranking or FLIGHT_RANKING
+        unique_flights = self._unique_flights(flight_results)
+
+        if ranking == "pareto":
+            return top_k(pareto_frontier(unique_flights), limit, flight_value_score)
+        if ranking == "value":
+            return top_k(unique_flights, limit, flight_value_score)
+        return top_k(unique_flights, limit, lambda x: x.price)
+
+    def _unique_flights(self, flight_results):
+        """Drop duplicates based on price, times and the airports searched, keeping the first seen"""
         seen = set()
-        unique_flights = []
         for f in flight_results:
-            key = (f.get("price"), f.get("outbound_departure_time"), f.get("outbound_date"))
+            key = (f.price, f.outbound_departure_time, f.outbound_date, f.search_origin, f.search_destination)
             if key not in seen:
                 seen.add(key)
-                unique_flights.append(f)
+                yield f
+
+class AsyncTravelPlanningAgent(TravelPlanningAgent):
+    """asyncio version of TravelPlanningAgent for the ASGI serving mode.
+
+    The upstream calls (SerpApi via httpx, Claude via AsyncAnthropic) are
+    coroutines so one process can keep many requests in flight; parsing,
+    ranking, prompts and fallbacks are inherited unchanged.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.serpapi = AsyncSerpApiClient()
+        self._upgrade_tasks = set()  # generations past their deadline, kept referenced until done
+
+    async def search_flights(self, origin, destination, outbound_date, return_date=None, currency="GBP"):
+        key = (origin, destination, outbound_date, return_date, currency)
+        return await self.flight_cache.aget_or_fetch(
+            key,
+            lambda: self.inflight.ado(
+                ("flights",) + key,
+                lambda: self._fetch_flights(origin, destination, outbound_date, return_date, currency)
+            ),
+            flight_cache_ttl(outbound_date),
+            should_cache=lambda result: "error" not in result
+        )
+
+    async def _fetch_flights(self, origin, destination, outbound_date, return_date=None, currency="GBP"):
+        try:
+            return await self.serpapi.get(self._flight_params(origin, destination, outbound_date, return_date, currency))
+        except Exception as e:
+            log.warning("Flight search error: %s", e)
+            return {"error": str(e)}
+
+    async def search_hotels(self, destination_code, check_in, check_out):
+        key = (destination_code, check_in, check_out)
+        return await self.hotel_cache.aget_or_fetch(
+            key,
+            lambda: self.inflight.ado(
+                ("hotels",) + key,
+                lambda: self._fetch_hotels(destination_code, check_in, check_out)
+            ),
+            flight_cache_ttl(check_in),
+            should_cache=lambda result: "error" not in result
+        )
+
+    async def _fetch_hotels(self, destination_code, check_in, check_out):
+        city_name = get_city_name(destination_code)
+        log.debug("Searching hotels for %s", city_name)
+
+        try:
+            result = await self.serpapi.get(self._hotel_params(city_name, check_in, check_out))
+            log.debug("Hotel API returned %d properties", len(result.get('properties', [])))
+            return result
+        except Exception as e:
+            log.warning("Hotel search error: %s", e)
+            return {"error": str(e)}
+
+    async def search_airbnb(self, destination_code, check_in, check_out):
+        return await self.inflight.ado(
+            ("airbnb", destination_code, check_in, check_out),
+            lambda: self._fetch_airbnb(destination_code, check_in, check_out)
+        )
+
+    async def _fetch_airbnb(self, destination_code, check_in, check_out):
+        city_name = get_city_name(destination_code)
+        nights = (datetime.strptime(check_out, "%Y-%m-%d") - datetime.strptime(check_in, "%Y-%m-%d")).days
+
+        try:
+            results = await self.serpapi.get(self._airbnb_params(city_name))
+            return self._parse_airbnb_results(results, nights)
+        except Exception as e:
+            log.warning("Airbnb search error: %s", e)
+            return []
+
+    async def analyze_flexible_dates(self, origin, destination, start_date, return_date, days_range=None, max_concurrency=None, on_date=None, budget=None, max_calls=None):
+        search = self._flexible_search(origin, destination, start_date, return_date, days_range, budget, max_calls)
+        by_search = {}
+
+        async def search_route(route):
+            flight_data = await self.search_flights(*route)
+            date_results = self._extract_date_results(flight_data, *route)
+            by_search[route] = date_results
+            if on_date:
+                on_date(route[2], route[3], date_results)
+            return date_results
+
+        for batch in iter(search.next_round, []):
+            round_results = await asyncio.gather(*map(search_route, batch))
+            search.add_round(dict(zip(batch, round_results)))
+
+        return self._merge_flexible_results(search, by_search)
+
+    async def estimate_flight_cost(self, origin, destination, outbound_date, return_date):
+        route = self._requested_route(origin, destination, outbound_date, return_date)
+        return self._cheapest_fare(self._extract_date_results(await self.search_flights(*route), *route))
+
+    async def create_structured_itinerary(self, destination_code, keywords, budget, duration_days, hotels, days_info=None, trip_type='leisure', on_section=None, deadline=None):
+        city_name, cache_key = self._start_itinerary(destination_code, keywords, budget, duration_days, days_info, trip_type)
+
+        cached = await asyncio.to_thread(self.itinerary_cache.get, cache_key)
+        if cached is not None:
+            log.info("Itinerary cache hit")
+            self._complete_itinerary(cached, city_name, duration_days)
+            return cached
+
+        relay = SectionRelay(on_section) if deadline and on_section else None
+        generation = self.inflight.ado(
+            ("itinerary", cache_key),
+            lambda: self._generate_complete_itinerary(
+                city_name, cache_key, keywords, budget, duration_days, hotels, days_info, trip_type, relay or on_section
+            )
+        )
+        try:
+            if not deadline:
+                return await generation
+
+            task = asyncio.ensure_future(generation)
+            try:
+                # shield() keeps the generation running when the wait times out
+                return await asyncio.wait_for(asyncio.shield(task), deadline)
+            except asyncio.TimeoutError:
+                if relay:
+                    relay.close()
+                token = self._missed_deadline(deadline)
+                self._upgrade_tasks.add(task)
+                task.add_done_callback(self._upgrade_tasks.discard)
+                task.add_done_callback(lambda done: resolve_upgrade(token, done))
+                return self._upgradable_fallback(city_name, duration_days, token)
+        except Exception as e:
+            return self._failed_itinerary(city_name, duration_days, e)
+
+    async def _generate_complete_itinerary(self, city_name, cache_key, keywords, budget, duration_days, hotels, days_info, trip_type, on_section=None):
+        if duration_days > ITINERARY_CHUNK_THRESHOLD:
+            jobs = self._itinerary_chunk_jobs(city_name, keywords, budget, duration_days, hotels, days_info, trip_type, on_section)
+            replies = await asyncio.gather(
+                *(self._generate_itinerary(prompt, callback) for _, prompt, callback in jobs),
+                return_exceptions=True
+            )
+            itinerary_data, complete = self._merge_itinerary_chunks(city_name, jobs, replies)
+        else:
+            prompt = self._build_itinerary_prompt(city_name, keywords, budget, duration_days, hotels, days_info, trip_type)
+            itinerary_data, complete = await self._generate_itinerary(prompt, on_section), True
+
+        return await asyncio.to_thread(self._finish_itinerary, itinerary_data, complete, city_name, duration_days, cache_key)
 
-        sorted_flights = sorted(unique_flights, key=lambda x: x.get("price", float('inf')))
+    async def _generate_itinerary(self, prompt, on_section=None):
+        parser = IncrementalJSONParser(on_section, is_itinerary_section) if on_section else None
+        chunks = []
+        started = time.perf_counter()
 
-        # Return more flights for better user choice (up to 20)
-        return sorted_flights[:20]
+        async def call():
+            async with async_client.beta.prompt_caching.messages.stream(**self._itinerary_request(prompt)) as stream:
+                async for text in stream.text_stream:
+                    if not chunks:
+                        self._record_first_token(time.perf_counter() - started)
+                    chunks.append(text)
+                    if parser:
+                        parser.feed(text)
+                return (await stream.get_final_message()).usage
+
+        usage = await aupstream_call("anthropic", "messages", call, failed_error=anthropic_unavailable)
+        self._record_itinerary_usage(usage)
+        return self._parse_itinerary_text("".join(chunks))
 
 agent = TravelPlanningAgent()
 
+def build_hotel_options(hotels):
+    """Trim a google_hotels response down to the hotel cards the frontend shows"""
+    hotel_options = []
+    if hotels and "properties" in hotels:
+        for hotel in hotels.get("properties", [])[:10]:
+            hotel_options.append({
+                "name": hotel.get("name", "N/A"),
+                "price_per_night": hotel.get("rate_per_night", {}).get("lowest", "N/A"),
+                "total_price": hotel.get("total_rate", {}).get("lowest", "N/A"),
+                "rating": hotel.get("overall_rating", "N/A"),
+                "reviews": hotel.get("reviews", 0),
+                "link": hotel.get("link", "#"),
+                "description": hotel.get("description", "")[:200],
+                "images": hotel.get("images", [])[:3],
+                "amenities": hotel.get("amenities", [])[:5],
+                "type": "hotel"
+            })
+    return hotel_options
+
+def build_airbnb_options(airbnb_listings):
+    """Convert Airbnb search results into accommodation cards"""
+    airbnb_options = []
+    for listing in airbnb_listings:
+        airbnb_options.append({
+            "name": listing.get("name"),
+            "price_per_night": listing.get("price_per_night"),
+            "total_price": listing.get("total_price"),
+            "description": listing.get("description"),
+            "link": listing.get("link"),
+            "type": "airbnb",
+            "property_type": listing.get("type")
+        })
+    return airbnb_options
+
+def emit_section(emit, streamed, path, value):
+    """Emit one itinerary section and remember what was sent for that path"""
+    streamed[tuple(path)] = value
+    emit("itinerary_section", {"path": list(path), "value": value})
+
+def emit_itinerary_sections(itinerary, emit, streamed=None):
+    """Emit an itinerary piece by piece: overview, each day, each restaurant list and nightlife venue.
+
+    Sections already streamed with the same value are skipped, so after a live
+    stream this only sends what validation filled in or replaced.
+    """
+    streamed = {} if streamed is None else streamed
+    sections = []
+    for key, value in itinerary.items():
+        if key == "upgrade":
+            continue  # sent with the result, not a section of the itinerary
+        if key == "daily_itinerary" or key == "nightlife":
+            sections.extend(((key, index), item) for index, item in enumerate(value))
+        elif key == "restaurants" and isinstance(value, dict):
+            sections.extend(((key, category), places) for category, places in value.items())
+        else:
+            sections.append(((key,), value))
+
+    for path, value in sections:
+        if streamed.get(path) != value:
+            emit_section(emit, streamed, path, value)
+
 @app.route('/')
 def home():
     try:
@@ -959,22 +3467,61 @@ def home():
     except Exception as e:
         return jsonify({"message": "Travel Planning AI Agent", "error": str(e)})
 
-@app.route('/itinerary', methods=['POST'])
-def create_itinerary():
-    data = request.json
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify({
+        "flights": agent.flight_cache.stats(),
+        "hotels": agent.hotel_cache.stats(),
+        "itineraries": agent.itinerary_cache.stats(),
+        "single_flight": agent.inflight.stats(),
+        "trip_requests": trip_requests.stats()
+    })
+
+@app.route('/airports')
+def airport_suggestions():
+    """Autocomplete airports by code, name or city: ``?q=barc&limit=8``"""
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', AIRPORT_SUGGEST_LIMIT, type=int), 50)
+    return jsonify({"query": query, "results": airports.search(query, limit)})
+
+def days_of_trip(start_datetime, duration_days):
+    """Generate day info with weekday names"""
+    days_info = []
+    for i in range(duration_days):
+        day_date = start_datetime + timedelta(days=i)
+        days_info.append({
+            "day": i + 1,
+            "date": day_date.strftime("%Y-%m-%d"),
+            "weekday": day_date.strftime("%A"),
+            "is_weekend": day_date.weekday() >= 5
+        })
+    return days_info
 
+def prepare_trip(data):
+    """Read and validate an /itinerary request body.
+
+    Returns ``(trip, error)``: a dict of normalised trip fields, or an error
+    payload for a 400 response.
+    """
     service_type = data.get('service_type', 'full')
     destination = data.get('destination')
-    keywords = data.get('keywords', [])
-    trip_type = data.get('trip_type', 'leisure')
-    travelers = data.get('travelers', '2')
+    trip = {
+        "service_type": service_type,
+        "destination": destination,
+        "destination_city": get_city_name(destination),
+        "keywords": data.get('keywords', []),
+        "trip_type": data.get('trip_type', 'leisure'),
+        "travelers": data.get('travelers', '2')
+    }
 
-    destination_city = get_city_name(destination)
+    try:
+        deadline = float(data.get('itinerary_deadline', ITINERARY_DEADLINE))
+    except (TypeError, ValueError):
+        return None, {"error": "itinerary_deadline must be a number of seconds"}
+    trip["itinerary_deadline"] = deadline if deadline > 0 else None
 
-    print(f"\n{'='*50}")
-    print(f"NEW REQUEST - {service_type.upper()} SERVICE")
-    print(f"{'='*50}")
-    print(f"Destination: {destination_city}")
+    log.info("New %s request for %s", service_type, trip['destination_city'],
+             extra={"service_type": service_type, "destination": destination})
 
     if service_type == 'itinerary_only':
         # ITINERARY ONLY MODE
@@ -983,7 +3530,7 @@ def create_itinerary():
         daily_budget = data.get('daily_budget', 100)
 
         if not destination:
-            return jsonify({"error": "Missing destination"}), 400
+            return None, {"error": "Missing destination"}
 
         # Calculate day of week for each day
         if start_date:
@@ -992,161 +3539,863 @@ def create_itinerary():
             start_datetime = datetime.now() + timedelta(days=30)
             start_date = start_datetime.strftime("%Y-%m-%d")
 
-        # Generate day info with weekday names
-        days_info = []
-        for i in range(duration_days):
-            day_date = start_datetime + timedelta(days=i)
-            days_info.append({
-                "day": i + 1,
-                "date": day_date.strftime("%Y-%m-%d"),
-                "weekday": day_date.strftime("%A"),
-                "is_weekend": day_date.weekday() >= 5
-            })
+        days_info = days_of_trip(start_datetime, duration_days)
 
-        print(f"Duration: {duration_days} days starting {start_date}")
-        print(f"Daily Budget: £{daily_budget}")
-        print(f"Days: {[(d['weekday'], d['is_weekend']) for d in days_info]}")
+        log.info("Itinerary only: %s days starting %s, £%s/day", duration_days, start_date, daily_budget)
+        log.debug("Days: %s", [(d['weekday'], d['is_weekend']) for d in days_info])
 
-        # Create enhanced itinerary with day-of-week awareness
-        itinerary = agent.create_structured_itinerary(
-            destination,
-            keywords,
-            daily_budget * duration_days,
-            duration_days,
-            None,
-            days_info=days_info,
-            trip_type=trip_type
-        )
+        trip.update(start_date=start_date, duration_days=duration_days, daily_budget=daily_budget, days_info=days_info)
+        return trip, None
 
-        print(f"\n{'='*50}")
-        print(f"ITINERARY ONLY RESPONSE READY")
-        print(f"{'='*50}\n")
-
-        return jsonify({
-            "service_type": "itinerary_only",
-            "destination": destination_city,
-            "keywords": keywords,
-            "daily_budget": daily_budget,
-            "total_budget": daily_budget * duration_days,
-            "trip_duration": duration_days,
-            "start_date": start_date,
-            "days_info": days_info,
-            "itinerary": itinerary
-        })
+    # FULL SERVICE MODE (flights + hotels + itinerary)
+    budget = data.get('budget', 1000)
+    origin = data.get('origin')
+    outbound_date = data.get('outbound_date')
+    return_date = data.get('return_date')
+    accommodation_type = data.get('accommodation_type', 'hotel')
 
+    if not all([destination, origin, outbound_date]):
+        return None, {"error": "Missing required fields"}
+    if not airport_pairs(origin, destination):
+        return None, {"error": "Origin and destination must not share an airport"}
+
+    ranking = data.get('ranking', FLIGHT_RANKING)
+    if ranking not in FLIGHT_RANKING_MODES:
+        return None, {"error": f"Unknown ranking '{ranking}', expected one of {', '.join(FLIGHT_RANKING_MODES)}"}
+
+    # Calculate duration
+    if return_date:
+        start = datetime.strptime(outbound_date, "%Y-%m-%d")
+        end = datetime.strptime(return_date, "%Y-%m-%d")
+        duration_days = (end - start).days
     else:
-        # FULL SERVICE MODE (flights + hotels + itinerary)
-        budget = data.get('budget', 1000)
-        origin = data.get('origin')
-        outbound_date = data.get('outbound_date')
-        return_date = data.get('return_date')
-        accommodation_type = data.get('accommodation_type', 'hotel')
+        duration_days = data.get('duration_days', 5)
+        return_date = (datetime.strptime(outbound_date, "%Y-%m-%d") + timedelta(days=duration_days)).strftime("%Y-%m-%d")
+
+    try:
+        flex_days = int(data.get('flex_days', FLEX_DAYS_RANGE))
+    except (TypeError, ValueError):
+        return None, {"error": "flex_days must be a whole number of days"}
+    if flex_days < 0:
+        return None, {"error": "flex_days must not be negative"}
 
-        print(f"Budget: £{budget}")
+    days_info = days_of_trip(datetime.strptime(outbound_date, "%Y-%m-%d"), duration_days)
 
-        if not all([destination, origin, outbound_date]):
-            return jsonify({"error": "Missing required fields"}), 400
+    log.info("Full service: %s to %s, %d days, budget £%s", origin, destination, duration_days, budget)
+    log.debug("Days: %s", [(d['weekday'], d['is_weekend']) for d in days_info])
 
-        # Calculate duration
-        if return_date:
-            start = datetime.strptime(outbound_date, "%Y-%m-%d")
-            end = datetime.strptime(return_date, "%Y-%m-%d")
-            duration_days = (end - start).days
+    trip.update(
+        budget=budget,
+        origin=origin,
+        outbound_date=outbound_date,
+        return_date=return_date,
+        accommodation_type=accommodation_type,
+        want_hotels=accommodation_type in ['hotel', 'mixed'],
+        want_airbnb=accommodation_type in ['airbnb', 'mixed'],
+        duration_days=duration_days,
+        days_info=days_info,
+        flex_days=flex_days,
+        ranking=ranking
+    )
+    return trip, None
+
+def itinerary_only_payload(trip, itinerary):
+    log.info("Itinerary only response ready")
+
+    return {
+        "service_type": "itinerary_only",
+        "destination": trip["destination_city"],
+        "keywords": trip["keywords"],
+        "daily_budget": trip["daily_budget"],
+        "total_budget": trip["daily_budget"] * trip["duration_days"],
+        "trip_duration": trip["duration_days"],
+        "start_date": trip["start_date"],
+        "days_info": trip["days_info"],
+        "itinerary": itinerary
+    }
+
+def full_service_payload(trip, best_flights, hotels, airbnb_listings, itinerary):
+    # Search accommodations
+    hotel_options = []
+    airbnb_options = []
+
+    if trip["want_hotels"]:
+        hotel_options = build_hotel_options(hotels)
+
+    if trip["want_airbnb"]:
+        airbnb_options = build_airbnb_options(airbnb_listings)
+
+    # Calculate costs
+    flight_cost = best_flights[0].price if best_flights else 0
+    remaining_budget = trip["budget"] - flight_cost
+
+    log.info("Full service response ready: %d flights, %d hotels, %d airbnb",
+             len(best_flights), len(hotel_options), len(airbnb_options))
+
+    return {
+        "service_type": "full",
+        "destination": trip["destination_city"],
+        "keywords": trip["keywords"],
+        "total_budget": trip["budget"],
+        "trip_duration": trip["duration_days"],
+        "outbound_date": trip["outbound_date"],
+        "return_date": trip["return_date"],
+        "flight_options": flight_dicts(best_flights),
+        "recommended_flight_cost": flight_cost,
+        "hotel_options": hotel_options,
+        "airbnb_options": airbnb_options,
+        "accommodation_type": trip["accommodation_type"],
+        "remaining_budget": remaining_budget,
+        "itinerary": itinerary
+    }
+
+def flights_event(search_date, search_return, flights):
+    return {"outbound_date": search_date, "return_date": search_return, "flights": flight_dicts(flights)}
+
+def prepare_comparison(data):
+    """Validate a /compare body. Returns ``(comparison, error)`` like prepare_trip"""
+    origin = data.get('origin')
+    outbound_date = data.get('outbound_date')
+    if not origin or not outbound_date:
+        return None, {"error": "Missing required fields"}
+
+    return_date = data.get('return_date')
+    if not return_date:
+        # A weekend away unless told otherwise
+        duration_days = data.get('duration_days', 2)
+        if not isinstance(duration_days, int) or isinstance(duration_days, bool) or duration_days < 1:
+            return None, {"error": "duration_days must be a whole number of days, at least 1"}
+        return_date = (datetime.strptime(outbound_date, "%Y-%m-%d") + timedelta(days=duration_days)).strftime("%Y-%m-%d")
+    nights = (datetime.strptime(return_date, "%Y-%m-%d") - datetime.strptime(outbound_date, "%Y-%m-%d")).days
+    if nights < 1:
+        return None, {"error": "return_date must be after outbound_date"}
+
+    requested = data.get('destinations')
+    if requested is not None and not (isinstance(requested, list) and all(isinstance(code, str) for code in requested)):
+        return None, {"error": "destinations must be a list of airport codes"}
+
+    # Skip duplicates and anywhere sharing an airport with the origin
+    home = set(metro_airports(origin))
+    destinations = [
+        code for code in dict.fromkeys(requested or COMPARE_DESTINATIONS)
+        if not home & set(metro_airports(code))
+    ]
+    if len(destinations) > COMPARE_MAX_DESTINATIONS:
+        return None, {"error": f"At most {COMPARE_MAX_DESTINATIONS} destinations can be compared at once"}
+
+    budget = data.get('budget')
+    try:
+        budget = float(budget) if budget is not None else None
+    except (TypeError, ValueError):
+        return None, {"error": "Budget must be a number"}
+
+    return {
+        "origin": origin,
+        "outbound_date": outbound_date,
+        "return_date": return_date,
+        "nights": nights,
+        "budget": budget,
+        "destinations": destinations,
+        # Searches per destination: its main airport pairs on the requested dates
+        "routes": {code: airport_pairs(origin, code)[:COMPARE_FLIGHT_CALLS] for code in destinations}
+    }, None
+
+def hotel_cost(hotel, nights):
+    """Total stay price of one google_hotels property, or None if it has none"""
+    total = hotel.get("total_rate", {}).get("extracted_lowest")
+    if total is None:
+        nightly = hotel.get("rate_per_night", {}).get("extracted_lowest")
+        total = nightly * nights if nightly is not None else None
+    return total
+
+def comparison_payload(comparison, flights, hotels):
+    """Rank destinations by cheapest flight plus cheapest hotel.
+
+    ``flights`` and ``hotels`` map each destination to its FlightRecords and
+    google_hotels response. Destinations within budget (all of them if no
+    budget was given) are ranked cheapest first; the rest are listed by total
+    under ``over_budget`` and those with no priced flight under ``unavailable``.
+    """
+    budget = comparison["budget"]
+    ranked, unavailable = [], []
+
+    for code in comparison["destinations"]:
+        best = agent.find_best_value_flights(flights[code], "price", limit=1)
+        if not best or not isinstance(best[0].price, (int, float)):
+            unavailable.append(code)
+            continue
+        flight = best[0]
+
+        priced = [(hotel_cost(hotel, comparison["nights"]), hotel) for hotel in (hotels[code] or {}).get("properties", [])]
+        priced = [priced_hotel for priced_hotel in priced if priced_hotel[0] is not None]
+        cost, hotel = min(priced, key=lambda priced_hotel: priced_hotel[0]) if priced else (None, None)
+
+        ranked.append({
+            "destination": code,
+            "city": get_city_name(code),
+            "total_cost": flight.price + (cost or 0),
+            "flight_cost": flight.price,
+            "hotel_cost": cost,
+            "flight": flight.to_dict(),
+            "hotel": build_hotel_options({"properties": [hotel]})[0] if hotel else None
+        })
+
+    ranked.sort(key=lambda result: (result["hotel_cost"] is None, result["total_cost"]))
+    within, over_budget = [], []
+    for result in ranked:
+        if budget is None or result["total_cost"] <= budget:
+            within.append(result)
         else:
-            duration_days = data.get('duration_days', 5)
-            return_date = (datetime.strptime(outbound_date, "%Y-%m-%d") + timedelta(days=duration_days)).strftime("%Y-%m-%d")
-
-        # Generate day info with weekday names
-        start_datetime = datetime.strptime(outbound_date, "%Y-%m-%d")
-        days_info = []
-        for i in range(duration_days):
-            day_date = start_datetime + timedelta(days=i)
-            days_info.append({
-                "day": i + 1,
-                "date": day_date.strftime("%Y-%m-%d"),
-                "weekday": day_date.strftime("%A"),
-                "is_weekend": day_date.weekday() >= 5
-            })
+            over_budget.append({"destination": result["destination"], "total_cost": result["total_cost"]})
+    return {
+        "origin": comparison["origin"],
+        "outbound_date": comparison["outbound_date"],
+        "return_date": comparison["return_date"],
+        "nights": comparison["nights"],
+        "budget": budget,
+        "results": within,
+        "over_budget": over_budget,
+        "unavailable": unavailable
+    }
 
-        print(f"Duration: {duration_days} days")
-        print(f"Days: {[(d['weekday'], d['is_weekend']) for d in days_info]}")
-
-        # Search flights
-        all_flights = agent.analyze_flexible_dates(origin, destination, outbound_date, return_date, 7)
-        best_flights = agent.find_best_value_flights(all_flights)
-        print(f"Flights: {len(best_flights)} options")
-
-        # Search accommodations
-        hotel_options = []
-        airbnb_options = []
-
-        if accommodation_type in ['hotel', 'mixed']:
-            hotels = agent.search_hotels(destination, outbound_date, return_date)
-            if hotels and "properties" in hotels:
-                for hotel in hotels.get("properties", [])[:10]:
-                    hotel_options.append({
-                        "name": hotel.get("name", "N/A"),
-                        "price_per_night": hotel.get("rate_per_night", {}).get("lowest", "N/A"),
-                        "total_price": hotel.get("total_rate", {}).get("lowest", "N/A"),
-                        "rating": hotel.get("overall_rating", "N/A"),
-                        "reviews": hotel.get("reviews", 0),
-                        "link": hotel.get("link", "#"),
-                        "description": hotel.get("description", "")[:200],
-                        "images": hotel.get("images", [])[:3],
-                        "amenities": hotel.get("amenities", [])[:5],
-                        "type": "hotel"
-                    })
-            print(f"Hotels: {len(hotel_options)} found")
-
-        if accommodation_type in ['airbnb', 'mixed']:
-            airbnb_listings = agent.search_airbnb(destination, outbound_date, return_date)
-            for listing in airbnb_listings:
-                airbnb_options.append({
-                    "name": listing.get("name"),
-                    "price_per_night": listing.get("price_per_night"),
-                    "total_price": listing.get("total_price"),
-                    "description": listing.get("description"),
-                    "link": listing.get("link"),
-                    "type": "airbnb",
-                    "property_type": listing.get("type")
-                })
-            print(f"Airbnb: {len(airbnb_options)} found")
-
-        # Calculate costs
-        flight_cost = best_flights[0].get('price', 0) if best_flights else 0
-        remaining_budget = budget - flight_cost
-
-        # Create itinerary with day-of-week awareness
+def plan_trip(data, emit=None):
+    """Run the /itinerary pipeline for a request body.
+
+    Returns ``(payload, status_code)``. If ``emit(event, data)`` is given it is
+    called with partial results as they become available, from whichever
+    thread produced them.
+    """
+    # Itinerary sections are only parsed out of the model's reply while it
+    # streams if someone is listening for them
+    streaming = emit is not None
+    emit = emit or (lambda event, event_data: None)
+
+    trip, error = prepare_trip(data)
+    if error:
+        return error, 400
+
+    if trip["service_type"] == 'itinerary_only':
+        # Create enhanced itinerary with day-of-week awareness
+        streamed = {}
+        with STAGE_SECONDS.time("itinerary"):
+            itinerary = agent.create_structured_itinerary(
+                trip["destination"],
+                trip["keywords"],
+                trip["daily_budget"] * trip["duration_days"],
+                trip["duration_days"],
+                None,
+                days_info=trip["days_info"],
+                trip_type=trip["trip_type"],
+                on_section=(lambda path, value: emit_section(emit, streamed, path, value)) if streaming else None,
+                deadline=trip["itinerary_deadline"]
+            )
+        emit_itinerary_sections(itinerary, emit, streamed)
+        return itinerary_only_payload(trip, itinerary), 200
+
+    destination, origin = trip["destination"], trip["origin"]
+    outbound_date, return_date = trip["outbound_date"], trip["return_date"]
+
+    # Flights, hotels and Airbnb are independent, so they run side by side.
+    # The itinerary needs the hotel list and the budget left after flights, so
+    # it starts once hotels and the requested-date fare are back instead of
+    # waiting for the (much longer) flexible-date search.
+    def search_flights_stage(done):
+        all_flights = agent.analyze_flexible_dates(
+            origin, destination, outbound_date, return_date, trip["flex_days"],
+            budget=trip["budget"],
+            on_date=lambda search_date, search_return, flights: emit(
+                "flights", flights_event(search_date, search_return, flights)
+            )
+        )
+        return agent.find_best_value_flights(all_flights, trip["ranking"])
+
+    def search_hotels_stage(done):
+        hotels = agent.search_hotels(destination, outbound_date, return_date)
+        emit("hotels", build_hotel_options(hotels))
+        return hotels
+
+    def search_airbnb_stage(done):
+        listings = agent.search_airbnb(destination, outbound_date, return_date)
+        emit("airbnb", build_airbnb_options(listings))
+        return listings
+
+    def flight_estimate_stage(done):
+        return agent.estimate_flight_cost(origin, destination, outbound_date, return_date)
+
+    def itinerary_stage(done):
+        streamed = {}
         itinerary = agent.create_structured_itinerary(
             destination,
-            keywords,
-            remaining_budget,
-            duration_days,
-            hotels if accommodation_type in ['hotel', 'mixed'] else None,
-            days_info=days_info,
-            trip_type=trip_type
+            trip["keywords"],
+            trip["budget"] - done["flight_estimate"],
+            trip["duration_days"],
+            done.get("hotels"),
+            days_info=trip["days_info"],
+            trip_type=trip["trip_type"],
+            on_section=(lambda path, value: emit_section(emit, streamed, path, value)) if streaming else None,
+            deadline=trip["itinerary_deadline"]
         )
+        emit_itinerary_sections(itinerary, emit, streamed)
+        return itinerary
 
-        print(f"\n{'='*50}")
-        print(f"FULL SERVICE RESPONSE READY")
-        print(f"{'='*50}\n")
+    stages = {
+        "flights": (search_flights_stage, ()),
+        "flight_estimate": (flight_estimate_stage, ()),
+        "itinerary": (itinerary_stage, ("hotels", "flight_estimate") if trip["want_hotels"] else ("flight_estimate",))
+    }
+    if trip["want_hotels"]:
+        stages["hotels"] = (search_hotels_stage, ())
+    if trip["want_airbnb"]:
+        stages["airbnb"] = (search_airbnb_stage, ())
 
-        return jsonify({
-            "service_type": "full",
-            "destination": destination_city,
-            "keywords": keywords,
-            "total_budget": budget,
-            "trip_duration": duration_days,
-            "outbound_date": outbound_date,
-            "return_date": return_date,
-            "flight_options": best_flights,
-            "recommended_flight_cost": flight_cost,
-            "hotel_options": hotel_options,
-            "airbnb_options": airbnb_options,
-            "accommodation_type": accommodation_type,
-            "remaining_budget": remaining_budget,
-            "itinerary": itinerary
-        })
+    stage_results = run_stage_graph(stages)
+
+    with STAGE_SECONDS.time("build_response"):
+        payload = full_service_payload(
+            trip,
+            stage_results["flights"],
+            stage_results.get("hotels"),
+            stage_results.get("airbnb"),
+            stage_results["itinerary"]
+        )
+    return payload, 200
+
+def compare_destinations(data):
+    """Run the /compare pipeline: trip cost per candidate destination, no itinerary.
+
+    Every destination's flight searches (requested dates only) and hotel
+    search go out at once. Both go through the shared caches, so routes and
+    cities another request or destination has already searched cost nothing.
+    Returns ``(payload, status_code)``.
+    """
+    comparison, error = prepare_comparison(data)
+    if error:
+        return error, 400
+
+    outbound_date, return_date = comparison["outbound_date"], comparison["return_date"]
+    log.info("Comparing %d destinations from %s", len(comparison["destinations"]), comparison["origin"])
+
+    with ThreadPoolExecutor(max_workers=COMPARE_CONCURRENCY) as executor:
+        flight_futures = [
+            (code, search_origin, search_destination,
+             executor.submit(in_context(agent.search_flights), search_origin, search_destination, outbound_date, return_date))
+            for code, pairs in comparison["routes"].items()
+            for _, search_origin, search_destination in pairs
+        ]
+        hotel_futures = {
+            code: executor.submit(in_context(agent.search_hotels), code, outbound_date, return_date)
+            for code in comparison["destinations"]
+        }
+
+        flights = {code: [] for code in comparison["destinations"]}
+        for code, search_origin, search_destination, future in flight_futures:
+            flights[code].extend(agent._extract_date_results(
+                future.result(), search_origin, search_destination, outbound_date, return_date
+            ))
+        hotels = {code: future.result() for code, future in hotel_futures.items()}
+
+    with STAGE_SECONDS.time("build_response"):
+        payload = comparison_payload(comparison, flights, hotels)
+    return payload, 200
+
+@app.route('/llm/stats')
+def llm_stats():
+    return jsonify({
+        "itinerary_first_token_seconds": agent.itinerary_first_token.stats(),
+        "itinerary_tokens": agent.itinerary_usage.stats()
+    })
+
+def agents():
+    """The agents in use in this process (the async one only once ASGI mode has started)"""
+    return [a for a in (agent, _async_agent) if a is not None]
+
+def cache_totals():
+    """Hit/miss/eviction counts per cache, summed over the agents in use"""
+    totals = {name: {"hits": 0, "misses": 0, "evictions": 0} for name in ("flights", "hotels", "itineraries")}
+    # Agents share the itinerary cache, so each cache is counted once
+    caches = {
+        id(cache): (name, cache)
+        for a in agents()
+        for name, cache in (("flights", a.flight_cache), ("hotels", a.hotel_cache), ("itineraries", a.itinerary_cache))
+    }
+    for name, stats in ((name, cache.stats()) for name, cache in caches.values()):
+        totals[name]["hits"] += stats["hits"] + stats.get("stale_hits", 0)
+        totals[name]["misses"] += stats["misses"]
+        totals[name]["evictions"] += stats["evictions"]
+    return totals
+
+def cache_hit_ratios():
+    return [
+        ({"cache": name}, round(t["hits"] / (t["hits"] + t["misses"]), 4) if t["hits"] + t["misses"] else 0.0)
+        for name, t in cache_totals().items()
+    ]
+
+metrics.collect("flight_agent_cache_hits_total", "counter", "Cache lookups served from cache (including stale hits)",
+                lambda: [({"cache": name}, t["hits"]) for name, t in cache_totals().items()])
+metrics.collect("flight_agent_cache_misses_total", "counter", "Cache lookups that missed",
+                lambda: [({"cache": name}, t["misses"]) for name, t in cache_totals().items()])
+metrics.collect("flight_agent_cache_evictions_total", "counter", "Cache entries evicted",
+                lambda: [({"cache": name}, t["evictions"]) for name, t in cache_totals().items()])
+metrics.collect("flight_agent_cache_hit_ratio", "gauge", "Share of cache lookups served from cache", cache_hit_ratios)
+metrics.collect("flight_agent_claude_tokens_total", "counter", "Claude tokens used by itinerary calls, by kind",
+                lambda: [({"kind": kind}, sum(a.itinerary_usage.stats()[kind] for a in agents())) for kind in TokenUsage.FIELDS])
+metrics.collect("flight_agent_single_flight_coalesced_total", "counter", "Calls that waited for an identical in-flight call instead of repeating it",
+                lambda: [({"scope": "upstream"}, sum(a.inflight.stats()["coalesced"] for a in agents())),
+                         ({"scope": "request"}, trip_requests.stats()["coalesced"])])
+metrics.collect("flight_agent_circuit_state", "gauge", "Circuit breaker state per upstream (1 for the current state)",
+                lambda: [({"upstream": upstream, "operation": operation, "state": state}, int(stats["state"] == state))
+                         for upstream, operation, stats in circuit_breakers.stats() for state in CircuitBreaker.STATES])
+metrics.collect("flight_agent_circuit_opens_total", "counter", "Times a circuit breaker opened",
+                lambda: [({"upstream": upstream, "operation": operation}, stats["opens"])
+                         for upstream, operation, stats in circuit_breakers.stats()])
+
+def new_request_id(header=None):
+    """Caller-supplied X-Request-ID (so logs join up across services) or a fresh one"""
+    return (header or uuid.uuid4().hex[:12])[:64]
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    request_id_var.set(new_request_id(request.headers.get("X-Request-ID")))
+
+@app.after_request
+def record_request_time(response):
+    # Streamed responses are timed when their last event is sent
+    if not response.is_streamed and request.url_rule is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, request.url_rule.rule)
+    response.headers["X-Request-ID"] = request_id_var.get()
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Identical /itinerary bodies submitted while one is running (e.g. a double
+# click) wait for and share that run's response
+trip_requests = SingleFlight()
+
+@app.route('/itinerary', methods=['POST'])
+def create_itinerary():
+    data = request.json
+    payload, status = trip_requests.do(request_key(data), lambda: plan_trip(data))
+    with SERIALIZE_SECONDS.time("json"):
+        response = jsonify(payload)
+    return response, status
+
+@app.route('/compare', methods=['POST'])
+def compare():
+    """Cheapest flight + hotel per candidate destination, ranked by total cost, with no itinerary"""
+    data = request.json
+    payload, status = trip_requests.do(("compare", request_key(data)), lambda: compare_destinations(data))
+    with SERIALIZE_SECONDS.time("json"):
+        response = jsonify(payload)
+    return response, status
+
+@app.route('/itinerary/stream', methods=['POST'])
+def stream_itinerary():
+    """Same pipeline as /itinerary, streamed as newline-delimited JSON events.
+
+    Each line is ``{"event": ..., "data": ...}``: ``flights`` per searched date,
+    ``hotels``, ``airbnb`` and ``itinerary_section`` as they arrive, then a final
+    ``result`` event carrying exactly what /itinerary would have returned (or
+    ``error`` with the status code if the request was invalid). If the result
+    had to use the fallback itinerary because of ITINERARY_DEADLINE, the stream
+    stays open for an ``itinerary_upgrade`` event with the generated one.
+    """
+    data = request.json
+    events = queue.Queue()
+    started = time.perf_counter()
+
+    def run():
+        try:
+            payload, status = plan_trip(data, emit=lambda event, event_data: events.put((event, event_data)))
+            if status == 200:
+                events.put(("result", payload))
+                token = pending_upgrade(payload)
+                if token:
+                    upgrade = upgrade_event(itinerary_upgrades.get(token, wait=ITINERARY_UPGRADE_WAIT))
+                    if upgrade:
+                        events.put(upgrade)
+            else:
+                events.put(("error", dict(payload, status=status)))
+        except Exception as e:
+            log.exception("Streaming request error: %s", e)
+            events.put(("error", {"error": str(e), "status": 500}))
+        events.put(None)
+
+    threading.Thread(target=in_context(run), daemon=True).start()
+
+    def generate():
+        while True:
+            item = events.get()
+            if item is None:
+                REQUEST_SECONDS.observe(time.perf_counter() - started, "/itinerary/stream")
+                return
+            event, event_data = item
+            with SERIALIZE_SECONDS.time("ndjson"):
+                line = app.json.dumps({"event": event, "data": event_data}) + "\n"
+            yield line
+
+    return Response(generate(), mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
+
+jobs = JobStore(plan_trip)
+
+def poll_params(arg):
+    """``((since, wait), error)`` from a poll's query string, ``arg(name)`` returning a value or None.
+
+    ``since`` is clamped to 0 and up, ``wait`` to 0..JOB_MAX_WAIT seconds.
+    """
+    try:
+        since = int(arg("since") or 0)
+        wait = float(arg("wait") or 0)
+    except ValueError:
+        return None, {"error": "since must be an integer and wait a number of seconds"}
+    if not math.isfinite(wait):
+        return None, {"error": "wait must be a number of seconds"}
+    return (max(since, 0), min(max(wait, 0), JOB_MAX_WAIT)), None
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Start an /itinerary run in the background and return its id straight away"""
+    job = jobs.submit(request.json)
+    if job is None:
+        return jsonify({"error": "Too many jobs queued, try again shortly"}), 503
+    return jsonify({"job_id": job.id, "status": job.status, "poll_url": f"/jobs/{job.id}"}), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Poll a job. ``since`` skips events already seen; ``wait`` long-polls for up to that many seconds"""
+    params, error = poll_params(request.args.get)
+    if error:
+        return jsonify(error), 400
+    since, wait = params
+    snapshot = jobs.get(job_id, since=since, wait=wait)
+    if snapshot is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    with SERIALIZE_SECONDS.time("json"):
+        response = jsonify(snapshot)
+    return response
+
+@app.route('/itinerary/upgrades/<token>')
+def get_itinerary_upgrade(token):
+    """The generated itinerary for a response that got the deadline fallback; ``wait`` long-polls"""
+    params, error = poll_params(request.args.get)
+    if error:
+        return jsonify(error), 400
+    snapshot = itinerary_upgrades.get(token, wait=params[1])
+    if snapshot is None:
+        return jsonify({"error": "Unknown or expired upgrade"}), 404
+    return jsonify(snapshot)
+
+# Async serving mode: `uvicorn flight_agent:asgi_app` (or gunicorn with
+# -k uvicorn.workers.UvicornWorker). Same routes and payloads as the Flask app.
+_async_agent = None
+
+def get_async_agent():
+    global _async_agent
+    if _async_agent is None:
+        _async_agent = AsyncTravelPlanningAgent()
+    return _async_agent
+
+async def plan_trip_async(data, emit=None):
+    """asyncio version of plan_trip, run on the AsyncTravelPlanningAgent"""
+    # Itinerary sections are only parsed out of the model's reply while it
+    # streams if someone is listening for them
+    streaming = emit is not None
+    emit = emit or (lambda event, event_data: None)
+    async_agent = get_async_agent()
+
+    trip, error = prepare_trip(data)
+    if error:
+        return error, 400
+
+    if trip["service_type"] == 'itinerary_only':
+        streamed = {}
+        with STAGE_SECONDS.time("itinerary"):
+            itinerary = await async_agent.create_structured_itinerary(
+                trip["destination"],
+                trip["keywords"],
+                trip["daily_budget"] * trip["duration_days"],
+                trip["duration_days"],
+                None,
+                days_info=trip["days_info"],
+                trip_type=trip["trip_type"],
+                on_section=(lambda path, value: emit_section(emit, streamed, path, value)) if streaming else None,
+                deadline=trip["itinerary_deadline"]
+            )
+        emit_itinerary_sections(itinerary, emit, streamed)
+        return itinerary_only_payload(trip, itinerary), 200
+
+    destination, origin = trip["destination"], trip["origin"]
+    outbound_date, return_date = trip["outbound_date"], trip["return_date"]
+
+    async def search_flights_stage():
+        with STAGE_SECONDS.time("flights"):
+            all_flights = await async_agent.analyze_flexible_dates(
+                origin, destination, outbound_date, return_date, trip["flex_days"],
+                budget=trip["budget"],
+                on_date=lambda search_date, search_return, flights: emit(
+                    "flights", flights_event(search_date, search_return, flights)
+                )
+            )
+            return async_agent.find_best_value_flights(all_flights, trip["ranking"])
+
+    async def search_hotels_stage():
+        if not trip["want_hotels"]:
+            return None
+        with STAGE_SECONDS.time("hotels"):
+            hotels = await async_agent.search_hotels(destination, outbound_date, return_date)
+        emit("hotels", build_hotel_options(hotels))
+        return hotels
+
+    async def search_airbnb_stage():
+        if not trip["want_airbnb"]:
+            return None
+        with STAGE_SECONDS.time("airbnb"):
+            listings = await async_agent.search_airbnb(destination, outbound_date, return_date)
+        emit("airbnb", build_airbnb_options(listings))
+        return listings
+
+    # As in plan_trip, the itinerary waits only for hotels and the requested-date fare
+    hotels_task = asyncio.ensure_future(search_hotels_stage())
+
+    async def itinerary_stage():
+        streamed = {}
+        hotels, flight_estimate = await asyncio.gather(
+            hotels_task, async_agent.estimate_flight_cost(origin, destination, outbound_date, return_date)
+        )
+        with STAGE_SECONDS.time("itinerary"):
+            itinerary = await async_agent.create_structured_itinerary(
+                destination,
+                trip["keywords"],
+                trip["budget"] - flight_estimate,
+                trip["duration_days"],
+                hotels,
+                days_info=trip["days_info"],
+                trip_type=trip["trip_type"],
+                on_section=(lambda path, value: emit_section(emit, streamed, path, value)) if streaming else None,
+                deadline=trip["itinerary_deadline"]
+            )
+        emit_itinerary_sections(itinerary, emit, streamed)
+        return itinerary
+
+    best_flights, hotels, airbnb_listings, itinerary = await asyncio.gather(
+        search_flights_stage(), hotels_task, search_airbnb_stage(), itinerary_stage()
+    )
+    with STAGE_SECONDS.time("build_response"):
+        payload = full_service_payload(trip, best_flights, hotels, airbnb_listings, itinerary)
+    return payload, 200
+
+async def compare_destinations_async(data):
+    """asyncio version of compare_destinations"""
+    async_agent = get_async_agent()
+
+    comparison, error = prepare_comparison(data)
+    if error:
+        return error, 400
+
+    outbound_date, return_date = comparison["outbound_date"], comparison["return_date"]
+    log.info("Comparing %d destinations from %s", len(comparison["destinations"]), comparison["origin"])
+    searches = asyncio.Semaphore(COMPARE_CONCURRENCY)
+
+    async def search_route(code, search_origin, search_destination):
+        async with searches:
+            flight_data = await async_agent.search_flights(search_origin, search_destination, outbound_date, return_date)
+        return code, async_agent._extract_date_results(flight_data, search_origin, search_destination, outbound_date, return_date)
+
+    async def search_hotels(code):
+        async with searches:
+            return code, await async_agent.search_hotels(code, outbound_date, return_date)
+
+    flight_results, hotel_results = await asyncio.gather(
+        asyncio.gather(*(
+            search_route(code, search_origin, search_destination)
+            for code, pairs in comparison["routes"].items()
+            for _, search_origin, search_destination in pairs
+        )),
+        asyncio.gather(*map(search_hotels, comparison["destinations"]))
+    )
+
+    flights = {code: [] for code in comparison["destinations"]}
+    for code, route_flights in flight_results:
+        flights[code].extend(route_flights)
+
+    with STAGE_SECONDS.time("build_response"):
+        payload = comparison_payload(comparison, flights, dict(hotel_results))
+    return payload, 200
+
+async def _read_json_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return json.loads(body or b"null")
+
+async def _send_response(send, status, body, content_type="application/json"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(len(body)).encode()),
+            (b"x-request-id", request_id_var.get().encode())
+        ]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def _send_json(send, payload, status=200):
+    with SERIALIZE_SECONDS.time("json"):
+        body = (app.json.dumps(payload) + "\n").encode()
+    await _send_response(send, status, body)
+
+async def _stream_itinerary_async(data, send):
+    """NDJSON event stream, same events as the Flask /itinerary/stream route"""
+    events = asyncio.Queue()
+
+    async def run():
+        try:
+            payload, status = await plan_trip_async(data, emit=lambda event, event_data: events.put_nowait((event, event_data)))
+            if status == 200:
+                events.put_nowait(("result", payload))
+                token = pending_upgrade(payload)
+                if token:
+                    upgrade = upgrade_event(await itinerary_upgrades.aget(token, ITINERARY_UPGRADE_WAIT))
+                    if upgrade:
+                        events.put_nowait(upgrade)
+            else:
+                events.put_nowait(("error", dict(payload, status=status)))
+        except Exception as e:
+            log.exception("Streaming request error: %s", e)
+            events.put_nowait(("error", {"error": str(e), "status": 500}))
+        events.put_nowait(None)
+
+    task = asyncio.ensure_future(run())
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"application/x-ndjson"),
+            (b"x-accel-buffering", b"no"),
+            (b"x-request-id", request_id_var.get().encode())
+        ]
+    })
+    while True:
+        item = await events.get()
+        if item is None:
+            break
+        event, event_data = item
+        with SERIALIZE_SECONDS.time("ndjson"):
+            line = app.json.dumps({"event": event, "data": event_data}) + "\n"
+        await send({"type": "http.response.body", "body": line.encode(), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+    await task
+
+async def asgi_app(scope, receive, send):
+    """Minimal ASGI application exposing the same routes as the Flask app"""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                get_async_agent()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _async_agent is not None:
+                    await _async_agent.serpapi.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    method, path = scope["method"], scope["path"]
+    async_agent = get_async_agent()
+    started = time.perf_counter()
+    # Each ASGI call runs in its own task, so this doesn't leak between requests
+    request_id_var.set(new_request_id(dict(scope.get("headers", [])).get(b"x-request-id", b"").decode("latin-1")))
+    route = path if path in ("/", "/cache/stats", "/airports", "/llm/stats", "/metrics", "/itinerary", "/itinerary/stream", "/compare", "/jobs") else (
+        "/jobs/<job_id>" if path.startswith("/jobs/") else
+        "/itinerary/upgrades/<token>" if path.startswith("/itinerary/upgrades/") else None
+    )
+    try:
+        if path == "/" and method == "GET":
+            try:
+                with open(os.path.join(app.root_path, "index.html"), "rb") as f:
+                    body = f.read()
+                await _send_response(send, 200, body, "text/html; charset=utf-8")
+            except OSError as e:
+                await _send_json(send, {"message": "Travel Planning AI Agent", "error": str(e)})
+        elif path == "/cache/stats" and method == "GET":
+            await _send_json(send, {
+                "flights": async_agent.flight_cache.stats(),
+                "hotels": async_agent.hotel_cache.stats(),
+                "itineraries": async_agent.itinerary_cache.stats(),
+                "single_flight": async_agent.inflight.stats(),
+                "trip_requests": trip_requests.stats()
+            })
+        elif path == "/airports" and method == "GET":
+            query = parse_qs(scope.get("query_string", b"").decode())
+            q = query.get("q", [""])[0]
+            try:
+                limit = min(int(query.get("limit", [AIRPORT_SUGGEST_LIMIT])[0]), 50)
+            except ValueError:
+                limit = AIRPORT_SUGGEST_LIMIT
+            await _send_json(send, {"query": q, "results": airports.search(q, limit)})
+        elif path == "/llm/stats" and method == "GET":
+            await _send_json(send, {
+                "itinerary_first_token_seconds": async_agent.itinerary_first_token.stats(),
+                "itinerary_tokens": async_agent.itinerary_usage.stats()
+            })
+        elif path == "/metrics" and method == "GET":
+            await _send_response(send, 200, metrics.render().encode(), "text/plain; version=0.0.4")
+        elif path == "/itinerary" and method == "POST":
+            data = await _read_json_body(receive)
+            payload, status = await trip_requests.ado(request_key(data), lambda: plan_trip_async(data))
+            await _send_json(send, payload, status)
+        elif path == "/compare" and method == "POST":
+            data = await _read_json_body(receive)
+            payload, status = await trip_requests.ado(("compare", request_key(data)), lambda: compare_destinations_async(data))
+            await _send_json(send, payload, status)
+        elif path == "/itinerary/stream" and method == "POST":
+            await _stream_itinerary_async(await _read_json_body(receive), send)
+        elif path == "/jobs" and method == "POST":
+            job = jobs.submit(await _read_json_body(receive))
+            if job is None:
+                await _send_json(send, {"error": "Too many jobs queued, try again shortly"}, 503)
+            else:
+                await _send_json(send, {"job_id": job.id, "status": job.status, "poll_url": f"/jobs/{job.id}"}, 202)
+        elif path.startswith("/itinerary/upgrades/") and method == "GET":
+            query = parse_qs(scope.get("query_string", b"").decode())
+            params, error = poll_params(lambda name: query.get(name, [None])[0])
+            if error:
+                await _send_json(send, error, 400)
+            else:
+                snapshot = await itinerary_upgrades.aget(path[len("/itinerary/upgrades/"):], wait=params[1])
+                if snapshot is None:
+                    await _send_json(send, {"error": "Unknown or expired upgrade"}, 404)
+                else:
+                    await _send_json(send, snapshot)
+        elif path.startswith("/jobs/") and method == "GET":
+            query = parse_qs(scope.get("query_string", b"").decode())
+            params, error = poll_params(lambda name: query.get(name, [None])[0])
+            if error:
+                await _send_json(send, error, 400)
+            else:
+                since, wait = params
+                snapshot = await jobs.aget(path[len("/jobs/"):], since=since, wait=wait)
+                if snapshot is None:
+                    await _send_json(send, {"error": "Unknown or expired job"}, 404)
+                else:
+                    await _send_json(send, snapshot)
+        else:
+            await _send_json(send, {"error": "Not found"}, 404)
+    except Exception as e:
+        log.exception("Request error: %s", e)
+        await _send_json(send, {"error": str(e)}, 500)
+    finally:
+        if route:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
@@ -0,0 +1,139 @@
+import asyncio
+
+import anthropic
+import httpx
+import pytest
+
+import flight_agent as fa
+
+
+def api_error(status):
+    response = httpx.Response(status, request=httpx.Request("POST", "https://api.anthropic.com/v1/messages"))
+    return anthropic.APIStatusError(f"status {status}", response=response, body=None)
+
+
+def fail(error):
+    def call():
+        raise error
+    return call
+
+
+@pytest.fixture
+def breakers(monkeypatch):
+    registry = fa.CircuitBreakers()
+    monkeypatch.setattr(fa, "circuit_breakers", registry)
+    return registry
+
+
+def test_opens_after_consecutive_failures():
+    breaker = fa.CircuitBreaker("test", failure_threshold=3, reset_timeout=60)
+    breaker.record(False)
+    breaker.record(False)
+    breaker.record(True)  # a success resets the run
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == fa.CircuitBreaker.CLOSED and breaker.allow()
+
+    breaker.record(False)
+    assert breaker.state == fa.CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.stats()["opens"] == 1
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = fa.CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.record(False)
+
+    assert breaker.allow()
+    assert breaker.state == fa.CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # the probe is already claimed
+
+
+def test_probe_success_closes():
+    breaker = fa.CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.record(False)
+    assert breaker.allow()
+
+    breaker.record(True)
+    assert breaker.state == fa.CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_probe_failure_reopens():
+    breaker = fa.CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.record(False)
+    assert breaker.allow()
+
+    breaker.record(False)
+    assert breaker.state == fa.CircuitBreaker.OPEN
+    assert breaker.stats()["opens"] == 2
+
+
+def test_unfinished_probe_releases_the_claim():
+    breaker = fa.CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.record(False)
+    assert breaker.allow()
+
+    breaker.record(None)
+    assert breaker.state == fa.CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+
+def test_open_circuit_fails_fast_without_calling(breakers):
+    breaker = breakers.get("serpapi", "google_flights")
+    breaker.failure_threshold = 1
+    breaker.record(False)
+    calls = []
+
+    with pytest.raises(fa.CircuitOpenError):
+        fa.upstream_call("serpapi", "google_flights", lambda: calls.append(1))
+    assert calls == []
+
+
+def test_rejected_anthropic_requests_do_not_trip(breakers):
+    for status in (400, 401, 404):
+        for _ in range(fa.CIRCUIT_FAILURE_THRESHOLD):
+            with pytest.raises(anthropic.APIStatusError):
+                fa.upstream_call("anthropic", "messages", fail(api_error(status)), failed_error=fa.anthropic_unavailable)
+
+    assert breakers.get("anthropic", "messages").state == fa.CircuitBreaker.CLOSED
+
+
+@pytest.mark.parametrize("error", [
+    api_error(429),
+    api_error(529),
+    anthropic.APIConnectionError(request=httpx.Request("POST", "https://api.anthropic.com/v1/messages")),
+    anthropic.APITimeoutError(request=httpx.Request("POST", "https://api.anthropic.com/v1/messages")),
+])
+def test_anthropic_outages_trip(breakers, error):
+    for _ in range(fa.CIRCUIT_FAILURE_THRESHOLD):
+        with pytest.raises(type(error)):
+            fa.upstream_call("anthropic", "messages", fail(error), failed_error=fa.anthropic_unavailable)
+
+    assert breakers.get("anthropic", "messages").state == fa.CircuitBreaker.OPEN
+
+
+def test_serpapi_error_status_trips(breakers):
+    for _ in range(fa.CIRCUIT_FAILURE_THRESHOLD):
+        fa.upstream_call("serpapi", "google_hotels", lambda: httpx.Response(503), failed=fa.serpapi_unavailable)
+
+    assert breakers.get("serpapi", "google_hotels").state == fa.CircuitBreaker.OPEN
+
+
+def test_cancelled_async_probe_releases_the_claim(breakers):
+    breaker = breakers.get("anthropic", "messages")
+    breaker.reset_timeout = 0
+    breaker.failure_threshold = 1
+    breaker.record(False)
+
+    async def probe():
+        task = asyncio.ensure_future(fa.aupstream_call("anthropic", "messages", lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0)
+        assert not breaker.allow()  # claimed by the task
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(probe())
+    assert breaker.state == fa.CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+import flight_agent as fa
+
+SEARCHES = [("LHR", "BCN", f"2026-06-{day:02d}", f"2026-06-{day + 7:02d}") for day in range(1, 15)]
+
+
+def fares(*prices):
+    return [SimpleNamespace(price=price) for price in prices]
+
+
+def search(**options):
+    options = dict(dict(round_size=2, max_calls=100, top_k=2, budget_share=0.5, min_gain=0.1), **options)
+    return fa.FlexibleDateSearch(SEARCHES, **options)
+
+
+def test_rounds_go_in_order_until_exhausted():
+    flex = search(min_gain=0)
+    rounds = []
+    while True:
+        batch = flex.next_round()
+        if not batch:
+            break
+        rounds.append(batch)
+        flex.add_round({route: [] for route in batch})
+
+    assert [route for batch in rounds for route in batch] == SEARCHES
+    assert flex.stop_reason == "exhausted"
+
+
+def test_call_cap():
+    flex = search(max_calls=3)
+
+    assert flex.next_round() == SEARCHES[:2]
+    assert flex.next_round() == SEARCHES[2:3]
+    assert flex.next_round() == []
+    assert flex.stop_reason == "call cap"
+    assert flex.calls == 3
+
+
+def test_stops_once_the_top_fares_are_well_under_budget():
+    flex = search(budget=1000)
+    batch = flex.next_round()
+    flex.add_round({batch[0]: fares(300, 400), batch[1]: fares(450)})
+
+    assert flex.stop_reason == "under budget"
+    assert flex.next_round() == []
+
+
+def test_keeps_going_while_rounds_improve():
+    flex = search()
+    batch = flex.next_round()
+    flex.add_round({batch[0]: fares(500, 600), batch[1]: fares(200)})
+    assert flex.stop_reason is None  # 200 + 500 beats the requested dates' 500 + 600
+
+    batch = flex.next_round()
+    flex.add_round({batch[0]: fares(150, 180), batch[1]: []})
+    assert flex.stop_reason is None
+    assert flex.prices[:2] == [150, 180]
+
+
+def test_stops_when_a_round_barely_improves():
+    flex = search()
+    batch = flex.next_round()
+    flex.add_round({batch[0]: fares(500, 600), batch[1]: fares(200)})
+    batch = flex.next_round()
+    flex.add_round({batch[0]: fares(480), batch[1]: fares(650)})  # 200 + 480 vs 200 + 500
+
+    assert flex.stop_reason == "no improvement"
+
+
+def test_first_round_is_judged_against_the_requested_dates():
+    # The other first-round dates are no cheaper than the requested ones
+    flex = search()
+    batch = flex.next_round()
+    flex.add_round({batch[0]: fares(200, 210), batch[1]: fares(300, 310)})
+
+    assert flex.stop_reason == "no improvement"
+
+
+def test_unpriced_fares_are_ignored():
+    flex = search(budget=1000)
+    batch = flex.next_round()
+    flex.add_round({batch[0]: fares(None, "n/a", 300), batch[1]: []})
+
+    assert flex.prices == [300]
+    assert flex.stop_reason is None
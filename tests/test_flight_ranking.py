@@ -0,0 +1,76 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+import flight_agent as fa
+
+
+def flight(price, duration, stops=0, name=None):
+    return SimpleNamespace(
+        name=name, price=price, total_duration=duration,
+        outbound_duration=None, return_duration=None, outbound_stops=stops, return_stops=0
+    )
+
+
+@pytest.mark.parametrize("k", [0, 1, 3, 10, 50])
+def test_top_k_matches_a_stable_sort(k):
+    rng = random.Random(k)
+    items = [rng.randint(0, 20) for _ in range(40)]
+
+    assert fa.top_k(items, k, lambda x: x) == sorted(items)[:k]
+
+
+def test_top_k_keeps_input_order_on_ties():
+    items = [("a", 2), ("b", 1), ("c", 2), ("d", 1)]
+
+    assert fa.top_k(items, 3, lambda item: item[1]) == [("b", 1), ("d", 1), ("a", 2)]
+
+
+def test_pareto_frontier_drops_dominated_flights():
+    cheap = flight(100, 600, stops=2, name="cheap")
+    fast = flight(300, 120, name="fast")
+    balanced = flight(180, 300, stops=1, name="balanced")
+    dominated = flight(200, 400, stops=1, name="dominated")  # balanced is cheaper, quicker, same stops
+    slower_direct = flight(250, 700, name="slower direct")   # only direct flights can beat it, and fast costs more
+
+    frontier = fa.pareto_frontier([dominated, fast, cheap, balanced, slower_direct])
+
+    assert [f.name for f in frontier] == ["cheap", "balanced", "slower direct", "fast"]
+
+
+def test_pareto_frontier_keeps_one_of_identical_flights():
+    first, second = flight(100, 120), flight(100, 120)
+
+    assert fa.pareto_frontier([first, second]) == [first]
+
+
+def test_pareto_frontier_treats_unknown_duration_as_worst():
+    known = flight(100, 120)
+    unknown = flight(100, None)
+
+    assert fa.pareto_frontier([unknown, known]) == [known]
+
+
+def brute_force_frontier(flights):
+    def objectives(f):
+        duration = fa.flight_duration(f)
+        return (f.price or float("inf"), float("inf") if duration is None else duration, fa.flight_stops(f))
+
+    def dominates(a, b):
+        return all(x <= y for x, y in zip(a, b))
+
+    keyed = [(objectives(f), i, f) for i, f in enumerate(flights)]
+    return {
+        i for a, i, _ in keyed
+        if not any(dominates(b, a) and (b != a or j < i) for b, j, _ in keyed if j != i)
+    }
+
+
+def test_pareto_frontier_matches_brute_force():
+    rng = random.Random(7)
+    flights = [flight(rng.randint(50, 400), rng.choice([None, *range(60, 900, 30)]), rng.randint(0, 2)) for _ in range(200)]
+
+    frontier = fa.pareto_frontier(flights)
+
+    assert {flights.index(f) for f in frontier} == brute_force_frontier(flights)
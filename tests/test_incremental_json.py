@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import flight_agent as fa
+
+DOCUMENT = {
+    "overview": {"destination": "Lisbon, \"the city\" {of} [seven] hills"},
+    "daily_itinerary": [
+        {"day": 1, "theme": "Alfama", "stops": ["Sé", "Miradouro"]},
+        {"day": 2, "theme": "Belém, with a \\ backslash"},
+    ],
+    "restaurants": {"dinner": [{"name": "Ramiro"}], "lunch": []},
+    "nightlife": [],
+}
+
+
+def parse(chunks, watch=fa.is_itinerary_section):
+    found = []
+    parser = fa.IncrementalJSONParser(lambda path, value: found.append((path, value)), watch)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser, found
+
+
+def test_sections_match_the_whole_document_whatever_the_chunking():
+    text = "```json\n" + json.dumps(DOCUMENT, ensure_ascii=False) + "\n```"
+    _, expected = parse([text])
+
+    for size in (1, 3, 17):
+        parser, found = parse([text[i:i + size] for i in range(0, len(text), size)])
+        assert found == expected
+        assert parser.done
+
+    assert expected == [
+        (["overview"], DOCUMENT["overview"]),
+        (["daily_itinerary", 0], DOCUMENT["daily_itinerary"][0]),
+        (["daily_itinerary", 1], DOCUMENT["daily_itinerary"][1]),
+        (["restaurants", "dinner"], DOCUMENT["restaurants"]["dinner"]),
+        (["restaurants", "lunch"], []),
+    ]
+
+
+def test_sections_are_reported_as_soon_as_they_close():
+    text = json.dumps(DOCUMENT)
+    day_one_end = text.index("}", text.index('"day": 1')) + 1
+
+    _, found = parse([text[:day_one_end]])
+
+    assert [path for path, _ in found] == [["overview"], ["daily_itinerary", 0]]
+
+
+def test_stops_after_the_top_level_object_closes():
+    parser, found = parse(['{"overview": {"a": 1}} {"overview": {"b": 2}}'])
+
+    assert parser.done
+    assert found == [(["overview"], {"a": 1})]
+
+
+@pytest.mark.parametrize("path,watched", [
+    (["overview"], True),
+    (["daily_itinerary"], False),
+    (["daily_itinerary", 3], True),
+    (["daily_itinerary", 3, "morning"], False),
+    (["restaurants", "dinner"], True),
+])
+def test_section_granularity(path, watched):
+    assert fa.is_itinerary_section(path) is watched
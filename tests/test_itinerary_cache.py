@@ -0,0 +1,53 @@
+import os
+import time
+
+import flight_agent as fa
+
+ENTRY = {"overview": {"destination": "x" * 200}}
+
+
+def entry_size():
+    return len(fa.json.dumps(ENTRY, ensure_ascii=False).encode("utf-8"))
+
+
+def test_round_trip_and_ttl(tmp_path):
+    cache = fa.ItineraryDiskCache(str(tmp_path), ttl=60)
+    assert cache.get("a") is None
+
+    cache.put("a", ENTRY)
+    assert cache.get("a") == ENTRY
+
+    old = time.time() - 120
+    os.utime(tmp_path / "a.json", (old, old))
+    assert cache.get("a") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_bound_holds_across_instances_sharing_a_directory(tmp_path):
+    # Two workers, each of which alone stays under the bound
+    workers = [fa.ItineraryDiskCache(str(tmp_path), max_bytes=entry_size() * 3) for _ in range(2)]
+    for i in range(8):
+        workers[i % 2].put(f"key{i}", ENTRY)
+        time.sleep(0.01)  # distinct mtimes
+
+    stats = workers[0].stats()
+    assert stats["bytes"] <= entry_size() * 3
+    assert sorted(os.listdir(tmp_path)) == ["key5.json", "key6.json", "key7.json"]
+    assert workers[0].evictions + workers[1].evictions == 5
+
+
+def test_hit_protects_an_entry_from_eviction(tmp_path):
+    cache = fa.ItineraryDiskCache(str(tmp_path), max_bytes=entry_size() * 2)
+    cache.put("old", ENTRY)
+    time.sleep(0.01)
+    cache.put("newer", ENTRY)
+    time.sleep(0.01)
+    assert cache.get("old") == ENTRY  # now the most recently used
+    time.sleep(0.01)
+    cache.put("newest", ENTRY)
+
+    assert sorted(os.listdir(tmp_path)) == ["newest.json", "old.json"]
+
+
+def test_agents_share_one_cache():
+    assert fa.agent.itinerary_cache is fa.get_async_agent().itinerary_cache is fa.itinerary_cache
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import flight_agent as fa
+
+DAYS = 4
+SECTION_DELAY = 0.1
+TRIP = {"service_type": "itinerary_only", "destination": "BCN", "duration_days": DAYS, "itinerary_deadline": 0.05}
+
+
+def generated_itinerary():
+    itinerary = fa.agent._get_fallback_itinerary("Barcelona, Spain", DAYS)
+    itinerary["daily_itinerary"] = [dict(day, theme=f"Generated day {day['day']}") for day in itinerary["daily_itinerary"]]
+    return itinerary
+
+
+def slow_generation(prompt, on_section=None):
+    itinerary = generated_itinerary()
+    for index, day in enumerate(itinerary["daily_itinerary"]):
+        time.sleep(SECTION_DELAY)
+        if on_section:
+            on_section(["daily_itinerary", index], day)
+    return itinerary
+
+
+async def aslow_generation(prompt, on_section=None):
+    itinerary = generated_itinerary()
+    for index, day in enumerate(itinerary["daily_itinerary"]):
+        await asyncio.sleep(SECTION_DELAY)
+        if on_section:
+            on_section(["daily_itinerary", index], day)
+    return itinerary
+
+
+@pytest.fixture
+def slow_model(monkeypatch, tmp_path):
+    async_agent = fa.get_async_agent()
+    for agent, generate in ((fa.agent, slow_generation), (async_agent, aslow_generation)):
+        monkeypatch.setattr(agent, "_generate_itinerary", generate)
+        monkeypatch.setattr(agent, "itinerary_cache", fa.ItineraryDiskCache(str(tmp_path / type(agent).__name__)))
+    monkeypatch.setattr(fa, "ITINERARY_UPGRADE_WAIT", 5)
+
+
+def assert_result_is_final(events):
+    names = [event for event, _ in events]
+    assert "result" in names
+    after_result = names[names.index("result") + 1:]
+    assert after_result == ["itinerary_upgrade"]
+    assert not [data for event, data in events if event == "itinerary_section" and data["path"] == ["upgrade"]]
+    upgrade = events[-1][1]
+    assert upgrade["daily_itinerary"][0]["theme"] == "Generated day 1"
+
+
+def parse_ndjson(text):
+    return [(line["event"], line["data"]) for line in map(json.loads, text.splitlines()) if line]
+
+
+def test_flask_stream_sends_nothing_after_result_but_the_upgrade(slow_model):
+    response = fa.app.test_client().post("/itinerary/stream", json=TRIP)
+
+    assert_result_is_final(parse_ndjson(response.get_data(as_text=True)))
+
+
+def test_asgi_stream_sends_nothing_after_result_but_the_upgrade(slow_model):
+    body = []
+
+    async def receive():
+        return {"type": "http.request", "body": json.dumps(TRIP).encode()}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    scope = {"type": "http", "method": "POST", "path": "/itinerary/stream", "query_string": b"", "headers": []}
+    asyncio.run(fa.asgi_app(scope, receive, send))
+
+    assert_result_is_final(parse_ndjson(b"".join(body).decode()))
+
+
+def test_job_events_stop_when_the_job_is_done(slow_model):
+    client = fa.app.test_client()
+    job_id = client.post("/jobs", json=TRIP).json["job_id"]
+    snapshot = client.get(f"/jobs/{job_id}?wait=5").json
+    while snapshot["status"] not in ("done", "failed"):
+        snapshot = client.get(f"/jobs/{job_id}?since={snapshot['next']}&wait=5").json
+    assert snapshot["status"] == "done"
+
+    time.sleep(SECTION_DELAY * (DAYS + 1))  # the background generation finishes meanwhile
+    assert client.get(f"/jobs/{job_id}").json["next"] == snapshot["next"]
+
+
+def test_saturated_pool_generates_inline_without_the_deadline(slow_model, monkeypatch):
+    monkeypatch.setattr(fa.agent, "itinerary_slots", fa.threading.BoundedSemaphore(1))
+    fa.agent.itinerary_slots.acquire()
+    saturated = sum(value for _, _, value in fa.ITINERARY_POOL_SATURATED.samples())
+
+    result = fa.app.test_client().post("/itinerary", json=TRIP).json
+
+    assert sum(value for _, _, value in fa.ITINERARY_POOL_SATURATED.samples()) == saturated + 1
+    assert "upgrade" not in result["itinerary"]
+    assert result["itinerary"]["daily_itinerary"][0]["theme"] == "Generated day 1"
+
+
+def test_async_upgrade_poll_wakes_on_resolve_without_a_thread(monkeypatch):
+    upgrades = fa.ItineraryUpgrades()
+    token = upgrades.add()
+
+    async def forbidden(*args, **kwargs):
+        raise AssertionError("long-polls must not take a default executor thread")
+
+    async def poll():
+        monkeypatch.setattr(fa.asyncio, "to_thread", forbidden)
+        resolver = fa.threading.Timer(0.05, upgrades.resolve, (token, {"days": 1}))
+        resolver.start()
+        started = time.monotonic()
+        snapshot = await upgrades.aget(token, wait=5)
+        return snapshot, time.monotonic() - started
+
+    snapshot, waited = asyncio.run(poll())
+    assert snapshot == {"status": "ready", "itinerary": {"days": 1}}
+    assert waited < 1
+
+
+def test_async_job_poll_times_out_with_the_snapshot():
+    store = fa.JobStore(lambda data, emit: ({}, 200))
+    job = fa.TripJob({})
+    store._jobs[job.id] = job
+
+    snapshot = asyncio.run(store.aget(job.id, wait=0.05))
+    assert snapshot["status"] == "queued" and snapshot["next"] == 0
+    assert not store._async_waiters._waiters
@@ -0,0 +1,41 @@
+import pytest
+
+import flight_agent as fa
+
+BASE = {"origin": "LON", "outbound_date": "2026-12-01"}
+
+
+@pytest.mark.parametrize("fields", [
+    {"destinations": "BCN"},
+    {"destinations": ["BCN", 1]},
+    {"duration_days": "3"},
+    {"duration_days": 0},
+    {"duration_days": 1.5},
+    {"return_date": "2026-11-30"},
+    {"return_date": "2026-12-01"},
+])
+def test_invalid_bodies_are_rejected(fields):
+    comparison, error = fa.prepare_comparison(dict(BASE, **fields))
+
+    assert comparison is None and "error" in error
+
+
+def test_defaults_to_a_weekend_at_every_comparison_destination():
+    comparison, error = fa.prepare_comparison(BASE)
+
+    assert error is None
+    assert comparison["nights"] == 2
+    assert comparison["destinations"] == list(fa.COMPARE_DESTINATIONS)
+
+
+def test_skips_duplicates_and_the_origin_metro_area():
+    comparison, _ = fa.prepare_comparison(dict(BASE, destinations=["BCN", "LHR", "BCN"], duration_days=3))
+
+    assert comparison["destinations"] == ["BCN"]
+    assert comparison["nights"] == 3
+
+
+def test_compare_route_answers_400():
+    response = fa.app.test_client().post("/compare", json=dict(BASE, destinations="BCN"))
+
+    assert response.status_code == 400
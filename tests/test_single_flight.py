@@ -0,0 +1,110 @@
+import asyncio
+import threading
+
+import pytest
+
+import flight_agent as fa
+
+
+def run_together(flight, count, fn, key="key"):
+    """Call flight.do from ``count`` threads at once; returns their results or exceptions"""
+    outcomes = [None] * count
+
+    def call(i):
+        try:
+            outcomes[i] = flight.do(key, fn)
+        except Exception as e:
+            outcomes[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def blocking(release, result=None, error=None):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        if error:
+            raise error
+        return result
+
+    return fn, calls
+
+
+def test_concurrent_callers_share_one_call():
+    flight = fa.SingleFlight()
+    release = threading.Event()
+    fn, calls = blocking(release, result={"flights": 3})
+    threading.Timer(0.1, release.set).start()
+
+    outcomes = run_together(flight, 5, fn)
+
+    assert calls == [1]
+    assert all(outcome is outcomes[0] for outcome in outcomes)
+    assert flight.stats() == {"calls": 1, "coalesced": 4, "in_flight": 0}
+
+
+def test_exception_reaches_every_waiter():
+    flight = fa.SingleFlight()
+    release = threading.Event()
+    error = RuntimeError("upstream down")
+    fn, calls = blocking(release, error=error)
+    threading.Timer(0.1, release.set).start()
+
+    outcomes = run_together(flight, 4, fn)
+
+    assert calls == [1]
+    assert all(outcome is error for outcome in outcomes)
+
+
+def test_key_is_released_after_a_failure():
+    flight = fa.SingleFlight()
+
+    with pytest.raises(ValueError):
+        flight.do("key", lambda: (_ for _ in ()).throw(ValueError("bad")))
+    assert flight.do("key", lambda: "retried") == "retried"
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_async_exception_reaches_every_waiter():
+    flight = fa.SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        raise RuntimeError("upstream down")
+
+    async def main():
+        return await asyncio.gather(*(flight.ado("key", fn) for _ in range(4)), return_exceptions=True)
+
+    outcomes = asyncio.run(main())
+
+    assert calls == [1]
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_async_waiters_survive_another_callers_cancellation():
+    flight = fa.SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.ado("key", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.ado("key", fn))
+        impatient = asyncio.ensure_future(flight.ado("key", fn))
+        await asyncio.sleep(0)
+        impatient.cancel()
+        return await leader, await follower
+
+    assert asyncio.run(main()) == ("done", "done")